@@ -1,29 +1,64 @@
 import asyncore
-import asynchat
+import collections
+import functools
+import itertools
 import socket
-import json
-import util
+import time
 import logging
+import partitioner as partitioners
 import sys
 
-class PynamoClient(asynchat.async_chat):
+from consistent_hash_ring import ConsistentHashRing
+from wire_protocol import MessageChannel, FRAMING_BINARY
 
-    def __init__(self, host, port):
+
+def _request(command, quorum_field=None, quorum=None, **fields):
+    """ Returns the message for command, with quorum as quorum_field ('r' or 'w') if given."""
+    message = dict(fields, command=command)
+    if quorum:
+        message[quorum_field] = quorum
+    return message
+
+def _put_request(key, value, w=None, context=None):
+    message = _request('put', 'w', w, key=key, value=value)
+    if context:
+        message['context'] = context
+    return message
+
+def _get_request(key, r=None):
+    return _request('get', 'r', r, key=key)
+
+def _delete_request(key, w=None):
+    return _request('delete', 'w', w, key=key)
+
+def _batch_put_request(items, w=None):
+    return _request('batch_put', 'w', w, items=[[key, value] for key, value in items])
+
+def _batch_get_request(keys, r=None):
+    return _request('batch_get', 'r', r, keys=list(keys))
+
+def _batch_delete_request(keys, w=None):
+    return _request('batch_delete', 'w', w, keys=list(keys))
+
+def _poll(timeout):
+    """ Waits up to timeout seconds, forever if None, for events on the asyncore socket map and handles them."""
+    asyncore.loop(timeout=timeout, count=1)
+
+
+class PynamoClient(MessageChannel):
+
+    def __init__(self, host, port, framing=FRAMING_BINARY):
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.debug('__init__')
 
-        asynchat.async_chat.__init__(self)
+        MessageChannel.__init__(self, framing=framing)
         self.host = host
         self.port = port
-        self._read_buffer = []
         self._write_buffer = []
 
         self._requests = []
         self._replies = []
 
-        self.terminator = "\r\n"
-        self.set_terminator(self.terminator)
-
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
             self.connect((host, int(port)))
@@ -48,53 +83,45 @@ class PynamoClient(asynchat.async_chat):
     def send_message(self, message):
         self.logger.debug('send_message')
         self.logger.debug('send_message.  message: {}'.format(message))
-        self.push(util.pack_message(message, self.terminator))
+        self.push(self.pack_message(message))
 
-    def put(self, key, value):
-        self.logger.debug('put')
-        message = {
-            'command' : 'put',
-            'key' : key,
-            'value' : value
-        }
+    def _send_request(self, message):
         self._requests.append(message)
         self.send_message(message)
 
-    def get(self, key):
+    def put(self, key, value, w=None, context=None):
+        self.logger.debug('put')
+        self._send_request(_put_request(key, value, w, context))
+
+    def get(self, key, r=None):
         self.logger.debug('get')
-        message = {
-            'command' : 'get',
-            'key' : key
-        }
-        self._requests.append(message)
-        self.send_message(message)
+        self._send_request(_get_request(key, r))
 
-    def delete(self, key):
+    def delete(self, key, w=None):
         self.logger.debug('delete')
-        message = {
-            'command' : 'delete',
-            'key' : key
-        }
-        self._requests.append(message)
-        self.send_message(message)
+        self._send_request(_delete_request(key, w))
+
+    def batch_put(self, items, w=None):
+        """ Puts every (key, value) pair in items with a single message; the reply holds a result per item, in order."""
+        self.logger.debug('batch_put')
+        self._send_request(_batch_put_request(items, w))
+
+    def batch_get(self, keys, r=None):
+        """ Gets every key in keys with a single message; the reply holds a result per key, in order."""
+        self.logger.debug('batch_get')
+        self._send_request(_batch_get_request(keys, r))
+
+    def batch_delete(self, keys, w=None):
+        """ Deletes every key in keys with a single message; the reply holds a result per key, in order."""
+        self.logger.debug('batch_delete')
+        self._send_request(_batch_delete_request(keys, w))
 
     def shutdown(self):
         self.logger.debug('shutdown')
-        message = {
-            'command' : 'shutdown'
-        }
-        self._requests.append(message)
-        self.send_message(message)
-
-    def collect_incoming_data(self, data):
-        self.logger.debug('collect_incoming_data')
-        self.logger.debug('collect_incoming_data.  data: {}'.format(data))
-        self._read_buffer.append(data)
+        self._send_request(_request('shutdown'))
 
-    def found_terminator(self):
-        self.logger.debug('found_terminator')
-        reply = json.loads(''.join(self._read_buffer))
-        self._read_buffer = []
+    def _process_message(self, reply):
+        self.logger.debug('_process_message')
         self._handle_reply(reply)
 
     def _handle_reply(self, reply):
@@ -102,3 +129,412 @@ class PynamoClient(asynchat.async_chat):
         self.logger.debug('_handle_reply.  appended reply: {}'.format(reply))
         self._replies.append(reply)
 
+
+
+class PynamoFuture(object):
+    """
+    Result of a request sent through a PynamoClientPool.
+    ----------
+        -done once the server's reply has arrived; callbacks added with add_done_callback are then called with the future.
+        -result() drives the asyncore loop until the reply arrives, so it can be used without running a loop elsewhere;
+         each pass blocks on the socket map for the time left.
+    """
+
+    def __init__(self, request=None):
+        self.request = request
+        self.address = None
+        self._reply = None
+        self._callbacks = []
+
+    def done(self):
+        return self._reply is not None
+
+    def add_done_callback(self, callback):
+        """ Calls callback(future) once the reply arrives, or immediately if it already has."""
+        if self.done():
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, reply):
+        self._reply = reply
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def result(self, timeout=None):
+        """
+        Returns:
+            the reply, e.g. {'error_code': '\x00', 'value': 'value'} for a get.
+
+        Raises:
+            socket.timeout if no reply arrived within timeout seconds.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        while not self.done():
+            remaining = deadline - time.time() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout('no reply to {} within {}s'.format(self.request, timeout))
+            _poll(remaining)
+        return self._reply
+
+
+class PooledClientConnection(MessageChannel):
+    """
+    One persistent, pipelined connection to a server.
+    ----------
+        -requests are tagged with a request id and replies matched to their PynamoFuture by id, so any number may be
+         outstanding and the server may answer them in any order.
+        -requests queued during one pass of the asyncore loop are written together in a single send, by handle_write.
+        -if the connection is lost, the outstanding futures resolve to error code '\x10' (server unreachable).
+    """
+
+    def __init__(self, host, port, framing=FRAMING_BINARY, terminator="\r\n", on_connect=None):
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        MessageChannel.__init__(self, framing=framing, terminator=terminator)
+        self.host = host
+        self.port = port
+        self._write_buffer = []
+        self._request_ids = itertools.count()
+        # request_id -> PynamoFuture awaiting its reply
+        self._futures = dict()
+        # called with self once the connection is established
+        self._on_connect = on_connect
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect((host, int(port)))
+        except:
+            self.logger.error('__init__.  connection refused.')
+
+    @property
+    def num_pending(self):
+        """ Returns the number of requests awaiting a reply."""
+        return len(self._futures)
+
+    def send_request(self, message):
+        """
+        Queues message for sending once the socket is writable.
+
+        Returns:
+            PynamoFuture for the reply.
+        """
+        future = PynamoFuture(request=message)
+        request_id = next(self._request_ids)
+        self._futures[request_id] = future
+        self._write_buffer.append(self.pack_message(dict(message, request_id=request_id)))
+        return future
+
+    def writable(self):
+        """ Implements asyncore.dispatcher's writable method: True while there is anything to send, or to connect."""
+        return MessageChannel.writable(self) or bool(self._write_buffer)
+
+    def handle_write(self):
+        """
+        Implements asyncore.dispatcher's handle_write method.
+            -pushes every request queued since the last write as one, then sends what asynchat holds.
+        """
+        if self._write_buffer:
+            data, self._write_buffer = ''.join(self._write_buffer), []
+            self.push(data)
+        else:
+            MessageChannel.handle_write(self)
+
+    def handle_connect(self):
+        if self._on_connect:
+            self._on_connect(self)
+
+    def _process_message(self, reply):
+        try:
+            future = self._futures.pop(reply.pop('request_id'))
+        except KeyError:
+            self.logger.error('_process_message.  no request waiting for reply: {}'.format(reply))
+            return
+        future.set_result(reply)
+
+    def handle_error(self):
+        self.logger.error('handle_error.  {}'.format(sys.exc_info()))
+        self.handle_close()
+
+    def handle_close(self):
+        self.logger.debug('handle_close')
+        self.close()
+        futures, self._futures = self._futures, dict()
+        self._write_buffer = []
+        for future in futures.values():
+            future.set_result({'error_code': '\x10'})
+
+
+class PynamoClientPool(object):
+    """
+    Client keeping connections_per_server persistent, pipelined connections to each server.
+    ----------
+        -put/get/delete return a PynamoFuture immediately; requests are spread over the least busy connections, so
+         a single client process can keep many thousands of requests in flight.
+        -connections that are lost are replaced on the next request.
+        -if token_aware, the client keeps its own ConsistentHashRing, fetched with a 'ring' request, and sends each
+         request straight to the least busy replica of its key, saving the coordinator a hop.  every reply carries
+         the server's ring_version; the ring is fetched again when it differs or a replica can't be reached.
+        -a request whose server can't be reached is sent again to the next reachable replica of its key, or for a
+         batch to the next reachable server.  the server is skipped until it leaves the ring or a new connection to it
+         succeeds; each ring fetch tries to connect to the servers skipped.
+    """
+
+    def __init__(self, addresses, connections_per_server=4, token_aware=True, framing=FRAMING_BINARY):
+        """
+        Args:
+        ----------
+        addresses (list of (host, port)):
+            external addresses of the servers to send requests to; with token_aware, the seeds the ring is fetched from.
+        connections_per_server (int, optional):
+            number of connections kept open to each server, defaults to 4.
+        token_aware (bool, optional):
+            route requests to the replicas of their key, defaults to True.
+        framing (str, optional):
+            wire_protocol.FRAMING_BINARY or FRAMING_JSON, defaults to binary frames.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        self._addresses = list(addresses)
+        self._connections_per_server = connections_per_server
+        self._framing = framing
+        self._connections = collections.defaultdict(list)
+        self._next_address = itertools.cycle(self._addresses)
+
+        self._token_aware = token_aware
+        self._ring = None
+        # hashes keys onto the ring, as the servers' partitioner does
+        self._partitioner = None
+        self._ring_version = None
+        # node_hash -> (host, external_port)
+        self._ring_addresses = dict()
+        # addresses that couldn't be reached, skipped until they leave the ring or a connection to them succeeds
+        self._unreachable_addresses = set()
+        self._ring_refresh = None
+        if token_aware:
+            self.refresh_ring()
+
+    @property
+    def ring_version(self):
+        return self._ring_version
+
+    def refresh_ring(self):
+        """
+        Fetches the ring from the next seed server, unless a fetch is already in flight.
+
+        Returns:
+            PynamoFuture for the 'ring' reply.
+        """
+        if self._ring_refresh is None or self._ring_refresh.done():
+            self._ring_refresh = self.send_request({'command': 'ring'})
+            self._ring_refresh.add_done_callback(self._update_ring)
+        return self._ring_refresh
+
+    def _update_ring(self, future):
+        reply = future.result()
+        if reply['error_code'] != '\x00':
+            self.logger.error('_update_ring.  ring request failed: {}'.format(reply))
+            return
+        ring_addresses = dict()
+        for node_hash, node_address in reply['nodes'].items():
+            hostname, external_port, _ = node_address.split(',')
+            ring_addresses[node_hash] = (hostname, int(external_port))
+        try:
+            self._partitioner = partitioners.get_partitioner(reply.get('partitioner', partitioners.DEFAULT_PARTITIONER))
+        except ValueError as e:
+            self.logger.error('_update_ring.  {}, sending requests to the servers in turn'.format(e))
+            self._ring = None
+            return
+        self._ring = ConsistentHashRing(node_hashes=ring_addresses.keys(), num_replicas=reply['num_replicas'],
+                                        vnodes=reply.get('vnodes', 1), weights=reply.get('weights'))
+        self._ring_addresses = ring_addresses
+        self._ring_version = reply['ring_version']
+        self._unreachable_addresses &= set(ring_addresses.values())
+        for address in list(self._unreachable_addresses):
+            # opens a connection if the pool has none left, which clears the address once it connects
+            self._connection(address)
+        self.logger.debug('_update_ring.  ring version {}, {} nodes'.format(self._ring_version, len(ring_addresses)))
+
+    def _num_pending(self, address):
+        return sum(connection.num_pending for connection in self._connections[address])
+
+    def _replica_addresses(self, key):
+        """
+        Returns:
+            addresses of the replicas of key, the seed servers if the ring is unknown.
+        """
+        if not self._ring:
+            return list(self._addresses)
+        return [self._ring_addresses[node_hash] for node_hash in self._ring.get_responsible_node_hashes(self._partitioner.key_hash(key))]
+
+    def _least_busy_address(self, addresses):
+        """
+        Returns:
+            the address in addresses with the fewest requests pending, preferring those not marked unreachable.
+        """
+        reachable_addresses = [address for address in addresses if address not in self._unreachable_addresses]
+        return min(reachable_addresses or addresses, key=self._num_pending)
+
+    def _replica_address(self, key):
+        """
+        Returns:
+            address of the least busy reachable replica of key, None if the ring is unknown.
+        """
+        if not self._ring:
+            return None
+        return self._least_busy_address(self._replica_addresses(key))
+
+    @staticmethod
+    def _unreachable(reply):
+        """ Returns True if reply reports its server couldn't be reached: a server's own replies carry its ring_version."""
+        return reply['error_code'] == '\x10' and 'ring_version' not in reply
+
+    def _check_ring_version(self, future):
+        reply = future.result()
+        if self._unreachable(reply):
+            self._unreachable_addresses.add(future.address)
+            self.refresh_ring()
+        else:
+            self._unreachable_addresses.discard(future.address)
+            if reply.get('ring_version') != self._ring_version:
+                self.refresh_ring()
+
+    def _connection(self, address):
+        connections = self._connections[address]
+        connections[:] = [connection for connection in connections if connection.connected or connection.connecting]
+        if len(connections) < self._connections_per_server:
+            connection = PooledClientConnection(*address, framing=self._framing, on_connect=lambda connection: self._unreachable_addresses.discard(address))
+            connections.append(connection)
+            return connection
+        return min(connections, key=lambda connection: connection.num_pending)
+
+    def send_request(self, message, address=None):
+        """
+        Sends message to address, or to the servers in turn if address is None.
+
+        Returns:
+            PynamoFuture for the reply.
+        """
+        if address is None:
+            address = next(self._next_address)
+        future = self._connection(address).send_request(message)
+        future.address = address
+        return future
+
+    def _send_failover_request(self, message, address, addresses):
+        """
+        Sends message to address, then, each time the server it was sent to can't be reached, to the least busy
+        reachable one of addresses it hasn't been sent to yet.
+
+        Returns:
+            PynamoFuture for the first reply from a server that could be reached, or the last failure if none could.
+        """
+        future = PynamoFuture(request=message)
+        tried = set()
+
+        def send(address):
+            tried.add(address)
+            future.address = address
+            attempt = self.send_request(message, address)
+            attempt.add_done_callback(self._check_ring_version)
+            attempt.add_done_callback(handle_reply)
+
+        def handle_reply(attempt):
+            reply = attempt.result()
+            untried = [address for address in addresses if address not in tried]
+            if self._unreachable(reply) and untried:
+                self.logger.debug('_send_failover_request.  {} unreachable, trying another server'.format(attempt.address))
+                send(self._least_busy_address(untried))
+            else:
+                future.set_result(reply)
+
+        send(address)
+        return future
+
+    def _send_keyed_request(self, message):
+        """
+        Sends a put/get/delete to a replica of its key if the ring is known, to the servers in turn otherwise.  if the
+        replica can't be reached, the request goes to the next reachable replica.
+        """
+        if not self._token_aware:
+            return self.send_request(message)
+        addresses = self._replica_addresses(message['key'])
+        return self._send_failover_request(message, self._least_busy_address(addresses), addresses)
+
+    def put(self, key, value, w=None, context=None):
+        return self._send_keyed_request(_put_request(key, value, w, context))
+
+    def get(self, key, r=None):
+        return self._send_keyed_request(_get_request(key, r))
+
+    def delete(self, key, w=None):
+        return self._send_keyed_request(_delete_request(key, w))
+
+    def batch_put(self, items, w=None):
+        return self._send_batch_request(_batch_put_request(items, w), 'items')
+
+    def batch_get(self, keys, r=None):
+        return self._send_batch_request(_batch_get_request(keys, r), 'keys')
+
+    def batch_delete(self, keys, w=None):
+        return self._send_batch_request(_batch_delete_request(keys, w), 'keys')
+
+    def _send_batch_request(self, message, field):
+        """
+        Sends a batch message.  if the ring is known, the batch is split by the replica each key would be routed to,
+        and the replies are combined.  a part whose replica can't be reached goes to the next reachable server, which
+        coordinates it like any batch.
+
+        Returns:
+            PynamoFuture for a reply whose 'results' hold a result per entry of message[field], in order.
+        """
+        entries = message[field]
+        if not self._token_aware or not self._ring:
+            return self.send_request(message)
+
+        # address -> indices of the entries routed to it
+        address_indices = collections.defaultdict(list)
+        for index, entry in enumerate(entries):
+            key = entry[0] if field == 'items' else entry
+            address_indices[self._replica_address(key)].append(index)
+
+        future = PynamoFuture(request=message)
+        results = [None] * len(entries)
+        pending_addresses = set(address_indices)
+
+        def collect(address, part):
+            reply = part.result()
+            indices = address_indices[address]
+            part_results = reply.get('results') or [{'error_code': reply['error_code']} for _ in indices]
+            for index, result in zip(indices, part_results):
+                results[index] = result
+            pending_addresses.discard(address)
+            if not pending_addresses:
+                future.set_result({'error_code': '\x00', 'results': results})
+
+        if not entries:
+            future.set_result({'error_code': '\x00', 'results': results})
+        ring_addresses = self._ring_addresses.values()
+        for address, indices in address_indices.items():
+            part = self._send_failover_request(dict(message, **{field: [entries[index] for index in indices]}), address, ring_addresses)
+            part.add_done_callback(functools.partial(collect, address))
+        return future
+
+    @staticmethod
+    def wait(futures, timeout=None):
+        """
+        Drives the asyncore loop until every future in futures is done.
+
+        Returns:
+            list of the replies, in the order of futures.
+        """
+        return [future.result(timeout=timeout) for future in futures]
+
+    def close(self):
+        for connections in self._connections.values():
+            for connection in connections:
+                connection.close_when_done()
+        self._connections.clear()
@@ -1,15 +1,31 @@
+import array
 import bisect
 import logging
 
+import util
+
+# unsigned 64-bit array items on LP64 platforms, wide enough for util.TOKEN_BITS-bit tokens
+TOKEN_TYPECODE = 'L'
+
 class ConsistentHashRing(object):
     """
     Implements a consistent hash ring.
     ----------
         -given a list of nodes, determines the n nodes responsible for holding a given key.
-        -it's assumed that nodes and keys have been hashed appropriately prior to interaction with hash ring.
+        -it's assumed that nodes and keys have been hashed appropriately prior to interaction with hash ring: nodes are
+         identified by hex node hashes, keys by binary key hashes (util.get_key_hash).
+        -positions on the ring are TOKEN_BITS-bit integer tokens, held in an array; a key's token is the start of its
+         hash, a node's tokens are the start of its node hash and of hashes derived from it.  lookups bisect the
+         greatest key hash of each token instead, as python 2 compares short strings faster than integers.
+        -each node is placed on the ring as vnodes virtual nodes, or tokens, scaled by its weight.  a key belongs to
+         the first num_replicas distinct nodes owning a token clockwise of it, so a node's share of the keys follows its
+         weight, and the ranges of a node that leaves are taken over by many nodes rather than its successors.
+        -a node's first token is that of its node hash, so with one vnode per node the ring is the ring of node hashes.
+        -the preference list of every range is computed once per membership change, so a lookup is a bisect into the
+         tokens and returns a shared tuple.
     """
 
-    def __init__(self, node_hashes=None, num_replicas=3):
+    def __init__(self, node_hashes=None, num_replicas=3, vnodes=1, weights=None):
         """
         Args:
         ----------
@@ -17,15 +33,29 @@ class ConsistentHashRing(object):
             list of the hex strings representing nodes in the system.
         num_replicas(int, optional):
             number of replicas for each key-value  pair,defaults to 3.
+        vnodes(int, optional):
+            number of tokens per node of weight 1.0, defaults to 1.
+        weights(dict, optional):
+            node_hash -> weight, e.g. 2.0 for a node with twice the capacity.  nodes not in it have weight 1.0.
         """
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.debug('__init__')
         self.num_replicas = num_replicas
+        self._vnodes = vnodes
+        self._weights = dict(weights or {})
 
         if node_hashes:
             self._hash_ring = sorted(node_hashes)
         else:
             self._hash_ring = []
+        # node_hash -> its tokens, kept so a membership change only hashes the tokens of the node added
+        self._node_tokens = dict()
+        # sorted tokens, the node owning each and the preference list of the range ending at each
+        self._tokens = array.array(TOKEN_TYPECODE)
+        self._token_bounds = []
+        self._token_owners = ()
+        self._preference_lists = ()
+        self._place_tokens()
 
     def __len__(self):
         """ Returns the number of nodes still in hash ring"""
@@ -36,6 +66,37 @@ class ConsistentHashRing(object):
         """ returns the list of node hashes in the ring"""
         return self._hash_ring
 
+    @property
+    def tokens(self):
+        """ returns the sorted array of integer tokens of the nodes in the ring"""
+        return self._tokens
+
+    @property
+    def vnodes(self):
+        return self._vnodes
+
+    @property
+    def weights(self):
+        return dict(self._weights)
+
+    def node_tokens(self, node_hash):
+        """ Returns the tokens of node_hash: that of node_hash itself, then those of node_hash and the vnode's index."""
+        tokens = self._node_tokens.get(node_hash)
+        if tokens is None:
+            num_tokens = max(1, int(round(self._vnodes * self._weights.get(node_hash, 1.0))))
+            tokens = [util.node_token(node_hash)] + [util.get_token('{}:{}'.format(node_hash, index)) for index in xrange(1, num_tokens)]
+        return tokens
+
+    def _place_tokens(self):
+        """ Rebuilds the tokens and the preference list of every range after a membership change."""
+        self._node_tokens = {node_hash: self.node_tokens(node_hash) for node_hash in self._hash_ring}
+        placed = sorted((token, node_hash) for node_hash, tokens in self._node_tokens.iteritems() for token in tokens)
+        self._tokens = array.array(TOKEN_TYPECODE, (token for token, _ in placed))
+        self._token_bounds = [util.token_key_bound(token) for token in self._tokens]
+        self._token_owners = tuple(node_hash for _, node_hash in placed)
+        self._preference_lists = ()
+        self._preference_lists = tuple(self.preference_list(index) for index in xrange(len(self._tokens)))
+
     def add_node_hash(self, node_hash=None):
         """
         add node hash to hash ring.
@@ -46,8 +107,9 @@ class ConsistentHashRing(object):
             node_hash (str): the hex string representing the node to be added
 
          """
-        if node_hash:
+        if node_hash and node_hash not in self._hash_ring:
             bisect.insort(self._hash_ring, node_hash)
+            self._place_tokens()
 
     def remove_node_hash(self, node_hash=None):
         """
@@ -67,9 +129,10 @@ class ConsistentHashRing(object):
         if node_hash:
             try:
                 self._hash_ring.remove(node_hash)
-                return True
             except ValueError:
                 return False
+            self._place_tokens()
+            return True
 
     def get_responsible_node_hashes(self, key_hash=None):
         """
@@ -79,26 +142,113 @@ class ConsistentHashRing(object):
         Args:
         ----------
         key_hash (str):
-            hash value of a given key sent by a client.
+            binary hash of a given key sent by a client.
 
         Returns:
         ----------
-        if there are >= n nodes left in the hash ring, list of n nodes clockwise of given key hash where n = num_replicas
+        if there are >= n nodes left in the hash ring, tuple of n nodes clockwise of given key hash where n = num_replicas
         if there are <n nodes left in the hash ring, however many nodes are left
-        empty list otherwise
+        empty tuple otherwise
+        the tuple is shared by every key of the range, so it mustn't be modified.
 
         Example:
         ----------
-        for node_hashes [ 'A', 'B', 'C', 'D' ] and key_hash 'AA', [ 'B', 'C', 'D' ] would be returned.
+        for nodes with tokens [ 10, 20, 30, 40 ] and a key with token 15, ( 20, 30, 40 )'s nodes would be returned.
 
         """
-        self.logger.debug('get_responsible_node_hashes.  key_hash, num_replicas: {}, {}'.format(key_hash, self.num_replicas))
+        if self._tokens and key_hash:
+            return self._preference_lists[bisect.bisect_left(self._token_bounds, key_hash) % len(self._tokens)]
+        else:
+            return ()
 
-        if self.hash_ring and key_hash:
-            primary_position = bisect.bisect_left(self.hash_ring, key_hash)
-            if len(self.hash_ring) >= self.num_replicas:
-                return [self._hash_ring[ (primary_position + i) % len(self._hash_ring) ] for i in xrange(self.num_replicas)]
-            else:
-                return [self._hash_ring[ (primary_position + i) % len(self._hash_ring) ] for i in xrange(len(self.hash_ring))]
+    def token_node_hashes(self, token):
+        """ Returns the nodes responsible for the keys with the given token, see get_responsible_node_hashes."""
+        if self._tokens:
+            return self._preference_lists[bisect.bisect_left(self._tokens, token) % len(self._tokens)]
         else:
+            return ()
+
+    def preference_list(self, index, exclude=None):
+        """
+        Returns:
+            tuple of the first num_replicas distinct nodes, other than exclude, owning a token clockwise from the token
+            at index, i.e. the nodes responsible for the range (tokens[index - 1], tokens[index]].
+        """
+        if exclude is None and self._preference_lists:
+            return self._preference_lists[index % len(self._tokens)]
+        num_nodes = len(self._hash_ring) - (exclude in self._node_tokens)
+        num_replicas = min(self.num_replicas, num_nodes)
+        node_hashes = []
+        num_tokens = len(self._tokens)
+        for offset in xrange(num_tokens):
+            if len(node_hashes) == num_replicas:
+                break
+            node_hash = self._token_owners[(index + offset) % num_tokens]
+            if node_hash != exclude and node_hash not in node_hashes:
+                node_hashes.append(node_hash)
+        return tuple(node_hashes)
+
+    def clockwise_node_hashes(self, key_hash):
+        """
+        Returns:
+            every node in the ring once, in the order their first token is met going clockwise from key_hash.
+        """
+        if not self._tokens:
+            return list()
+        index = bisect.bisect_left(self._token_bounds, key_hash)
+        node_hashes = []
+        seen = set()
+        for offset in xrange(len(self._tokens)):
+            node_hash = self._token_owners[(index + offset) % len(self._tokens)]
+            if node_hash not in seen:
+                seen.add(node_hash)
+                node_hashes.append(node_hash)
+        return node_hashes
+
+    def ranges(self):
+        """
+        Returns:
+            list of (low, high] token ranges between consecutive tokens, in token order; the first wraps around the end
+            of the ring.  the nodes responsible for ranges()[index] are preference_list(index).
+        """
+        return [(self._tokens[index - 1], token) for index, token in enumerate(self._tokens)]
+
+    def without_node_hash(self, node_hash):
+        """
+        Returns:
+            a copy of the ring with node_hash removed, e.g. to diff with the ring before node_hash fails.  the tokens of
+            the other nodes are reused rather than hashed again.
+        """
+        ring = ConsistentHashRing(num_replicas=self.num_replicas, vnodes=self._vnodes, weights=self._weights)
+        ring._hash_ring = [other_node_hash for other_node_hash in self._hash_ring if other_node_hash != node_hash]
+        ring._node_tokens = self._node_tokens
+        ring._place_tokens()
+        return ring
+
+    def diff(self, other):
+        """
+        Compares the ownership of the ring with that of other, e.g. the ring once a node has left or joined.
+            -the ranges are those between consecutive tokens of either ring, with adjacent ranges that changed the same
+             way merged, so they can be streamed as is.
+            -costs O(t log t) for t tokens, independent of the number of keys stored.
+
+        Returns:
+        ----------
+        list of ((low, high), node_hashes, other_node_hashes) in token order, for every token range (low, high] whose
+        preference list differs between the rings, with node_hashes its preference list in self and other_node_hashes
+        that in other.  empty if either ring is.
+        """
+        if not self._tokens or not other._tokens:
             return list()
+        boundaries = sorted(set(self._tokens).union(other._tokens))
+        changes = []
+        for index, high in enumerate(boundaries):
+            node_hashes = self.token_node_hashes(high)
+            other_node_hashes = other.token_node_hashes(high)
+            if node_hashes == other_node_hashes:
+                continue
+            if changes and index > 0 and changes[-1][0][1] == boundaries[index - 1] and changes[-1][1:] == (node_hashes, other_node_hashes):
+                changes[-1] = ((changes[-1][0][0], high), node_hashes, other_node_hashes)
+            else:
+                changes.append(((boundaries[index - 1], high), node_hashes, other_node_hashes))
+        return changes
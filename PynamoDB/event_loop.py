@@ -0,0 +1,194 @@
+"""
+    event_loop.py
+    ~~~~~~~~~~~~
+    Implements EventLoop, which waits on the asyncore channels and on timers together, so a server blocks while idle
+    instead of polling its stages every millisecond.
+"""
+
+import asyncore
+import collections
+import errno
+import heapq
+import itertools
+import logging
+import select
+import sys
+
+import util
+
+
+class Handle(object):
+    """ A callback scheduled on an EventLoop; cancel() keeps it from running."""
+
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+    """
+    Single-threaded event loop over an asyncore socket map.
+    ----------
+        -each iteration waits in poll() for socket events until the next timer is due, without waiting at all if
+         callbacks are ready to run, then dispatches the events to the channels, runs the io callbacks if there were
+         any, and then runs the due timers and ready callbacks.
+        -callbacks run in the order they were scheduled; exceptions they raise are logged, not propagated.
+    """
+
+    def __init__(self, socket_map=None, max_wait=1.0):
+        """
+        Args:
+        ----------
+        socket_map (dict, optional):
+            asyncore socket map to wait on, defaults to asyncore.socket_map.
+        max_wait (float, optional):
+            longest time in seconds to wait in poll(), defaults to 1s.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        self._map = asyncore.socket_map if socket_map is None else socket_map
+        self._max_wait = max_wait
+        self._ready = collections.deque()
+        # heap of (when, sequence, Handle)
+        self._timers = []
+        self._sequence = itertools.count()
+        self._io_callbacks = []
+        self._running = False
+
+        self._metrics = {
+            'iterations': 0,
+            'io_events': 0,
+            'callbacks': 0
+        }
+
+    @property
+    def metrics(self):
+        return dict(self._metrics)
+
+    @property
+    def running(self):
+        return self._running
+
+    def time(self):
+        """ Returns the loop's clock, in seconds."""
+        return util.monotonic_time()
+
+    def call_soon(self, callback, *args):
+        """
+        Schedules callback(*args) to run in this iteration of the loop, after the callbacks already scheduled.
+
+        Returns:
+            Handle that can cancel the call.
+        """
+        handle = Handle(None, callback, args)
+        self._ready.append(handle)
+        return handle
+
+    def call_later(self, delay, callback, *args):
+        """
+        Schedules callback(*args) to run once delay seconds have passed.
+
+        Returns:
+            Handle that can cancel the call.
+        """
+        handle = Handle(self.time() + delay, callback, args)
+        heapq.heappush(self._timers, (handle.when, next(self._sequence), handle))
+        return handle
+
+    def add_io_callback(self, callback):
+        """ Registers callback() to run after every poll() that dispatched socket events, e.g. PynamoServer.process."""
+        self._io_callbacks.append(callback)
+
+    def remove_io_callback(self, callback):
+        self._io_callbacks.remove(callback)
+
+    def run_forever(self):
+        """ Runs iterations of the loop until stop() is called."""
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        """ Stops run_forever after the current iteration."""
+        self._running = False
+
+    def run_once(self):
+        """
+        Runs a single iteration of the loop.
+
+        Returns:
+            the number of socket events dispatched.
+        """
+        self._metrics['iterations'] += 1
+
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = min(max(0, self._timers[0][0] - self.time()), self._max_wait)
+        else:
+            timeout = self._max_wait
+
+        num_events = self._poll(timeout)
+        if num_events:
+            self._metrics['io_events'] += num_events
+            for callback in list(self._io_callbacks):
+                self._run(callback)
+
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            _, _, handle = heapq.heappop(self._timers)
+            self._ready.append(handle)
+
+        # callbacks scheduled by these run in the next iteration
+        for _ in xrange(len(self._ready)):
+            handle = self._ready.popleft()
+            if not handle.cancelled:
+                self._metrics['callbacks'] += 1
+                self._run(handle.callback, *handle.args)
+
+        return num_events
+
+    def _run(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            self.logger.error('_run.  {} raised {}'.format(callback, sys.exc_info()))
+
+    def _poll(self, timeout):
+        """
+        asyncore.poll that reports how many sockets had events.
+            -waits at most timeout seconds for an event on a channel in the socket map.
+        """
+        readers, writers = [], []
+        for fd, channel in self._map.items():
+            if channel.readable():
+                readers.append(fd)
+            if channel.writable() and not channel.accepting:
+                writers.append(fd)
+        try:
+            readers, writers, errors = select.select(readers, writers, readers + writers, timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return 0
+        for fd in readers:
+            channel = self._map.get(fd)
+            if channel is not None:
+                asyncore.read(channel)
+        for fd in writers:
+            channel = self._map.get(fd)
+            if channel is not None:
+                asyncore.write(channel)
+        for fd in errors:
+            channel = self._map.get(fd)
+            if channel is not None:
+                asyncore._exception(channel)
+        return len(readers) + len(writers) + len(errors)
@@ -1,9 +1,13 @@
-import asynchat
 import asyncore
+import collections
 import logging
 import util
 import socket
-import json
+
+from wire_protocol import MessageChannel
+
+# seconds a channel is kept open after its last reply
+CHANNEL_IDLE_TIMEOUT = 30
 
 class ExternalRequestStage(asyncore.dispatcher):
     """
@@ -42,8 +46,10 @@ class ExternalRequestStage(asyncore.dispatcher):
         self._server = server
         self._hostname = hostname
         self._external_port = int(external_port)
-        self._channels = []
-        self._coordinators = []
+        # open channels; each removes itself when closed
+        self._channels = set()
+        # channels with replies to send, flushed by the next process()
+        self._ready_channels = collections.deque()
         self._processor = self._request_handler()
 
     def handle_accept(self):
@@ -54,7 +60,7 @@ class ExternalRequestStage(asyncore.dispatcher):
         sock, client_address = self.accept()
         if self._server.is_accepting_external_requests:
             external_channel = ExternalChannel(server=self._server, sock=sock)
-            self._channels.append(external_channel)
+            self._channels.add(external_channel)
             self.logger.info('handle_accept.  accepting connection from: {}'.format(client_address))
         else:
             self.logger.debug('handle_accept.  external shutdown flag: {}.  closing connection.'.format(self_server._external_shutdown_flag))
@@ -66,7 +72,7 @@ class ExternalRequestStage(asyncore.dispatcher):
             -closes each asynchat channel and then closes self.
         """
         self.logger.debug('handle_close')
-        for channel in self._channels:
+        for channel in list(self._channels):
             channel.close_when_done()
         self.close()
         self.logger.info('handle_close.  channels and self closed')
@@ -78,10 +84,18 @@ class ExternalRequestStage(asyncore.dispatcher):
         self.logger.debug('process')
         return self._processor.next()
 
+    def schedule(self, channel):
+        """
+        Queues channel to send its completed replies on the next process().
+        """
+        if not channel._scheduled:
+            channel._scheduled = True
+            self._ready_channels.append(channel)
+
     @util.coroutine
     def _request_handler(self):
         """
-        Coroutine that cycles through self._channels and processes each one in turn.
+        Coroutine that processes the channels with replies ready.
         """
 
         yield   # do nothing when first called
@@ -93,12 +107,10 @@ class ExternalRequestStage(asyncore.dispatcher):
                     self.handle_close()
                     yield False
 
-            to_be_removed = []
-            for channel in self._channels:
-                if channel.process():
-                    to_be_removed.append(channel)
-
-            # implement channel removal here
+            while self._ready_channels:
+                channel = self._ready_channels.popleft()
+                channel._scheduled = False
+                channel.process()
 
             yield True
 
@@ -109,9 +121,11 @@ class ExternalRequestStage(asyncore.dispatcher):
         self.logger.debug('_immediate_shutdown')
         self.handle_close()
 
-class ExternalChannel(asynchat.async_chat):
+class ExternalChannel(MessageChannel):
     """
     asyncore channel that handles external communication with a client.
+        -replies in the framing the client uses: binary frames, or JSON messages followed by the server's terminator.
+        -closed once CHANNEL_IDLE_TIMEOUT seconds pass after its last reply, by a timer on the server's timer wheel.
     """
     def __init__(self, server=None, sock=None):
         """
@@ -127,44 +141,18 @@ class ExternalChannel(asynchat.async_chat):
 
         # internal variables
         self._server = server
-        self._coordinators = list()
-        self._timeout = None
+        # coordinators of requests without a request_id, replied to in the order they arrived
+        self._coordinators = collections.deque()
+        # coordinators of requests with a request_id whose replies are ready
+        self._completed_coordinators = []
+        # True while queued in ExternalRequestStage's ready queue
+        self._scheduled = False
+        # time of the last reply, and the Timer that checks it for the idle timeout
+        self._last_reply_time = None
+        self._idle_timer = None
 
         # async_chat
-        asynchat.async_chat.__init__(self, sock)
-        self._read_buffer = list()
-        self.set_terminator(self._server.terminator)
-
-    def collect_incoming_data(self, data):
-         """
-        Implements asynchat.async_chat's collect_incoming_data method.
-            -appends data to internal read buffer.
-
-        Args:
-        ----------
-        data : str
-            incoming data read by the async_chat channel.
-        """
-        self.logger.debug('collect_incoming_data')
-        self.logger.debug('collect_incoming_data.  node_hash: {}'.format(self._server.node_hash))
-        self.logger.debug('collect_incoming_data.  collected data: {}'.format(data))
-        self._read_buffer.append(data)
-
-    def found_terminator(self):
-        """
-        Implements asynchat.async_chat's found_terminator method.
-            - handler for when message's terminator is found.
-            - the message is converted into a json object, the read buffer flushed, and the message passed to a message handler.
-
-        Args:
-        ----------
-        data : str
-            incoming data read by the async_chat channel.
-        """
-        request = json.loads(''.join(self._read_buffer))
-        self.logger.debug('found_terminator.  request: {}'.format(request))
-        self._read_buffer = []
-        self._process_message(request)
+        MessageChannel.__init__(self, sock, terminator=self._server.terminator)
 
     def _process_message(self, request):
         """
@@ -179,15 +167,23 @@ class ExternalChannel(asynchat.async_chat):
         self.logger.debug('_request_handler.')
 
         request['type'] = 'external request'
-        request['timestamp'] = util.current_time()
+        request['timestamp'] = self._server.clock.now()
 
-        try
-            request['key'] = util.get_hash(request['key'])
+        key_hash = self._server.partitioner.key_hash
+        try:
+            request['key'] = key_hash(request['key'])
         except:
             pass
 
-        coordinator = ExternalRequestCoordinator(server=self._server, request=request)
-        self._coordinators.append(coordinator)
+        # batch commands
+        if 'keys' in request:
+            request['keys'] = [key_hash(key) for key in request['keys']]
+        if 'items' in request:
+            request['items'] = [[key_hash(key), value] for key, value in request['items']]
+
+        coordinator = ExternalRequestCoordinator(server=self._server, request=request, channel=self)
+        if coordinator.request_id is None:
+            self._coordinators.append(coordinator)
 
         self.logger.debug('_request_handler. coordinator appended: {}'.format(coordinator))
 
@@ -197,33 +193,57 @@ class ExternalChannel(asynchat.async_chat):
         """
         self.logger.debug('_send_message.')
         self.logger.debug('_send_message.  message {}'.format(message))
-        self.push(util.pack_message(message, self._server._terminator))
+        self.push(self.pack_message(message))
 
-        # set timeout to be 30 seconds after last request received
-        self._timeout = util.add_time(util.current_time(), 30)
+        # the timer isn't moved on every reply; once due, it checks the time of the last one
+        self._last_reply_time = self._server.timer_wheel.time()
+        if not self._idle_timer:
+            self._idle_timer = self._server.timer_wheel.schedule(CHANNEL_IDLE_TIMEOUT, self._handle_idle_timeout)
 
-    def process(self):
+    def _handle_idle_timeout(self):
         """
-        Processes request queue and returns replies in the correct order when they are ready.
+        Closes the channel once CHANNEL_IDLE_TIMEOUT seconds have passed since its last reply.
         """
-
-        self.logger.debug('process')
-        # if timeout has been set and it's past the time
-        if self._timeout and (util.current_time() > self._timeout):
+        idle_time = self._server.timer_wheel.time() - self._last_reply_time
+        if idle_time >= CHANNEL_IDLE_TIMEOUT:
+            self._idle_timer = None
             self.close_when_done()
-            pass
+        else:
+            self._idle_timer = self._server.timer_wheel.schedule(CHANNEL_IDLE_TIMEOUT - idle_time, self._handle_idle_timeout)
 
-        # process requests
-        for coordinator in self._coordinators:
-            coordinator.process()
+    def handle_close(self):
+        """
+        Implements asyncore.dispatcher's handle_close method.
+            -cancels the idle timer and removes self from the stage's channels.
+        """
+        self.logger.debug('handle_close')
+        if self._idle_timer:
+            self._idle_timer.cancel()
+            self._idle_timer = None
+        self._server.external_request_stage._channels.discard(self)
+        self.close()
 
-        # send replies if ready
-        for index, coordinator in enumerate(self._coordinators):
-            if coordinator.completed:
-                self._send_message(coordinator._reply)
-                self._coordinators.pop(0)
-            else:
-                break
+    def handle_completion(self, coordinator):
+        """
+        Called by an ExternalRequestCoordinator of this channel once its reply is ready; schedules the channel.
+        """
+        if coordinator.request_id is not None:
+            self._completed_coordinators.append(coordinator)
+        self._server.external_request_stage.schedule(self)
+
+    def process(self):
+        """
+        Sends the replies that are ready.
+            -replies to requests carrying a request_id are sent as soon as they complete; the client matches them by id.
+            -replies to requests without one are sent in the order the requests arrived.
+        """
+        self.logger.debug('process')
+        completed_coordinators, self._completed_coordinators = self._completed_coordinators, []
+        for coordinator in completed_coordinators:
+            self._send_message(coordinator.reply)
+
+        while self._coordinators and self._coordinators[0].completed:
+            self._send_message(self._coordinators.popleft().reply)
 
 class ExternalRequestCoordinator(object):
     """
@@ -232,7 +252,7 @@ class ExternalRequestCoordinator(object):
     Instructs InternalRequestStage to handle request and listens for a reply, which it then forwards back to the client.
     """
 
-    def __init__(self, server=None, request=None):
+    def __init__(self, server=None, request=None, channel=None):
         """
         Args:
         ----------
@@ -240,12 +260,16 @@ class ExternalRequestCoordinator(object):
             object through which internal stages can be accessed.
         request : json
             request message.
+        channel : ExternalChannel, optional
+            channel the request arrived on, told through handle_completion once the reply is ready.
         """
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.debug('__init__')
 
         self._server = server
+        self._channel = channel
         self._reply = None
+        self._request_id = request.get('request_id')
 
         self._reply_listener = self._reply_listener()
         self._processor = self._request_handler(request)
@@ -262,6 +286,14 @@ class ExternalRequestCoordinator(object):
     def reply(self):
         return self._reply
 
+    @property
+    def request_id(self):
+        """
+        Returns:
+            the id the client tagged the request with, None if it relies on replies arriving in order.
+        """
+        return self._request_id
+
     def process(self):
         """
         Steps processor through next cycle.
@@ -290,8 +322,14 @@ class ExternalRequestCoordinator(object):
         Coroutine for listening to the reply of a request.
         """
         self.logger.debug('_reply_listener')
-        self._reply = (yield)
+        reply = (yield)
+        if self._request_id is not None:
+            reply['request_id'] = self._request_id
+        reply['ring_version'] = self._server.membership_stage.ring_version
+        self._reply = reply
         self.logger.debug('_reply_listener.  reply received: {}'.format(self._reply))
+        if self._channel:
+            self._channel.handle_completion(self)
         yield True
 
 
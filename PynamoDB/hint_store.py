@@ -0,0 +1,100 @@
+"""
+    hint_store.py
+    ~~~~~~~~~~~~
+    Implements HintStore, which holds writes accepted on behalf of unreachable replicas until they can be handed off.
+"""
+
+import collections
+import logging
+
+from persistence_engine import PersistenceEngine
+
+NODE_HASH_LENGTH = 64
+# sorts after every key hash, binary or hex, so (node_hash, node_hash + HIGH_SUFFIX] covers every key prefixed by node_hash
+HIGH_SUFFIX = '\xff' * 65
+
+
+class HintStore(object):
+    """
+    Hinted handoff store layered over a persistence engine kept apart from the node's own data.
+    ----------
+        -each hint is stored under node_hash + key, so the hints for one intended owner are a single range scan.
+        -a hint's value is [command, value]; only the newest hint per (owner, key) is kept.
+        -hints are durable if the engine is, e.g. a LogPersistenceEngine in its own directory.
+    """
+
+    def __init__(self, persistence_engine=None):
+        """
+        Args:
+        ----------
+        persistence_engine (object implementing put/get/delete/keys/iter_items, optional):
+            storage for the hints, defaults to the in-memory PersistenceEngine.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        if persistence_engine is None:
+            persistence_engine = PersistenceEngine()
+        self._persistence_engine = persistence_engine
+
+        # node_hash -> number of hints held for it
+        self._counts = collections.Counter(key[:NODE_HASH_LENGTH] for key in persistence_engine.keys())
+
+    def __len__(self):
+        return sum(self._counts.values())
+
+    @property
+    def node_hashes(self):
+        """ Returns the node hashes hints are held for."""
+        return [node_hash for node_hash, count in self._counts.items() if count]
+
+    def add(self, node_hash, key, command, value, timestamp):
+        """
+        Stores a put or delete of key meant for node_hash, unless a newer hint for the same key is already held.
+
+        Returns:
+            True if the hint was stored, False if it was superseded.
+        """
+        hint_key = node_hash + key
+        try:
+            _, old_timestamp = self._persistence_engine.get(hint_key)
+        except KeyError:
+            self._counts[node_hash] += 1
+        else:
+            if timestamp <= old_timestamp:
+                return False
+        self._persistence_engine.put(hint_key, [command, value], timestamp)
+        return True
+
+    def iter_hints(self, node_hash):
+        """
+        Lazily yields (key, value, timestamp, command) for every hint held for node_hash, in key order.
+        """
+        for hint_key, (command, value), timestamp in self._persistence_engine.iter_items(node_hash, node_hash + HIGH_SUFFIX):
+            yield hint_key[NODE_HASH_LENGTH:], value, timestamp, command
+
+    def remove(self, node_hash, key, timestamp):
+        """
+        Removes the hint for key meant for node_hash if it still holds the version with timestamp, i.e. once it has been
+        handed off and no newer hint arrived in the meantime.
+        """
+        hint_key = node_hash + key
+        try:
+            _, stored_timestamp = self._persistence_engine.get(hint_key)
+        except KeyError:
+            return False
+        if stored_timestamp != timestamp:
+            return False
+        self._persistence_engine.delete(hint_key)
+        self._counts[node_hash] -= 1
+        return True
+
+    def discard(self, node_hash):
+        """ Drops every hint held for node_hash, e.g. once it has left the ring."""
+        for key, _, timestamp, _ in list(self.iter_hints(node_hash)):
+            self.remove(node_hash, key, timestamp)
+        del self._counts[node_hash]
+
+    def process(self):
+        """ Gives the hint engine a slice of time for background work such as compaction."""
+        return self._persistence_engine.process()
@@ -0,0 +1,77 @@
+"""
+    hybrid_logical_clock.py
+    ~~~~~~~~~~~~
+    Implements HybridLogicalClock, which stamps the versions a server writes with 64-bit integer timestamps that follow
+    the wall clock but never go backwards, and that order after every timestamp the server has seen from its peers.
+"""
+
+import logging
+import time
+
+import util
+
+
+class HybridLogicalClock(object):
+    """
+    Hybrid logical clock over util timestamps: milliseconds of wall clock time above util.LOGICAL_BITS bits of counter.
+    ----------
+        -now() returns the wall clock if it is ahead of every timestamp returned or observed so far, otherwise the
+         latest of those plus one, i.e. the counter breaks ties within a millisecond and while the wall clock is behind.
+        -update() observes a timestamp carried by a message from another node, so later versions order after it.
+         timestamps further than max_offset seconds ahead of the wall clock are ignored, so one node's runaway clock
+         can't drag the others along.
+    """
+
+    def __init__(self, max_offset=0.5, clock=time.time):
+        """
+        Args:
+        ----------
+        max_offset (float, optional):
+            seconds an observed timestamp may be ahead of the wall clock, defaults to 0.5.
+        clock (function, optional):
+            returns the wall clock in seconds since the epoch, defaults to time.time.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        self._clock = clock
+        self._max_offset = util.add_time(0, max_offset)
+        self._last = 0
+
+        self._metrics = {
+            'observed': 0,
+            'rejected': 0
+        }
+
+    @property
+    def metrics(self):
+        return dict(self._metrics)
+
+    def now(self):
+        """
+        Returns:
+            a timestamp greater than every timestamp returned by, or passed to, self so far.
+        """
+        wall = util.timestamp_from_seconds(self._clock())
+        if wall > self._last:
+            self._last = wall
+        else:
+            self._last += 1
+        return self._last
+
+    def update(self, timestamp):
+        """
+        Observes timestamp from another node.
+
+        Returns:
+            False if timestamp was ignored for being more than max_offset ahead of the wall clock, True otherwise.
+        """
+        if timestamp <= self._last:
+            return True
+        if timestamp - util.timestamp_from_seconds(self._clock()) > self._max_offset:
+            self._metrics['rejected'] += 1
+            self.logger.error('update.  ignoring timestamp {} ahead of the wall clock by more than max_offset'.format(util.to_datetime(timestamp)))
+            return False
+        self._metrics['observed'] += 1
+        self._last = timestamp
+        return True
@@ -1,12 +1,26 @@
-import asynchat
 import asyncore
 import logging
 import util
+import partitioner as partitioners
 import json
 import socket
 import collections
+import itertools
 import random
 import sys
+import uuid
+
+import vector_clock
+from wire_protocol import MessageChannel, FRAMING_BINARY
+
+# error code of the reply an outgoing InternalChannel hands its listener when the node can't be reached
+UNREACHABLE_ERROR_CODE = '\x10'
+# error codes of replies that don't count towards a read or write quorum
+FAILED_ERROR_CODES = ('\x06', UNREACHABLE_ERROR_CODE)
+# multi-key commands, each applying the single-key command after the prefix to every key
+BATCH_COMMANDS = ('batch_put', 'batch_get', 'batch_delete')
+# seconds a coordinator waits for a peer's reply before retrying the request
+REQUEST_TIMEOUT = 2.0
 
 class InternalRequestStage(asyncore.dispatcher):
     """
@@ -14,7 +28,7 @@ class InternalRequestStage(asyncore.dispatcher):
     ----------
     """
 
-    def __init__(self, server=None, internal_port=None, hostname="0.0.0.0"):
+    def __init__(self, server=None, internal_port=None, hostname="0.0.0.0", pool_size=2):
         """
         Parameters
         ----------
@@ -24,6 +38,8 @@ class InternalRequestStage(asyncore.dispatcher):
             port on which server will be listening for internal communications.
         hostname : str
             public dns name through which server will be contacted.
+        pool_size : int, optional
+            number of long-lived connections kept open to each peer for request/reply traffic, defaults to 2.
         """
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.debug('__init__')
@@ -31,8 +47,21 @@ class InternalRequestStage(asyncore.dispatcher):
         self._server = server
         self._hostname = hostname
         self._internal_port = internal_port
-        self._coordinators = []
+        self._coordinators = set()
+        # coordinators with events to handle, stepped by the next process()
+        self._ready_coordinators = collections.deque()
         self._channels = []
+        self._pool_size = pool_size
+        # node_hash -> list of PooledInternalChannels connected to it
+        self._pools = collections.defaultdict(list)
+        self._metrics = {
+            'read_repairs': 0,
+            'hinted_writes': 0,
+            'hints_replayed': 0,
+            'retries': 0
+        }
+        # node hashes whose hints are being handed off
+        self._hint_replay_node_hashes = set()
 
         # socket stuff
         asyncore.dispatcher.__init__(self)
@@ -47,6 +76,14 @@ class InternalRequestStage(asyncore.dispatcher):
 
         self.logger.debug('__init__ complete')
 
+    @property
+    def metrics(self):
+        """
+        Returns:
+            dict of request counters, e.g. the number of replicas repaired on read and of hints handed off.
+        """
+        return dict(self._metrics)
+
     def handle_error(self):
         """
         Implements asyncore.dispatcher's handle_error method.
@@ -71,6 +108,9 @@ class InternalRequestStage(asyncore.dispatcher):
         self.logger.debug('handle_close')
         for channel in self._channels:
             channel.close_when_done()
+        for pool in self._pools.values():
+            for channel in pool:
+                channel.close_when_done()
         for coordinator in self._coordinators:
             for channel in coordinator._channels:
                 channel.close_when_done()
@@ -79,25 +119,62 @@ class InternalRequestStage(asyncore.dispatcher):
 
     def process(self):
         """
-        Steps processor coroutine through next cycle.
+        Steps the coordinators that are ready, i.e. were created, handed a reply or hit a deadline on the server's
+        timer wheel since they were last stepped.
         ----------
             -closes and removes finished InternalRequestCoordinators.
         """
         self.logger.debug('process')
-        to_be_removed = []
-        for coordinator in self._coordinators:
-            if coordinator.process():
-                to_be_removed.append(coordinator)
-        for coordinator in to_be_removed:
+        while self._ready_coordinators:
+            coordinator = self._ready_coordinators.popleft()
+            coordinator._scheduled = False
+            if coordinator in self._coordinators and coordinator.process():
+                self._remove_coordinator(coordinator)
+
+    def schedule(self, coordinator):
+        """
+        Queues coordinator to be stepped by the next process(), once however many events it has.
+        """
+        if not coordinator._scheduled:
+            coordinator._scheduled = True
+            self._ready_coordinators.append(coordinator)
+
+    def _add_coordinator(self, coordinator):
+        self._coordinators.add(coordinator)
+        self.schedule(coordinator)
+
+    def _remove_coordinator(self, coordinator):
+        coordinator._cancel_timers()
+        for channel in coordinator._channels:
             try:
-                for channel in coordinator._channels:
-                    try:
-                        channel.close_when_done()
-                    except:
-                        pass
-                self._coordinators.remove(coordinator)
+                channel.close_when_done()
             except:
                 pass
+        self._coordinators.discard(coordinator)
+
+    def send_request(self, node_hash=None, message=None, listener=None, coordinator=None, timeout=None, on_timeout=None):
+        """
+        Sends message to node_hash over a pooled connection and routes the reply to listener.
+            -requests are multiplexed by request id, so many may be in flight on one connection; the least busy
+             connection is used, and a new one is opened while the pool has fewer than pool_size.
+            -if the connection fails, listener is sent a reply with UNREACHABLE_ERROR_CODE.
+            -coordinator, if given, is scheduled whenever listener is sent a reply.
+            -if timeout seconds pass without a reply, the request is dropped, so a late reply is ignored, and
+             on_timeout() is called instead of listener.
+        """
+        pool = self._pools[node_hash]
+        if len(pool) < self._pool_size:
+            channel = PooledInternalChannel(server=self._server, node_hash=node_hash)
+            pool.append(channel)
+        else:
+            channel = min(pool, key=lambda channel: channel.num_pending)
+        channel.send_request(message, listener, coordinator, timeout, on_timeout)
+
+    def _remove_pooled_channel(self, channel):
+        """ Drops a failed or closed channel from its peer's pool so the next request opens a new one."""
+        pool = self._pools.get(channel._node_hash, [])
+        if channel in pool:
+            pool.remove(channel)
 
     def handle_internal_message(self, message=None, reply_listener=None, internal_channel=None):
         """
@@ -105,7 +182,7 @@ class InternalRequestStage(asyncore.dispatcher):
         """
         self.logger.debug('handle_internal_message.')
         coordinator = InternalRequestCoordinator(server=self._server, message=message, reply_listener=reply_listener, internal_channel=internal_channel)
-        self._coordinators.append(coordinator)
+        self._add_coordinator(coordinator)
         self.logger.debug('handle_internal_message. coordinator appended.')
 
     def handle_membership_check(self, gossip_node_hash=None):
@@ -115,7 +192,7 @@ class InternalRequestStage(asyncore.dispatcher):
         self.logger.debug('handle_membership_check')
         coordinator = InternalRequestCoordinator(server=self._server, timeout=1)
         coordinator._handle_membership_check(gossip_node_hash=gossip_node_hash)
-        self._coordinators.append(coordinator)
+        self._add_coordinator(coordinator)
 
     def handle_unannounced_failure(self, failure_node_hash=None):
         """
@@ -128,7 +205,30 @@ class InternalRequestStage(asyncore.dispatcher):
             coordinator._handle_unannounced_failure(failure_node_hash=failure_node_hash)
         except:
             pass
-        self._coordinators.append(coordinator)
+        self._add_coordinator(coordinator)
+
+    def handle_anti_entropy(self, node_hash=None, low=None, high=None):
+        """
+        Instantiates InternalRequestCoordinator for comparing the Merkle tree of hash range (low, high] with a replica peer.
+        """
+        self.logger.debug('handle_anti_entropy.  node_hash, range: {}, {}'.format(node_hash, (low, high)))
+        tree = self._server.persistence_stage.merkle_tree(low, high)
+        if tree:
+            coordinator = InternalRequestCoordinator(server=self._server)
+            coordinator._handle_anti_entropy(node_hash=node_hash, tree=tree)
+            self._add_coordinator(coordinator)
+
+    def handle_hint_replay(self, node_hash=None):
+        """
+        Instantiates InternalRequestCoordinator for handing off the hints held for node_hash, unless one is already running.
+        """
+        if node_hash in self._hint_replay_node_hashes:
+            return
+        self.logger.info('handle_hint_replay.  node_hash: {}'.format(node_hash))
+        self._hint_replay_node_hashes.add(node_hash)
+        coordinator = InternalRequestCoordinator(server=self._server)
+        coordinator._handle_hint_replay(node_hash=node_hash)
+        self._add_coordinator(coordinator)
 
     def _immediate_shutdown(self):
         """
@@ -136,9 +236,11 @@ class InternalRequestStage(asyncore.dispatcher):
         """
         self.handle_close()
 
-class InternalChannel(asynchat.async_chat):
+class InternalChannel(MessageChannel):
     """
     asyncore channel that handles internal communication with another node.
+        -outgoing channels send binary frames; incoming channels answer in whichever framing the sender uses.
+        -every message carries the sender's hybrid logical clock as 'hlc', which the receiver's clock observes.
     """
 
     def __init__(self, server=None, sock=None, client_address=None, node_hash=None, coordinator_listener=None):
@@ -147,18 +249,18 @@ class InternalChannel(asynchat.async_chat):
 
         self._server = server
         self._node_hash = node_hash
-        self._read_buffer = []
         self._coordinator_listener = coordinator_listener
-
-        self.set_terminator(self._server.terminator)
+        # InternalRequestCoordinator scheduled whenever the listener is handed a reply, set by its _add_channel
+        self._coordinator = None
+        self._failure_reported = False
 
         if sock:                # for incoming communication
             self._client_address = client_address
-            asynchat.async_chat.__init__(self, sock)
+            MessageChannel.__init__(self, sock, terminator=self._server.terminator)
 
         elif node_hash:     # for outgoing communication
             try:
-                asynchat.async_chat.__init__(self)
+                MessageChannel.__init__(self, framing=FRAMING_BINARY, terminator=self._server.terminator)
                 hostname, port = self._server.membership_stage.node_address(node_hash)
                 self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.connect((str(hostname), int(port)))
@@ -167,16 +269,6 @@ class InternalChannel(asynchat.async_chat):
 
         self.logger.debug('__init__ complete')
 
-    def collect_incoming_data(self, data):
-        self.logger.debug('collect_incoming_data')
-        self._read_buffer.append(data)
-
-    def found_terminator(self):
-        self.logger.debug('found_terminator')
-        message = json.loads(''.join(self._read_buffer))
-        self._read_buffer = []
-        self._process_message(message=message, internal_channel=self)
-
     def handle_error(self):
         self.logger.debug('handle_error')
         self.logger.debug('handle_error. {}'.format(sys.exc_info()))
@@ -184,13 +276,42 @@ class InternalChannel(asynchat.async_chat):
             self._server.membership_stage.report_contact_failure(node_hash=self._node_hash)
         except:
             pass
+        self._report_unreachable()
         self.close_when_done()
 
+    def _report_unreachable(self):
+        """
+        Hands the listener of an outgoing channel a synthetic reply with UNREACHABLE_ERROR_CODE, once, so its coordinator
+        doesn't wait forever for a node it couldn't reach.
+        """
+        if self._node_hash and self._coordinator_listener and not self._failure_reported:
+            self._failure_reported = True
+            reply = {
+                'type': 'reply',
+                'error_code': UNREACHABLE_ERROR_CODE,
+                'node_hash': self._node_hash
+            }
+            try:
+                self._coordinator_listener.send(reply)
+            except:
+                self.logger.error('_report_unreachable.  listener error: {}'.format(sys.exc_info()))
+            self._schedule_coordinator(self._coordinator)
+
+    def _schedule_coordinator(self, coordinator):
+        if coordinator:
+            self._server.internal_request_stage.schedule(coordinator)
+
     def _send_message(self, message):
         self.logger.debug('_send_message')
-        self.push(util.pack_message(message, self._server._terminator))
+        message['hlc'] = self._server.clock.now()
+        self.push(self.pack_message(message))
         self.logger.debug('_send_message.  message sent')
 
+    def _observe_clock(self, message):
+        hlc = message.pop('hlc', None)
+        if hlc:
+            self._server.clock.update(hlc)
+
     def _send_gossip(self, message, propagation_probability=0.5):
         self.logger.debug('_send_gossip')
         if random.random() > propagation_probability:
@@ -199,18 +320,252 @@ class InternalChannel(asynchat.async_chat):
     def _process_message(self, message=None, internal_channel=None):
         self.logger.debug('_process_message')
         self.logger.debug('_process_message.  node_hash: {}'.format(self._server.node_hash))
+        self._observe_clock(message)
 
         if message['type'] == 'reply':
             self.logger.debug('_process_message.  type: {}, sending reply to coordinator listener'.format(message['type']))
             self._coordinator_listener.send(message)
+            self._schedule_coordinator(self._coordinator)
         else:
             self.logger.debug('_process_message.  type: {} '.format(message['type']))
             self.logger.debug('_process_message.  calling handle_internal_message')
-            self._server.internal_request_stage.handle_internal_message(message=message, internal_channel=internal_channel)
+            self._server.internal_request_stage.handle_internal_message(message=message, internal_channel=internal_channel or self)
+
+class PooledInternalChannel(InternalChannel):
+    """
+    Long-lived outgoing InternalChannel shared by many requests to the same node.
+    ----------
+        -each request is tagged with a request id, which the receiving node copies into its reply and keeps the
+         connection open; replies are routed back to the listener registered under their id.
+        -if the connection fails or is closed, every request still in flight is answered with UNREACHABLE_ERROR_CODE.
+        -the coordinator a request was sent for, if any, is scheduled once its listener has the reply.
+        -a request sent with a timeout holds a timer on the server's timer wheel, cancelled when its reply arrives.
+    """
+
+    def __init__(self, server=None, node_hash=None):
+        InternalChannel.__init__(self, server=server, node_hash=node_hash)
+        self._request_ids = itertools.count()
+        # request_id -> (listener awaiting its reply, coordinator to schedule, Timer of its timeout or None)
+        self._listeners = dict()
+
+    @property
+    def num_pending(self):
+        """ Returns the number of requests awaiting a reply."""
+        return len(self._listeners)
+
+    def send_request(self, message, listener, coordinator=None, timeout=None, on_timeout=None):
+        request_id = next(self._request_ids)
+        timer = None
+        if timeout is not None:
+            timer = self._server.timer_wheel.schedule(timeout, self._handle_request_timeout, request_id, on_timeout)
+        self._listeners[request_id] = (listener, coordinator, timer)
+        try:
+            self._send_message(dict(message, request_id=request_id))
+        except:
+            self.handle_error()
+
+    def _process_message(self, message=None, internal_channel=None):
+        self.logger.debug('_process_message')
+        self._observe_clock(message)
+        try:
+            listener, coordinator, timer = self._listeners.pop(message['request_id'])
+        except KeyError:
+            self.logger.error('_process_message.  no request waiting for reply: {}'.format(message))
+            return
+        if timer:
+            timer.cancel()
+        listener.send(message)
+        self._schedule_coordinator(coordinator)
+
+    def _handle_request_timeout(self, request_id, on_timeout):
+        listener, coordinator, _ = self._listeners.pop(request_id)
+        self.logger.error('_handle_request_timeout.  no reply from {} to request {}'.format(self._node_hash, request_id))
+        if on_timeout:
+            on_timeout()
+        self._schedule_coordinator(coordinator)
+
+    def handle_close(self):
+        self.logger.debug('handle_close')
+        self._report_unreachable()
+        self.close()
+
+    def _report_unreachable(self):
+        self._server.internal_request_stage._remove_pooled_channel(self)
+        listeners, self._listeners = self._listeners, dict()
+        reply = {
+            'type': 'reply',
+            'error_code': UNREACHABLE_ERROR_CODE,
+            'node_hash': self._node_hash
+        }
+        for listener, coordinator, timer in listeners.values():
+            if timer:
+                timer.cancel()
+            try:
+                listener.send(dict(reply))
+            except:
+                self.logger.error('_report_unreachable.  listener error: {}'.format(sys.exc_info()))
+            self._schedule_coordinator(coordinator)
+
+class PartitionTransfer(object):
+    """
+    Streams key-value pairs to another node as a sequence of bounded 'partition chunk' messages over one InternalChannel.
+    ----------
+        -items are pulled lazily, so only the chunks in flight are ever held in memory.
+        -at most window chunks are unacknowledged at a time; each ack from the receiver lets the next chunk go out.
+        -a timer on the server's timer wheel fails the transfer if no ack arrives for timeout seconds.
+    """
+
+    def __init__(self, server=None, node_hash=None, items=None, max_chunk_items=1000, max_chunk_bytes=512 * 1024, window=4, timeout=30, completion_listener=None):
+        """
+        Args:
+        ----------
+        server : PynamoServer object.
+            object through which internal stages can be accessed.
+        node_hash : str
+            node receiving the partition.
+        items : iterable
+            (key, value, timestamp) tuples to transfer.  a fourth 'delete' element deletes key instead.
+        max_chunk_items, max_chunk_bytes : int, optional
+            bounds on the number of items and approximate payload size of a chunk, default to 1000 and 512KB.
+        window : int, optional
+            maximum number of unacknowledged chunks, defaults to 4.
+        timeout : int, optional
+            seconds without an acknowledgement after which the transfer is abandoned, defaults to 30.
+        completion_listener : coroutine, optional
+            sent True once every chunk has been acknowledged, False if the transfer failed.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        self._server = server
+        self._node_hash = node_hash
+        self._items = iter(items)
+        self._max_chunk_items = max_chunk_items
+        self._max_chunk_bytes = max_chunk_bytes
+        self._window = window
+        self._timeout_seconds = timeout
+        self._completion_listener = completion_listener
+
+        self._transfer_id = uuid.uuid4().hex
+        self._next_sequence = 0
+        self._in_flight = set()
+        self._exhausted = False
+        self._failed = False
+        self._num_items = 0
+        self._timer = self._server.timer_wheel.schedule(timeout, self._handle_timeout)
+
+        self.channel = InternalChannel(server=self._server, node_hash=node_hash, coordinator_listener=self._ack_listener())
+
+    @property
+    def complete(self):
+        """
+        Returns:
+            True once every chunk has been acknowledged, or the transfer has failed.
+        """
+        return self._failed or (self._exhausted and not self._in_flight)
+
+    @property
+    def failed(self):
+        return self._failed
+
+    @staticmethod
+    def _item_size(key, value, timestamp):
+        if isinstance(value, basestring):
+            value_size = len(value)
+        else:
+            value_size = len(json.dumps(value))
+        return len(key) + value_size + len(str(timestamp)) + 16
+
+    def _next_chunk(self):
+        chunk = []
+        chunk_bytes = 0
+        for item in self._items:
+            chunk.append(list(item))
+            chunk_bytes += self._item_size(*item[:3])
+            if len(chunk) >= self._max_chunk_items or chunk_bytes >= self._max_chunk_bytes:
+                return chunk
+        self._exhausted = True
+        return chunk
+
+    def process(self):
+        """
+        Sends chunks until the window is full.
+
+        Returns:
+            True if the transfer is complete, False otherwise.
+        """
+        if self.complete:
+            self._notify_completion()
+            return True
+
+        while not self._exhausted and len(self._in_flight) < self._window:
+            chunk = self._next_chunk()
+            message = {
+                'type': 'partition chunk',
+                'node_hash': self._server.node_hash,
+                'transfer_id': self._transfer_id,
+                'sequence': self._next_sequence,
+                'items': chunk,
+                'last': self._exhausted
+            }
+            self.channel._send_message(message)
+            self._in_flight.add(self._next_sequence)
+            self._next_sequence += 1
+            self._num_items += len(chunk)
+
+        if self.complete:
+            self._notify_completion()
+        return self.complete
+
+    def _handle_timeout(self):
+        if not self.complete:
+            self.logger.error('_handle_timeout.  transfer {} to {} timed out after {} items'.format(self._transfer_id, self._node_hash, self._num_items))
+            self._failed = True
+            self.channel._schedule_coordinator(self.channel._coordinator)
+
+    def _notify_completion(self):
+        self._timer.cancel()
+        if self._completion_listener:
+            completion_listener, self._completion_listener = self._completion_listener, None
+            completion_listener.send(not self._failed)
+
+    @util.coroutine
+    def _ack_listener(self):
+        while True:
+            reply = (yield)
+            if reply['error_code'] == '\x00':
+                self._in_flight.discard(reply['sequence'])
+                self._timer.cancel()
+                self._timer = self._server.timer_wheel.schedule(self._timeout_seconds, self._handle_timeout)
+            else:
+                self.logger.error('_ack_listener.  chunk {} of transfer {} rejected by {}'.format(reply.get('sequence'), self._transfer_id, self._node_hash))
+                self._failed = True
+            if self.complete:
+                self.logger.info('_ack_listener.  transfer {} to {} complete, {} items'.format(self._transfer_id, self._node_hash, self._num_items))
+
 
 class InternalRequestCoordinator(object):
 
-    def __init__(self, server=None, message=None, reply_listener=None, internal_channel=None, timeout=1000000, max_retries=3):
+    def __init__(self, server=None, message=None, reply_listener=None, internal_channel=None, timeout=None, max_retries=3, request_timeout=REQUEST_TIMEOUT):
+        """
+        Args:
+        ----------
+        server : PynamoServer object.
+            object through which internal stages can be accessed.
+        message : dict, optional
+            request to coordinate.
+        reply_listener : coroutine, optional
+            sent the reply to an external request.
+        internal_channel : InternalChannel, optional
+            channel an internal request arrived on, and its reply is sent on.
+        timeout : float, optional
+            seconds after which the coordinator gives up and completes, defaults to None, i.e. never.
+        max_retries : int, optional
+            times a request to a peer is resent after going unanswered before the peer is reported unreachable,
+            defaults to 3.
+        request_timeout : float, optional
+            seconds to wait for a peer's reply before retrying, defaults to REQUEST_TIMEOUT.
+        """
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.debug('__init__')
         self.logger.debug('__init__.  node_hash: {}'.format(server.node_hash))
@@ -222,12 +577,21 @@ class InternalRequestCoordinator(object):
 
         # for communications
         self._complete = False
+        # True while queued in InternalRequestStage's ready queue
+        self._scheduled = False
 
         self._replies = dict()
         self._channels = list()
+        self._transfers = list()
+        # handoff node_hash, or id of a hinted batch, -> replica its hinted write is meant for
+        self._hints = dict()
 
         # for timeouts
-        self._timeout = util.add_time(util.current_time(), timeout)
+        self._timed_out = False
+        self._expiry_timer = None
+        if timeout is not None:
+            self._expiry_timer = self._server.timer_wheel.schedule(timeout, self._handle_expiry)
+        self._request_timeout = request_timeout
         self._retries = dict()
         self._max_retries = max_retries
         self._outgoing_message = None
@@ -245,25 +609,45 @@ class InternalRequestCoordinator(object):
         """
         return self._processor.next()
 
+    def _add_channel(self, channel):
+        """
+        Keeps channel until self completes, and has replies arriving on it schedule self.
+        """
+        channel._coordinator = self
+        self._channels.append(channel)
+
+    def _handle_expiry(self):
+        if not self._complete:
+            self.logger.debug('_handle_expiry.  message: {}'.format(self._message))
+            self._timed_out = True
+            self._complete = True
+            self._server.internal_request_stage.schedule(self)
+
+    def _cancel_timers(self):
+        if self._expiry_timer:
+            self._expiry_timer.cancel()
+        for transfer in self._transfers:
+            transfer._timer.cancel()
+
     @property
     def timed_out(self):
         """
         Returns:
         ----------
-            True if self has timed out i.e. current time is past the set timeout time.
+            True if self gave up on its request after its timeout.
             False otherwise.
         """
-        return util.current_time() > self._timeout
+        return self._timed_out
 
     @property
     def complete(self):
         """
         Returns:
         ----------
-            True if the request the coordinator is responsible for has completed.
+            True if the request the coordinator is responsible for has completed, including any partition transfers.
             False otherwise.
         """
-        return self._complete
+        return self._complete and not self._transfers
 
     @util.coroutine
     def _listener(self, num_replies):
@@ -280,6 +664,41 @@ class InternalRequestCoordinator(object):
         while True:
             yield True
 
+    @util.coroutine
+    def _quorum_listener(self, num_replies, quorum):
+        """
+        Listener for external put/get/delete requests.
+            -answers the client as soon as quorum replicas have replied successfully, then keeps absorbing the remaining
+             replies so read repair sees every replica's version.
+            -if fewer than quorum replicas succeed, the client is answered once every reply is in.
+            -a put/delete a replica couldn't be reached for is handed to the next healthy node along with a hint naming
+             that replica, and the hinted write counts towards the quorum (sloppy quorum).
+        """
+        self.logger.debug('_quorum_listener.  num_replies, quorum: {}, {}'.format(num_replies, quorum))
+        replied = False
+
+        while num_replies:
+            reply = (yield)
+            num_replies -= 1
+            self._replies[reply['node_hash']] = reply
+            if reply['error_code'] == UNREACHABLE_ERROR_CODE and self._message['command'] in ['put', 'delete']:
+                if self._handle_hinted_handoff(reply['node_hash']):
+                    num_replies += 1
+            successful_replies = {node_hash: reply for node_hash, reply in self._replies.items() if reply and reply['error_code'] not in FAILED_ERROR_CODES}
+            if not replied and len(successful_replies) >= quorum:
+                self._send_client_reply(self._message['command'], successful_replies)
+                replied = True
+
+        self.logger.debug('_quorum_listener.  all replies received: {}'.format(self._replies))
+        if not replied:
+            self._send_client_reply(self._message['command'], self._replies)
+        if self._message['command'] == 'get':
+            self._handle_read_repair({self._message['key']: self._replies})
+        self._complete = True
+
+        while True:
+            yield True
+
     @util.coroutine
     def _request_handler(self, message=None, reply_listener=None, internal_channel=None):
         self.logger.debug('_request_handler')
@@ -287,11 +706,18 @@ class InternalRequestCoordinator(object):
         if not message:
             pass
         elif message['type'] == 'external request':
-            if message['command'] in ['put', 'get', 'delete']:
+            if not self._version_values(message):
+                reply_listener.send({'error_code': '\x06', 'info': 'invalid context'})
+                self._complete = True
+
+            elif message['command'] in ['put', 'get', 'delete']:
                 self.logger.debug('_request_handler.  handling external {} command'.format(message['command']))
 
                 responsible_node_hashes = self._server.membership_stage.get_responsible_node_hashes(message['key'])
-                self.logger.debug('_request_handler.  key, node_hashes: {}, {}'.format(message['key'], responsible_node_hashes))
+                self.logger.debug('_request_handler.  key, node_hashes: {}, {}'.format(util.to_hex(message['key']), responsible_node_hashes))
+
+                quorum = self._quorum(message, len(responsible_node_hashes))
+                self._coordinator_listener = self._quorum_listener(len(responsible_node_hashes), quorum)
 
                 for node_hash in responsible_node_hashes:
                     self._replies[node_hash] = None
@@ -304,6 +730,22 @@ class InternalRequestCoordinator(object):
                         message['type'] = 'internal request'
                         self._handle_request_remotely(message, node_hash)
 
+            elif message['command'] in BATCH_COMMANDS:
+                self.logger.debug('_request_handler.  handling external {} command'.format(message['command']))
+                self._handle_batch_request(message)
+
+            elif message['command'] == 'ring':
+                reply = {
+                    'error_code': '\x00',
+                    'nodes': self._server.membership_stage.ring_addresses(),
+                    'num_replicas': self._server.num_replicas,
+                    'vnodes': self._server.membership_stage.vnodes,
+                    'weights': self._server.membership_stage.node_weights,
+                    'partitioner': self._server.partitioner.name
+                }
+                reply_listener.send(reply)
+                self._complete = True
+
             elif message['command'] == 'shutdown':
                 reply = {'error_code': '\x00'}
                 reply_listener.send(reply)
@@ -314,8 +756,8 @@ class InternalRequestCoordinator(object):
         elif message['type'] == 'internal request':
             self.logger.debug('_request_handler.  handling internal {} command'.format(message['command']))
             reply = self._handle_request_locally(request=message)
-            internal_channel._send_message(reply)
-            internal_channel.close_when_done()
+            self._send_reply(internal_channel, message, reply)
+            self._complete = True
 
         elif message['type'] == 'reply':
             self._coordinator_listener.send(message)
@@ -330,24 +772,100 @@ class InternalRequestCoordinator(object):
             internal_channel._send_message(reply)
             internal_channel.close_when_done()
 
+        elif message['type'] == 'partition chunk':
+            reply = self._handle_partition_chunk(message)
+            internal_channel._send_message(reply)
+            self._complete = True
+
+        elif message['type'] == 'anti entropy':
+            reply = self._handle_anti_entropy_message(message)
+            internal_channel._send_message(reply)
+            self._complete = True
+
         elif message['type'] == 'gossip':
             self._handle_gossip(message)
 
         elif message['type'] == 'membership':
             reply = self._handle_membership_message(message)
-            internal_channel._send_message(reply)
-            internal_channel.close_when_done()
+            self._send_reply(internal_channel, message, reply)
+            self._complete = True
 
         while True:
             try:
-                # if self.timed_out and not self.complete:
-                #     self._handle_timeout()
-                #     yield self.complete
-                # else:
-                    yield self.complete
+                if self._transfers:
+                    self._transfers = [transfer for transfer in self._transfers if not transfer.process()]
+                yield self.complete
             except:
                 pass
 
+    def _version_values(self, message):
+        """
+        On servers with vector clocks, replaces the value of an external put, or each value of a batch_put, with the
+        version to store: one superseding the versions its 'context' token was read from, if given.
+
+        Returns:
+            False if the request's context token is invalid, True otherwise.
+        """
+        if not self._server.vector_clocks:
+            return True
+        actor = vector_clock.actor(self._server.node_hash)
+        try:
+            if message['command'] == 'put':
+                message['value'] = vector_clock.new_version(message['value'], message.pop('context', None), actor, message['timestamp'])
+            elif message['command'] == 'batch_put':
+                message['items'] = [[key, vector_clock.new_version(value, None, actor, message['timestamp'])] for key, value in message['items']]
+        except ValueError:
+            return False
+        return True
+
+    def _handle_hinted_handoff(self, node_hash):
+        """
+        Sends the coordinator's put/delete to the next healthy node on the ring that hasn't been tried yet, with a hint
+        naming the replica the write was meant for.  if node_hash was itself holding a hint, the hint is passed on.
+
+        Returns:
+            True if the write was handed off, False if no node is left to hand it to.
+        """
+        exclude = set(self._replies.keys())
+        exclude.add(self._server.node_hash)
+        handoff_node_hash = self._server.membership_stage.get_handoff_node_hash(self._message['key'], exclude=exclude)
+        if not handoff_node_hash:
+            self.logger.error('_handle_hinted_handoff.  no node left to hold the hint for {}'.format(node_hash))
+            return False
+
+        hint = self._hints.get(node_hash, node_hash)
+        self.logger.info('_handle_hinted_handoff.  handing write meant for {} to {}'.format(hint, handoff_node_hash))
+        self._hints[handoff_node_hash] = hint
+        self._replies[handoff_node_hash] = None
+        self._retries[handoff_node_hash] = 0
+        self._server.internal_request_stage._metrics['hinted_writes'] += 1
+        self._handle_request_remotely(dict(self._message, type='internal request', hint=hint), handoff_node_hash)
+        return True
+
+    def _quorum(self, message, num_replicas):
+        """
+        Returns:
+            number of successful replies needed before answering the client: the request's 'r' (get) or 'w' (put/delete)
+            field if given, the server's read or write quorum otherwise, capped at num_replicas.
+        """
+        if message['command'] in ['get', 'batch_get']:
+            quorum = message.get('r') or self._server.read_quorum
+        else:
+            quorum = message.get('w') or self._server.write_quorum
+        return max(1, min(int(quorum), num_replicas))
+
+    def _send_reply(self, internal_channel, message, reply):
+        """
+        Replies to message on internal_channel.  requests sent over a pooled connection carry a request id, which is
+        echoed back and the connection kept open for the next request; other connections are closed once flushed.
+        """
+        if 'request_id' in message:
+            reply['request_id'] = message['request_id']
+            internal_channel._send_message(reply)
+        else:
+            internal_channel._send_message(reply)
+            internal_channel.close_when_done()
+
     def _process_replies(self, message, replies):
         """ Process replies when listener has received
                 If the request is get, return the most recent value and perform repairs if necessary.
@@ -360,22 +878,10 @@ class InternalRequestCoordinator(object):
             pass
 
         try:
-            if message['command'] in ['put', 'delete']:
-                replies = [reply['error_code'] for reply in replies.values()]
-                reply = {'error_code': max(set(replies), key=replies.count)}
-                if self._reply_listener:
-                    self._reply_listener.send(reply)
-
-            elif message['command'] == 'get':
-                replies = sorted(self._replies.values(), key=lambda reply: reply['timestamp'])
-                newest_reply = replies[0]
-                reply = {
-                    'error_code': newest_reply['error_code'],
-                    'value': newest_reply['value']
-                }
-                if self._reply_listener:
-                    self._reply_listener.send(reply)
-                # repair at read
+            if message['command'] in ['put', 'get', 'delete']:
+                self._send_client_reply(message['command'], replies)
+                if message['command'] == 'get':
+                    self._handle_read_repair({message['key']: replies})
             else:
                 reply = replies.values()[0]
                 self.logger.debug('_process_replies.  reply: {}'.format(reply))
@@ -400,30 +906,321 @@ class InternalRequestCoordinator(object):
 
         self._complete = True
 
+    @staticmethod
+    def _newest_reply(replies):
+        """
+        Returns:
+            the get reply holding the newest version, None if no replica found the key.  a tombstone, a \x01 reply with
+            the timestamp of the delete, counts as a version, and wins a tie with a value.
+        """
+        versioned_replies = [reply for reply in replies.values() if reply and reply.get('timestamp') is not None
+                             and reply['error_code'] in ('\x00', '\x01')]
+        if versioned_replies:
+            return max(versioned_replies, key=lambda reply: (reply['timestamp'], reply['error_code']))
+
+    @staticmethod
+    def _merged_versions(replies):
+        """
+        Returns:
+            the siblings among the versions found by the get replies, on servers with vector clocks.
+        """
+        return vector_clock.reconcile([version for reply in replies.values() if reply and reply['error_code'] == '\x00' for version in reply['value']])
+
+    def _client_reply(self, command, replies):
+        """
+        Returns:
+            the reply for the client from the replicas' replies: the newest value for get, the most common error code
+            for put/delete.  on servers with vector clocks, a get also returns the context token of the versions found
+            and, if there are concurrent ones, their values as 'siblings'.
+        """
+        if command == 'get':
+            newest_reply = self._newest_reply(replies) or replies.values()[0]
+            if self._server.vector_clocks and newest_reply['error_code'] == '\x00':
+                versions = self._merged_versions(replies)
+                reply = {
+                    'error_code': '\x00',
+                    'value': versions[-1][0],
+                    'context': vector_clock.encode_context(vector_clock.merge(clock for _, clock in versions))
+                }
+                if len(versions) > 1:
+                    reply['siblings'] = [value for value, _ in versions]
+                return reply
+            return {
+                'error_code': newest_reply['error_code'],
+                'value': newest_reply.get('value')
+            }
+        else:
+            error_codes = [reply['error_code'] for reply in replies.values()]
+            return {'error_code': max(set(error_codes), key=error_codes.count)}
+
+    def _send_client_reply(self, command, replies):
+        """
+        Answers the client from replies.
+        """
+        reply = self._client_reply(command, replies)
+        self.logger.debug('_send_client_reply.  reply: {}'.format(reply))
+        if self._reply_listener:
+            self._reply_listener.send(reply)
+
+    def _handle_read_repair(self, key_replies):
+        """
+        Pushes the newest version of each key in key_replies, a dict of key -> {node_hash: get reply}, to every replica
+        whose reply was stale or missing the key.
+            -if the newest version is a tombstone, the delete is pushed to the replicas still holding an older value,
+             and replicas missing the key are left alone, so a replica that missed a delete can't bring the key back.
+            -called after the client has been answered; remote replicas are repaired with a PartitionTransfer per node
+             stepped by the coordinator's processor, so the repair is acknowledged and times out like any transfer.
+        """
+        repairs = collections.defaultdict(list)
+        for key, replies in key_replies.items():
+            newest_reply = self._newest_reply(replies)
+            if not newest_reply:
+                continue
+
+            if newest_reply['error_code'] == '\x01':
+                item = (key, None, newest_reply['timestamp'], 'delete')
+            elif self._server.vector_clocks:
+                versions = self._merged_versions(replies)
+                item = (key, versions, vector_clock.latest_timestamp(versions))
+            else:
+                item = (key, newest_reply['value'], newest_reply['timestamp'])
+            for node_hash, reply in replies.items():
+                if newest_reply['error_code'] == '\x01':
+                    stale = reply['error_code'] == '\x00'
+                elif self._server.vector_clocks:
+                    stale = reply['error_code'] == '\x01' or (reply['error_code'] == '\x00' and reply['value'] != item[1])
+                else:
+                    stale = reply['error_code'] == '\x01' or (reply['error_code'] == '\x00' and reply['timestamp'] < item[2])
+                if stale:
+                    self.logger.debug('_handle_read_repair.  repairing key {} on {}'.format(util.to_hex(key), node_hash))
+                    repairs[node_hash].append(item)
+
+        for node_hash, items in repairs.items():
+            self._server.internal_request_stage._metrics['read_repairs'] += len(items)
+            if node_hash == self._server.node_hash:
+                for item in items:
+                    self._apply_item(item)
+            else:
+                transfer = PartitionTransfer(server=self._server, node_hash=node_hash, items=items)
+                self._transfers.append(transfer)
+                self._add_channel(transfer.channel)
+
+    def _handle_batch_request(self, message):
+        """
+        Splits a batch_put/batch_get/batch_delete over the nodes responsible for its keys and sends each node one
+        internal message holding all of its keys.  replies are combined by _batch_listener.
+        """
+        if message['command'] == 'batch_put':
+            keys = [key for key, _ in message['items']]
+        else:
+            keys = message['keys']
+
+        # node_hash -> indices of the keys it is responsible for
+        node_indices = collections.defaultdict(list)
+        quorums = []
+        # nodes each key has been sent to
+        key_node_hashes = []
+        for index, key in enumerate(keys):
+            responsible_node_hashes = self._server.membership_stage.get_responsible_node_hashes(key)
+            quorums.append(self._quorum(message, len(responsible_node_hashes)))
+            key_node_hashes.append(set(responsible_node_hashes))
+            for node_hash in responsible_node_hashes:
+                node_indices[node_hash].append(index)
+
+        self._coordinator_listener = self._batch_listener(keys, node_indices, quorums, key_node_hashes)
+        for node_hash, indices in node_indices.items():
+            self._replies[node_hash] = None
+            self._retries[node_hash] = 0
+            request = self._batch_request(indices)
+            if node_hash == self._server.node_hash:
+                self._coordinator_listener.send(self._handle_request_locally(request))
+            else:
+                self._handle_request_remotely(request, node_hash)
+
+    def _batch_request(self, indices):
+        """ Returns the internal request applying the coordinator's batch to the keys at indices."""
+        request = {
+            'type': 'internal request',
+            'command': self._message['command'],
+            'timestamp': self._message['timestamp']
+        }
+        if self._message['command'] == 'batch_put':
+            request['items'] = [self._message['items'][index] for index in indices]
+        else:
+            request['keys'] = [self._message['keys'][index] for index in indices]
+        return request
+
+    @util.coroutine
+    def _batch_listener(self, keys, node_indices, quorums, key_node_hashes):
+        """
+        Listener for external batch requests, collecting one reply per node holding a 'results' list in the order of
+        the keys it was sent.
+            -answers the client with a reply per key once every key has quorums[index] successful replies, or once every
+             node has replied.  a node that can't be reached fails all of its keys.
+            -the keys of a batch_put/batch_delete a node couldn't be reached for are handed off as single writes are,
+             and the hinted writes count towards each key's quorum.
+            -batch_get then repairs stale replicas, one transfer per node.
+        """
+        command = self._message['command'][len('batch_'):]
+        key_replies = [dict() for _ in keys]
+        num_successful = [0] * len(keys)
+        replied = not keys
+        num_replies = len(node_indices)
+
+        while num_replies:
+            reply = (yield)
+            num_replies -= 1
+            node_hash = reply['node_hash']
+            # hinted batches are tracked by their own target, as their node may hold other keys of the batch too
+            target = reply.pop('handoff', node_hash)
+            self._replies[node_hash] = reply
+            results = reply.get('results') or [{'error_code': reply['error_code']} for _ in node_indices[target]]
+            for index, result in zip(node_indices[target], results):
+                key_replies[index][node_hash] = result
+                if result['error_code'] not in FAILED_ERROR_CODES:
+                    num_successful[index] += 1
+            if reply['error_code'] == UNREACHABLE_ERROR_CODE and command in ['put', 'delete']:
+                num_replies += self._handle_batch_hinted_handoff(target, keys, node_indices, key_node_hashes)
+
+            if not replied and all(count >= quorum for count, quorum in zip(num_successful, quorums)):
+                self._send_batch_reply(command, key_replies)
+                replied = True
+
+        if not replied:
+            self._send_batch_reply(command, key_replies)
+        if command == 'get':
+            self._handle_read_repair({key: replies for key, replies in zip(keys, key_replies)})
+        self._complete = True
+
+        while True:
+            yield True
+
+    def _handle_batch_hinted_handoff(self, target, keys, node_indices, key_node_hashes):
+        """
+        Hands the keys of a batch_put/batch_delete that target, a node or an earlier handoff, couldn't be reached for to
+        the next healthy node of each key that hasn't been tried yet, as _handle_hinted_handoff does for a single write.
+        each handoff node is sent one batch with a hint naming the replica the writes were meant for.
+
+        Returns:
+            the number of handoff batches sent.
+        """
+        hint = self._hints.get(target, target)
+        handoff_indices = collections.defaultdict(list)
+        for index in node_indices[target]:
+            exclude = key_node_hashes[index] | set([self._server.node_hash])
+            handoff_node_hash = self._server.membership_stage.get_handoff_node_hash(keys[index], exclude=exclude)
+            if handoff_node_hash:
+                key_node_hashes[index].add(handoff_node_hash)
+                handoff_indices[handoff_node_hash].append(index)
+        if not handoff_indices:
+            self.logger.error('_handle_batch_hinted_handoff.  no node left to hold the hints for {}'.format(hint))
+
+        for handoff_node_hash, indices in handoff_indices.items():
+            self.logger.info('_handle_batch_hinted_handoff.  handing {} writes meant for {} to {}'.format(len(indices), hint, handoff_node_hash))
+            handoff_target = len(node_indices)
+            node_indices[handoff_target] = indices
+            self._hints[handoff_target] = hint
+            self._retries.setdefault(handoff_node_hash, 0)
+            self._server.internal_request_stage._metrics['hinted_writes'] += len(indices)
+            self._handle_request_remotely(dict(self._batch_request(indices), hint=hint), handoff_node_hash, listener=self._handoff_listener(handoff_target))
+        return len(handoff_indices)
+
+    @util.coroutine
+    def _handoff_listener(self, target):
+        """
+        Listener for a hinted batch, passing each reply it is handed, even one reporting its node unreachable, on to the
+        coordinator's listener tagged with target.
+        """
+        while True:
+            reply = (yield)
+            reply['handoff'] = target
+            self._coordinator_listener.send(reply)
+
+    def _send_batch_reply(self, command, key_replies):
+        reply = {
+            'error_code': '\x00',
+            'results': [self._client_reply(command, replies) for replies in key_replies]
+        }
+        if self._reply_listener:
+            self._reply_listener.send(reply)
+
     def _handle_request_locally(self, request):
         self.logger.debug('_handle_request_locally')
 
-        if request['command'] == 'put':
+        if request['command'] in BATCH_COMMANDS:
+            reply = self._handle_batch_locally(request)
+        elif 'hint' in request:
+            reply = self._server.persistence_stage.put_hint(request['hint'], request['key'], request['command'], request.get('value'), request['timestamp'])
+        elif request['command'] == 'put':
             reply = self._server.persistence_stage.put(request['key'], request['value'], request['timestamp'])
         elif request['command'] == 'get':
             reply = self._server.persistence_stage.get(request['key'])
         elif request['command'] == 'delete':
-            reply = self._server.persistence_stage.delete(request['key'])
+            reply = self._server.persistence_stage.delete(request['key'], request.get('timestamp'))
 
         return reply
         self.logger.debug('_handle_request_locally.  returning reply: {}'.format(reply))
 
-    def _handle_request_remotely(self, request, node_hash):
+    def _handle_batch_locally(self, request):
+        """
+        Returns:
+            reply holding a 'results' list with the outcome of the command for each key of the batch, in order.  the
+            writes of a batch carrying a hint are stored as hints for that replica.
+        """
+        persistence_stage = self._server.persistence_stage
+        if 'hint' in request:
+            hint, timestamp = request['hint'], request['timestamp']
+            if request['command'] == 'batch_put':
+                results = [persistence_stage.put_hint(hint, key, 'put', value, timestamp) for key, value in request['items']]
+            else:
+                results = [persistence_stage.put_hint(hint, key, 'delete', None, timestamp) for key in request['keys']]
+        elif request['command'] == 'batch_put':
+            results = [persistence_stage.put(key, value, request['timestamp']) for key, value in request['items']]
+        elif request['command'] == 'batch_get':
+            results = [persistence_stage.get(key) for key in request['keys']]
+        else:
+            results = [persistence_stage.delete(key, request['timestamp']) for key in request['keys']]
+
+        for result in results:
+            del result['type'], result['node_hash']
+        reply = {
+            'type': 'reply',
+            'error_code': '\x00',
+            'node_hash': self._server.node_hash,
+            'results': results
+        }
+        return reply
+
+    def _handle_request_remotely(self, request, node_hash, listener=None):
+        """ Sends request to node_hash, routing its reply to listener, the coordinator's listener if not given."""
         self.logger.debug('_handle_request_remotely')
+        listener = listener or self._coordinator_listener
         try:
-            internal_channel = InternalChannel(server=self._server, node_hash=node_hash, coordinator_listener=self._coordinator_listener)
-            self.logger.debug('_handle_request_remotely.  created internal channel.')
-            internal_channel._send_message(request)
-            self.logger.debug('_handle_request_remotely.  sending request.')
-            self._channels.append(internal_channel)
-            self.logger.debug('_handle_request_remotely.  appending internal channel.')
+            self._server.internal_request_stage.send_request(node_hash=node_hash, message=request, listener=listener, coordinator=self,
+                                                             timeout=self._request_timeout, on_timeout=lambda: self._handle_timeout(request, node_hash, listener))
+            self.logger.debug('_handle_request_remotely.  sent request over pooled channel.')
         except:
-            pass
+            self.logger.error('_handle_request_remotely.  send failed: {}'.format(sys.exc_info()))
+
+    def _stream_partition(self, node_hash, ranges):
+        """
+        Starts a PartitionTransfer of every key-value pair and tombstone in ranges to node_hash; stepped by the
+        coordinator's processor.  tombstones go as timestamped deletes, so the new owner orders them against the
+        versions a replica that missed the delete sends later, rather than taking the key back.
+        """
+        self.logger.debug('_stream_partition.  node_hash, ranges: {}, {}'.format(node_hash, ranges))
+        items = itertools.chain.from_iterable(self._iter_range_items(low, high) for low, high in ranges)
+        transfer = PartitionTransfer(server=self._server, node_hash=node_hash, items=items)
+        self._transfers.append(transfer)
+        self._add_channel(transfer.channel)
+
+    def _iter_range_items(self, low, high):
+        """ Lazily yields the PartitionTransfer items of hash range (low, high]: its versions, then its tombstones as deletes."""
+        persistence_stage = self._server.persistence_stage
+        for item in persistence_stage.items_in_range(low, high):
+            yield item
+        for key, timestamp in persistence_stage.tombstones_in_range(low, high):
+            yield key, None, timestamp, 'delete'
 
     def _handle_announced_failure_repair(self):
         self.logger.debug('_handle_announced_failure_repair')
@@ -435,47 +1232,218 @@ class InternalRequestCoordinator(object):
 
         message = {
             'type': 'announced failure',
-            'node_hash': self._server.node_hash,
-            'partition' : None
+            'node_hash': self._server.node_hash
         }
 
+        self._coordinator_listener = self._listener(len(new_partition))
         for node_hash in new_partition:
-            message['partition'] = new_partition[node_hash]
             self._replies[node_hash] = None
             self._retries[node_hash] = 0
             internal_channel = InternalChannel(server=self._server, node_hash=node_hash, coordinator_listener=self._coordinator_listener)
             internal_channel._send_message(message=message)
-            self._channels.append(internal_channel)
+            self._add_channel(internal_channel)
+            self._stream_partition(node_hash, new_partition[node_hash])
 
         self._server.membership_stage.remove_node_hash(self._server.node_hash)
 
     def _handle_unannounced_failure_repair(self, failure_node_hash=None):
         self.logger.info('_handle_unannounced_failure_repair')
-        new_partition = self._server.membership_stage._partition_for_failure(node_hash=failure_node_hash)
+        # every surviving replica of the failed node's ranges runs this; each streams the ranges it is the first survivor of
+        new_partition = self._server.membership_stage._partition_for_failure(node_hash=failure_node_hash, source_node_hash=self._server.node_hash)
 
         message = {
             'type': 'unannounced failure',
-            'node_hash': failure_node_hash,
-            'partition' : None
+            'node_hash': failure_node_hash
         }
 
+        self._coordinator_listener = self._listener(len(new_partition))
         for node_hash in new_partition:
-            message['partition'] = new_partition[node_hash]
             self._replies[node_hash] = None
             self._retries[node_hash] = 0
-            self._coordinator_listener = self._listener(len(new_partition))
             internal_channel = InternalChannel(server=self._server, node_hash=node_hash, coordinator_listener=self._coordinator_listener)
             internal_channel._send_message(message=message)
-            self._channels.append(internal_channel)
+            self._add_channel(internal_channel)
+            self._stream_partition(node_hash, new_partition[node_hash])
 
         self._server.membership_stage.remove_node_hash(failure_node_hash)
 
+    def _handle_hint_replay(self, node_hash=None, batch_size=100):
+        """
+        Hands off the hints held for node_hash as a PartitionTransfer of batch_size hints per chunk, one chunk in flight
+        at a time so a backlog of hints doesn't swamp a node that just came back.
+        """
+        self.logger.debug('_handle_hint_replay')
+        replayed = []
+        items = self._iter_hints(node_hash, replayed)
+        transfer = PartitionTransfer(server=self._server, node_hash=node_hash, items=items, max_chunk_items=batch_size,
+                                     window=1, completion_listener=self._hint_replay_listener(node_hash, replayed))
+        self._transfers.append(transfer)
+        self._add_channel(transfer.channel)
+        self._complete = True
+
+    def _iter_hints(self, node_hash, replayed):
+        """ Lazily yields the hints held for node_hash as PartitionTransfer items, recording (key, timestamp) of each in replayed."""
+        for key, value, timestamp, command in self._server.persistence_stage.hint_store.iter_hints(node_hash):
+            replayed.append((key, timestamp))
+            if command == 'delete':
+                yield key, value, timestamp, 'delete'
+            else:
+                yield key, value, timestamp
+
+    @util.coroutine
+    def _hint_replay_listener(self, node_hash, replayed):
+        """
+        Coroutine told whether the hand-off to node_hash succeeded; if so, removes the hints that were sent from the store.
+        """
+        success = (yield)
+        internal_request_stage = self._server.internal_request_stage
+        if success:
+            hint_store = self._server.persistence_stage.hint_store
+            num_removed = sum(hint_store.remove(node_hash, key, timestamp) for key, timestamp in replayed)
+            internal_request_stage._metrics['hints_replayed'] += num_removed
+            self.logger.info('_hint_replay_listener.  handed off {} hints to {}'.format(num_removed, node_hash))
+        else:
+            self.logger.error('_hint_replay_listener.  hand-off to {} failed, keeping its hints'.format(node_hash))
+        internal_request_stage._hint_replay_node_hashes.discard(node_hash)
+        while True:
+            yield
+
+    def _handle_anti_entropy(self, node_hash=None, tree=None):
+        """
+        Starts an anti-entropy exchange of tree's hash range with replica peer node_hash over a single InternalChannel.
+        """
+        self.logger.debug('_handle_anti_entropy')
+        internal_channel = InternalChannel(server=self._server, node_hash=node_hash)
+        internal_channel._coordinator_listener = self._anti_entropy_exchange(internal_channel, node_hash, tree)
+        self._add_channel(internal_channel)
+
+    @util.coroutine
+    def _anti_entropy_exchange(self, internal_channel, node_hash, tree, max_leaves=32):
+        """
+        Coroutine walking down tree alongside the peer's copy, one level per round trip, into the subtrees whose digests differ.
+            -differing leaves are then exchanged max_leaves at a time as {key: timestamp} maps: the peer returns the items it
+             holds newer versions of, and names the keys it wants, which are streamed back with a PartitionTransfer.
+            -tombstones are exchanged with the timestamps of their deletes, so a newer delete wins over an older value
+             and is sent as a delete item.
+            -only differing subtrees are ever sent, so bandwidth is O(differences * log n).
+        """
+        message = {
+            'type': 'anti entropy',
+            'node_hash': self._server.node_hash,
+            'range': [tree.low, tree.high],
+            'depth': tree.depth
+        }
+        level, indices = 0, [0]
+        num_received, num_sent = 0, 0
+
+        while indices and level < tree.depth:
+            message['level'] = level
+            message['digests'] = tree.digests(level, indices)
+            internal_channel._send_message(message)
+            reply = (yield)
+            if reply['error_code'] != '\x00':
+                indices = []
+                break
+            indices = reply['differing']
+            if indices and level + 1 < tree.depth:
+                indices = tree.children(indices)
+            level += 1
+        else:
+            # compare leaves, whose children are the differing leaves of the last round
+            indices = tree.children(indices)
+            del message['digests']
+            message['level'] = tree.depth
+            wanted = []
+            for batch_start in xrange(0, len(indices), max_leaves):
+                leaves = dict()
+                for index in indices[batch_start:batch_start + max_leaves]:
+                    leaves[index] = self._leaf_versions(*tree.leaf_range(index))
+                message['leaves'] = leaves
+                internal_channel._send_message(message)
+                reply = (yield)
+                if reply['error_code'] != '\x00':
+                    break
+                for item in reply['items']:
+                    self._apply_item(item)
+                num_received += len(reply['items'])
+                wanted += reply['wanted']
+
+            if wanted:
+                num_sent = len(wanted)
+                transfer = PartitionTransfer(server=self._server, node_hash=node_hash, items=self._iter_stored_items(wanted))
+                self._transfers.append(transfer)
+                self._add_channel(transfer.channel)
+
+        self.logger.info('_anti_entropy_exchange.  range {} with {}: received {} items, sending {} items'.format(message['range'], node_hash, num_received, num_sent))
+        self._complete = True
+        while True:
+            yield
+
+    def _leaf_versions(self, low, high):
+        """ Returns {key: timestamp} of the versions stored in the leaf range (low, high], tombstones included."""
+        persistence_stage = self._server.persistence_stage
+        versions = {key: timestamp for key, _, timestamp in persistence_stage.items_in_range(low, high)}
+        versions.update(persistence_stage.tombstones_in_range(low, high))
+        return versions
+
+    def _iter_stored_items(self, keys):
+        """
+        Lazily yields (key, value, timestamp) for each of keys still present in the persistence stage, and
+        (key, None, timestamp, 'delete') for each deleted one.
+        """
+        for key in keys:
+            reply = self._server.persistence_stage.get(key)
+            if reply['error_code'] == '\x00':
+                yield key, reply['value'], reply['timestamp']
+            elif reply['error_code'] == '\x01' and reply['timestamp'] is not None:
+                yield key, None, reply['timestamp'], 'delete'
+
+    def _handle_anti_entropy_message(self, message):
+        """
+        Answers one round of an anti-entropy exchange for the hash range in message.
+            -digest rounds: replies with the indices whose digests differ from the local tree's.
+            -leaf rounds: replies with the items held in newer versions here and the keys the sender holds newer versions of.
+             a newer tombstone here is returned as a delete item.
+        """
+        self.logger.debug('_handle_anti_entropy_message')
+        persistence_stage = self._server.persistence_stage
+        tree = persistence_stage.merkle_tree(*message['range'])
+        reply = {
+                    'type': 'reply',
+                    'error_code': '\x00',
+                    'node_hash': self._server.node_hash
+                }
+
+        if not tree or tree.depth != message['depth']:
+            reply['error_code'] = '\x04'
+        elif 'leaves' in message:
+            reply['items'], reply['wanted'] = [], []
+            for index, remote_versions in message['leaves'].items():
+                low, high = tree.leaf_range(int(index))
+                local_versions = dict()
+                for key, value, timestamp in persistence_stage.items_in_range(low, high):
+                    local_versions[key] = timestamp
+                    if key not in remote_versions or timestamp > remote_versions[key]:
+                        reply['items'].append([key, value, timestamp])
+                for key, timestamp in persistence_stage.tombstones_in_range(low, high):
+                    local_versions[key] = timestamp
+                    if key not in remote_versions or timestamp > remote_versions[key]:
+                        reply['items'].append([key, None, timestamp, 'delete'])
+                for key, timestamp in remote_versions.items():
+                    if key not in local_versions or timestamp > local_versions[key]:
+                        reply['wanted'].append(key)
+        else:
+            reply['differing'] = tree.differing(message['level'], message['digests'])
+
+        return reply
+
     def _handle_membership_check(self, gossip_node_hash=None):
         self.logger.debug('_handle_membership_check')
         message = {
             'type': 'membership',
             'info': 'membership check',
-            'hash ring': self._server.membership_stage.node_hashes
+            'hash ring': self._server.membership_stage.node_hashes,
+            'partitioner': self._server.partitioner.name
         }
 
         if not gossip_node_hash:
@@ -487,8 +1455,7 @@ class InternalRequestCoordinator(object):
         self._coordinator_listener = self._listener(1)
 
         try:
-            internal_channel = InternalChannel(server=self._server, node_hash=gossip_node_hash, coordinator_listener=self._coordinator_listener)
-            internal_channel._send_message(message=message)
+            self._server.internal_request_stage.send_request(node_hash=gossip_node_hash, message=message, listener=self._coordinator_listener, coordinator=self)
         except:
             self.logger.error('_handle_membership_check.  message send fail')
 
@@ -504,25 +1471,51 @@ class InternalRequestCoordinator(object):
 
         message = {
             'type': 'unannounced failure',
-            'node_hash': failure_node_hash,
-            'partition' : None
+            'node_hash': failure_node_hash
         }
 
         for gossip_node_hash in unannounced_repair_node_hashes:
             self._coordinator_listener = self._listener(len(unannounced_repair_node_hashes))
             internal_channel = InternalChannel(server=self._server, node_hash=gossip_node_hash, coordinator_listener=self._coordinator_listener)
             internal_channel._send_message(message=message)
+            self._add_channel(internal_channel)
+
+    def _apply_item(self, item):
+        """
+        Stores a PartitionTransfer item: (key, value, timestamp), or (key, None, timestamp, 'delete') for a delete.
+
+        Returns:
+            the persistence stage's reply.
+        """
+        key, value, timestamp = item[:3]
+        if tuple(item[3:]) == ('delete',):
+            return self._server.persistence_stage.delete(key, timestamp)
+        return self._server.persistence_stage.put(key, value, timestamp)
+
+    def _handle_partition_chunk(self, message):
+        """
+        Applies one chunk of a partition transfer and acknowledges it so the sender can release the next one.
+            -puts and deletes carry the timestamp of the version they were written with, so an item older than the
+             version already stored, e.g. a hinted delete replayed after a newer put, is ignored.
+        """
+        self.logger.debug('_handle_partition_chunk.  transfer, sequence, items: {}, {}, {}'.format(message['transfer_id'], message['sequence'], len(message['items'])))
+        error_code = '\x00'
+        for item in message['items']:
+            if self._apply_item(item)['error_code'] == '\x06':
+                error_code = '\x06'
+
+        reply = {
+                    'type': 'reply',
+                    'error_code': error_code,
+                    'node_hash': self._server.node_hash,
+                    'transfer_id': message['transfer_id'],
+                    'sequence': message['sequence']
+                }
+
+        return reply
 
     def _handle_announced_failure_message(self, message):
         self.logger.debug('_handle_announced_failure_message')
-        if message['partition']:
-            self.logger.debug('_handle_announced_failure.  received partition: {}'.format(message['partition']))
-            partition = message['partition']
-            for key_hash in partition:
-                self._server.persistence_stage.put(key_hash, partition[key_hash]['value'], partition[key_hash]['timestamp'])
-
-            # remove partition from message when forwarding to other nodes
-            message['partition'] = None
 
         # # attempt to remove node from own hash ring.  if it's already been removed, a previous announced failure notification has already been received.
         node_hash_already_removed = not self._server.membership_stage.remove_node_hash(message['node_hash'])
@@ -553,15 +1546,6 @@ class InternalRequestCoordinator(object):
 
         failure_node_hash = message['node_hash']
 
-        if message['partition']:
-            self.logger.debug('_handle_unannounced_failure.  received partition: {}'.format(message['partition']))
-            partition = message['partition']
-            for key_hash in partition:
-                self._server.persistence_stage.put(key_hash, partition[key_hash]['value'], partition[key_hash]['timestamp'])
-
-            # remove partition from message when forwarding to other nodes
-            message['partition'] = None
-
         # check if failed node hash is present.  if so, partition before removing it.
         if failure_node_hash in self._server.membership_stage.node_hashes:
             unannounced_repair_node_hashes = self._server.membership_stage.get_unannounced_failure_repair_node_hashes(failure_node_hash=failure_node_hash)
@@ -611,7 +1595,7 @@ class InternalRequestCoordinator(object):
                 internal_channel = InternalChannel(server=self._server, node_hash=node_hash, coordinator_listener=self._coordinator_listener)
                 self.logger.debug('_handle_gossip. sending message: {}'.format(contents))
                 internal_channel._send_message(message=contents)
-                self._channels.append(internal_channel)
+                self._add_channel(internal_channel)
             else:
                 self._replies[node_hash] = None
                 self._retries[node_hash] = 0
@@ -624,6 +1608,16 @@ class InternalRequestCoordinator(object):
 
     def _handle_membership_message(self, message=None):
         self.logger.debug('_handle_membership_message')
+        partitioner = message.get('partitioner', partitioners.DEFAULT_PARTITIONER)
+        if partitioner != self._server.partitioner.name:
+            self.logger.error('_handle_membership_message.  ignoring {}, which places keys with partitioner {}'.format(message.get('node_hash'), partitioner))
+            return {
+                'type': 'reply',
+                'info': 'partitioner mismatch',
+                'error_code': '\x06',
+                'node_hash': self._server.node_hash
+            }
+
         old_membership_view = set(self._server.membership_stage.node_hashes)
         new_membership_view = set(message['hash ring']).intersection(old_membership_view)
         for node_hash in list(old_membership_view - new_membership_view):
@@ -639,12 +1633,31 @@ class InternalRequestCoordinator(object):
 
         return reply
 
-    def _handle_timeout(self):
+    def _handle_timeout(self, request, node_hash, listener=None):
         """
-        Retries requests up to _max_num_tries
+        Resends request to node_hash after it went unanswered, up to _max_retries times; after that node_hash is
+        reported to the membership stage and listener, the coordinator's listener if not given, handed a reply with
+        UNREACHABLE_ERROR_CODE.
         """
-        self.logger.debug('_handle_timeout')
-
-        for channel in self._channels:
-            channel.close_when_done()
-            self._channels.remove(channel)
+        listener = listener or self._coordinator_listener
+        self.logger.debug('_handle_timeout.  node_hash: {}'.format(node_hash))
+        if self._complete:
+            return
+
+        if self._retries.get(node_hash, 0) < self._max_retries:
+            self._retries[node_hash] = self._retries.get(node_hash, 0) + 1
+            self._server.internal_request_stage._metrics['retries'] += 1
+            self._handle_request_remotely(request, node_hash, listener)
+            return
+
+        self.logger.error('_handle_timeout.  {} unanswered after {} retries'.format(node_hash, self._max_retries))
+        try:
+            self._server.membership_stage.report_contact_failure(node_hash=node_hash)
+        except:
+            pass
+        reply = {
+            'type': 'reply',
+            'error_code': UNREACHABLE_ERROR_CODE,
+            'node_hash': node_hash
+        }
+        listener.send(reply)
@@ -0,0 +1,545 @@
+"""
+    log_persistence_engine.py
+    ~~~~~~~~~~~~
+    Implements a disk-backed, log-structured PersistenceEngine.
+
+    Every put/delete is appended as a record to the active segment file of an append-only log, and an in-memory
+    index maps each live key to the location of its newest record.  Segments roll over once they reach
+    max_segment_size, and the log is replayed on startup to rebuild the index after a crash.
+
+    Sealed segments are merged in the background by a compactor that is stepped from PynamoServer.process(), a
+    slice of records at a time, dropping superseded records and tombstones older than a grace period.
+"""
+
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+
+import util
+import wire_protocol
+from persistence_engine import DeletedKeyError
+from sorted_index import SortedKeyIndex
+
+
+# record layout: crc32 (of everything after it), payload length, flags, payload
+RECORD_HEADER = struct.Struct('>IIB')
+
+FLAG_PUT = 0
+FLAG_TOMBSTONE = 1
+FLAG_COMMIT = 2     # last record of a finished compaction output; value lists the merged segment ids
+FLAG_ENCODED = 0x80  # payload encoded with wire_protocol.encode rather than JSON, so values may hold any bytes
+
+SEGMENT_SUFFIX = '.log'
+COMPACTION_SUFFIX = '.compact'
+# file recording the format version of the data in an engine's directory
+FORMAT_FILENAME = 'FORMAT'
+
+
+def pack_record(key, value, timestamp, flags=FLAG_PUT):
+    """ Returns the on-disk representation of a single record."""
+    payload = wire_protocol.encode([key, value, timestamp])
+    body = struct.pack('>IB', len(payload), flags | FLAG_ENCODED) + payload
+    return struct.pack('>I', zlib.crc32(body) & 0xffffffff) + body
+
+def unpack_record(data):
+    """
+    Returns:
+        (key, value, timestamp, flags) for the serialized record data.
+
+    Raises:
+        ValueError if the record is truncated or its checksum does not match.
+    """
+    if len(data) < RECORD_HEADER.size:
+        raise ValueError('truncated record header')
+    crc, length, flags = RECORD_HEADER.unpack_from(data)
+    if len(data) < RECORD_HEADER.size + length:
+        raise ValueError('truncated record payload')
+    body = data[4:RECORD_HEADER.size + length]
+    if zlib.crc32(body) & 0xffffffff != crc:
+        raise ValueError('record checksum mismatch')
+    if flags & FLAG_ENCODED:
+        key, value, timestamp = wire_protocol.decode(body[5:])
+    else:
+        # written before records were encoded
+        key, value, timestamp = json.loads(body[5:])
+    if not isinstance(timestamp, (int, long)):
+        # stamped before timestamps were integers
+        timestamp = util.to_timestamp(timestamp)
+    return key, value, timestamp, flags & ~FLAG_ENCODED
+
+def read_format_version(directory):
+    """ Returns the format version recorded in directory, 0 if none was."""
+    try:
+        with open(os.path.join(directory, FORMAT_FILENAME), 'rb') as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return 0
+
+def write_format_version(directory, version):
+    """ Records version as the format version of the data in directory, replacing the old record atomically."""
+    path = os.path.join(directory, FORMAT_FILENAME)
+    with open(path + '.tmp', 'wb') as f:
+        f.write('{}\n'.format(version))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+def read_records(f):
+    """
+    Generator over the records of an open segment file, starting at its current position.
+
+    Yields:
+        (offset, size, key, value, timestamp, flags) for each intact record.
+        stops at the first truncated or corrupt record, leaving f positioned at its start.
+    """
+    while True:
+        offset = f.tell()
+        header = f.read(RECORD_HEADER.size)
+        if not header:
+            return
+        try:
+            _, length, _ = RECORD_HEADER.unpack(header)
+        except struct.error:
+            f.seek(offset)
+            return
+        data = header + f.read(length)
+        try:
+            key, value, timestamp, flags = unpack_record(data)
+        except ValueError:
+            f.seek(offset)
+            return
+        yield offset, len(data), key, value, timestamp, flags
+
+
+class LogPersistenceEngine(object):
+    """
+    Log-structured persistence engine with an in-memory hash index.
+    ----------
+        -writes are sequential appends to the active segment; reads are a single seek + read.
+        -fsyncs are batched: the active segment is fsync'd every sync_every writes, or when sync() is called.
+        -once compaction_threshold sealed segments exist, process() merges them into one, compaction_slice records per call.
+        -on_tombstone_dropped(key, timestamp), if set, is called for each tombstone a compaction drops.
+    """
+
+    def __init__(self, directory, max_segment_size=64 * 1024 * 1024, sync_every=100,
+                 compaction_threshold=4, compaction_slice=500, tombstone_grace_period=24 * 60 * 60):
+        """
+        Args:
+        ----------
+        directory (str):
+            directory holding the segment files; created if it doesn't exist.
+        max_segment_size (int, optional):
+            size in bytes after which the active segment is sealed and a new one started, defaults to 64MB.
+        sync_every (int, optional):
+            number of writes between fsyncs of the active segment, defaults to 100.  1 fsyncs every write.
+        compaction_threshold (int, optional):
+            number of sealed segments that triggers a compaction, defaults to 4.
+        compaction_slice (int, optional):
+            maximum number of records the compactor copies per call to process(), defaults to 500.
+        tombstone_grace_period (int, optional):
+            seconds a tombstone survives compaction for, defaults to a day.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        self._directory = directory
+        self._max_segment_size = max_segment_size
+        self._sync_every = sync_every
+        self._compaction_threshold = compaction_threshold
+        self._compaction_slice = compaction_slice
+        self._tombstone_grace_period = tombstone_grace_period
+
+        # key -> (segment_id, offset, size) of the key's newest record
+        self._index = dict()
+        self._sorted_keys = SortedKeyIndex()
+        # key -> (segment_id, offset, size, timestamp) of deleted keys' tombstones, plus their keys in sorted order
+        self._tombstones = dict()
+        self._sorted_tombstones = SortedKeyIndex()
+        # segment_id -> bytes taken up by superseded records
+        self._dead_bytes = dict()
+        self._readers = dict()
+
+        self._active_segment_id = None
+        self._active_file = None
+        self._active_size = 0
+        self._unsynced_writes = 0
+        self._unflushed = False
+
+        self._compactor = None
+        self._metrics = {
+            'compactions': 0,
+            'reclaimed_bytes': 0,
+            'dropped_tombstones': 0,
+            'compaction_seconds': 0.0,
+            'last_compaction_seconds': 0.0
+        }
+        # called with (key, timestamp) of each tombstone dropped while it was the key's newest record
+        self.on_tombstone_dropped = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._recover()
+
+    @property
+    def segment_ids(self):
+        """ Returns the sorted ids of every segment on disk, active segment included."""
+        return sorted(self._readers.keys())
+
+    @property
+    def metrics(self):
+        """
+        Returns:
+            dict of compaction counters: number of compactions, bytes reclaimed, tombstones dropped and time spent.
+        """
+        return dict(self._metrics)
+
+    @property
+    def format_version(self):
+        """ Returns the format version of the data stored, as last set with set_format_version; 0 if it never was."""
+        return read_format_version(self._directory)
+
+    def set_format_version(self, version):
+        """ Records version as the format version of the data stored, e.g. once it has been migrated."""
+        write_format_version(self._directory, version)
+
+    def _segment_path(self, segment_id):
+        return os.path.join(self._directory, '{:08d}{}'.format(segment_id, SEGMENT_SUFFIX))
+
+    def _list_segment_ids(self):
+        segment_ids = []
+        for filename in os.listdir(self._directory):
+            name, suffix = os.path.splitext(filename)
+            if suffix == SEGMENT_SUFFIX and name.isdigit():
+                segment_ids.append(int(name))
+        return sorted(segment_ids)
+
+    def _recover_compaction(self):
+        """
+        Finishes or discards a compaction interrupted by a crash.
+            -an output ending in a commit record is installed, anything else is removed.
+        """
+        for filename in os.listdir(self._directory):
+            if not filename.endswith(SEGMENT_SUFFIX + COMPACTION_SUFFIX):
+                continue
+            path = os.path.join(self._directory, filename)
+            merged_segment_ids = None
+            with open(path, 'rb') as f:
+                for _, _, _, value, _, flags in read_records(f):
+                    if flags == FLAG_COMMIT:
+                        merged_segment_ids = value
+            if merged_segment_ids:
+                self.logger.info('_recover_compaction.  installing compaction of segments {}'.format(merged_segment_ids))
+                self._replace_segments(path, merged_segment_ids)
+            else:
+                self.logger.info('_recover_compaction.  removing unfinished compaction {}'.format(filename))
+                os.remove(path)
+
+    def _replace_segments(self, compaction_path, merged_segment_ids):
+        """ Swaps the merged segments for the compaction output, which takes over the newest merged segment's id."""
+        for segment_id in merged_segment_ids[:-1]:
+            if os.path.exists(self._segment_path(segment_id)):
+                os.remove(self._segment_path(segment_id))
+        os.rename(compaction_path, self._segment_path(merged_segment_ids[-1]))
+
+    def _recover(self):
+        """
+        Rebuilds the index by replaying every segment in order.
+            -a torn write at the tail of the newest segment is truncated away.
+        """
+        self._recover_compaction()
+        segment_ids = self._list_segment_ids()
+        self.logger.info('_recover.  replaying {} segments in {}'.format(len(segment_ids), self._directory))
+
+        for segment_id in segment_ids:
+            reader = open(self._segment_path(segment_id), 'rb')
+            self._readers[segment_id] = reader
+            self._dead_bytes[segment_id] = 0
+            for offset, size, key, _, timestamp, flags in read_records(reader):
+                if flags == FLAG_COMMIT:
+                    self._dead_bytes[segment_id] += size
+                    continue
+                self._supersede(key)
+                if flags == FLAG_TOMBSTONE:
+                    self._index.pop(key, None)
+                    self._tombstones[key] = (segment_id, offset, size, timestamp)
+                else:
+                    self._index[key] = (segment_id, offset, size)
+            end = reader.tell()
+            if end != os.path.getsize(self._segment_path(segment_id)):
+                self.logger.warn('_recover.  truncating corrupt tail of segment {} at offset {}'.format(segment_id, end))
+                with open(self._segment_path(segment_id), 'r+b') as f:
+                    f.truncate(end)
+
+        self._sorted_keys.update(self._index)
+        self._sorted_tombstones.update(self._tombstones)
+
+        if segment_ids:
+            self._open_active_segment(segment_ids[-1])
+        else:
+            self._open_active_segment(0)
+
+    def _open_active_segment(self, segment_id):
+        path = self._segment_path(segment_id)
+        self._active_file = open(path, 'ab')
+        self._active_segment_id = segment_id
+        self._active_size = os.path.getsize(path)
+        self._dead_bytes.setdefault(segment_id, 0)
+        if segment_id not in self._readers:
+            self._readers[segment_id] = open(path, 'rb')
+
+    def _roll_segment(self):
+        """ Seals the active segment and starts a new one."""
+        self.sync()
+        self._active_file.close()
+        self._open_active_segment(self._active_segment_id + 1)
+        self.logger.debug('_roll_segment.  new active segment: {}'.format(self._active_segment_id))
+
+    def _append(self, record):
+        """
+        Appends record to the active segment.
+
+        Returns:
+            (segment_id, offset, size) of the appended record.
+        """
+        if self._active_size and self._active_size + len(record) > self._max_segment_size:
+            self._roll_segment()
+
+        location = (self._active_segment_id, self._active_size, len(record))
+        self._active_file.write(record)
+        self._active_size += len(record)
+        self._unflushed = True
+
+        self._unsynced_writes += 1
+        if self._unsynced_writes >= self._sync_every:
+            self.sync()
+        return location
+
+    def _read(self, location):
+        segment_id, offset, size = location
+        if segment_id == self._active_segment_id and self._unflushed:
+            self._active_file.flush()
+            self._unflushed = False
+        reader = self._readers[segment_id]
+        reader.seek(offset)
+        return unpack_record(reader.read(size))
+
+    def _supersede(self, key):
+        """ Accounts the current record or tombstone of key, about to be replaced, as dead bytes."""
+        location = self._index.get(key)
+        if not location:
+            location = self._tombstones.pop(key, None)
+            if location:
+                self._sorted_tombstones.discard(key)
+        if location:
+            self._dead_bytes[location[0]] += location[2]
+
+    def sync(self):
+        """ Flushes and fsyncs the active segment."""
+        if self._active_file and (self._unsynced_writes or self._unflushed):
+            self._active_file.flush()
+            os.fsync(self._active_file.fileno())
+        self._unsynced_writes = 0
+        self._unflushed = False
+
+    def close(self):
+        """ Syncs outstanding writes and closes every open segment."""
+        self.sync()
+        if self._active_file:
+            self._active_file.close()
+            self._active_file = None
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = dict()
+
+    def keys(self):
+        return self._index.keys()
+
+    def sorted_keys(self):
+        return list(self._sorted_keys)
+
+    def iter_keys(self, low=None, high=None):
+        """ Lazily yields the keys in (low, high] in sorted order."""
+        return self._sorted_keys.irange(low, high)
+
+    def iter_items(self, low=None, high=None):
+        """ Lazily yields (key, value, timestamp) for the keys in (low, high] in sorted order."""
+        for key in self._sorted_keys.irange(low, high):
+            location = self._index.get(key)
+            if location:
+                _, value, timestamp, _ = self._read(location)
+                yield key, value, timestamp
+
+    def iter_tombstones(self, low=None, high=None):
+        """ Lazily yields (key, timestamp of the delete) for the deleted keys in (low, high] in sorted order."""
+        for key in self._sorted_tombstones.irange(low, high):
+            tombstone = self._tombstones.get(key)
+            if tombstone:
+                yield key, tombstone[3]
+
+    def put(self, key, value, timestamp):
+        """ Put key value pair into storage"""
+        self._supersede(key)
+        if key not in self._index:
+            self._sorted_keys.add(key)
+        self._index[key] = self._append(pack_record(key, value, timestamp))
+        return True
+
+    def get(self, key):
+        """
+        Get key's value
+
+        Raises:
+            DeletedKeyError, a KeyError, if key's newest record is a tombstone.
+        """
+        if key not in self._index and key in self._tombstones:
+            raise DeletedKeyError(key, self._tombstones[key][3])
+        _, value, timestamp, _ = self._read(self._index[key])
+        return value, timestamp
+
+    def delete(self, key, timestamp=None):
+        """
+        Delete key value pair, leaving a tombstone with timestamp, the current time if not given.
+
+        Raises:
+            KeyError if key isn't live and no timestamp is given.  a delete with a timestamp writes its tombstone
+            either way, so a replica that never held key still orders it against later versions.
+        """
+        if key not in self._index and timestamp is None:
+            raise KeyError(key)
+        self._supersede(key)
+        if key in self._index:
+            del self._index[key]
+            self._sorted_keys.discard(key)
+        if not timestamp:
+            timestamp = util.current_time()
+        segment_id, offset, size = self._append(pack_record(key, None, timestamp, flags=FLAG_TOMBSTONE))
+        self._tombstones[key] = (segment_id, offset, size, timestamp)
+        self._sorted_tombstones.add(key)
+        return True
+
+    def process(self):
+        """
+        Steps the background compactor through one slice of work, starting a compaction once enough segments are sealed.
+
+        Returns:
+            True if a compaction is in progress, False otherwise.
+        """
+        if self._compactor is None:
+            sealed_segment_ids = [segment_id for segment_id in self.segment_ids if segment_id != self._active_segment_id]
+            if len(sealed_segment_ids) < self._compaction_threshold:
+                return False
+            self._compactor = self._compact(sealed_segment_ids)
+
+        start = time.time()
+        try:
+            next(self._compactor)
+        except StopIteration:
+            self._compactor = None
+        except:
+            self.logger.error('process.  compaction failed', exc_info=True)
+            self._compactor = None
+        self._metrics['compaction_seconds'] += time.time() - start
+        return self._compactor is not None
+
+    def _tombstone_expired(self, timestamp):
+        return util.add_time(timestamp, self._tombstone_grace_period) < util.current_time()
+
+    def _compact(self, segment_ids):
+        """
+        Generator merging the sealed segment_ids into a single segment, yielding after every compaction_slice records.
+            -only records the index (or tombstone table) still points at are copied; tombstones past the grace period are dropped.
+            -keys written or deleted while the compaction runs keep their newer location when the output is installed.
+        """
+        self.logger.info('_compact.  compacting segments {}'.format(segment_ids))
+        start = time.time()
+        compaction_path = self._segment_path(segment_ids[-1]) + COMPACTION_SUFFIX
+        output = open(compaction_path, 'wb')
+        output_size = 0
+        relocated = []
+        dropped_tombstones = []
+        copied = 0
+
+        try:
+            for segment_id in segment_ids:
+                reader = open(self._segment_path(segment_id), 'rb')
+                try:
+                    for offset, size, key, _, timestamp, flags in read_records(reader):
+                        location = (segment_id, offset, size)
+                        if flags == FLAG_TOMBSTONE:
+                            tombstone = self._tombstones.get(key)
+                            if not tombstone or tombstone[:3] != location:
+                                continue
+                            if self._tombstone_expired(timestamp):
+                                dropped_tombstones.append((key, location))
+                                continue
+                        elif self._index.get(key) != location:
+                            continue
+
+                        reader.seek(offset)
+                        output.write(reader.read(size))
+                        relocated.append((key, location, output_size, flags))
+                        output_size += size
+
+                        copied += 1
+                        if copied % self._compaction_slice == 0:
+                            yield
+                finally:
+                    reader.close()
+
+            output.write(pack_record(None, segment_ids, None, flags=FLAG_COMMIT))
+            output.flush()
+            os.fsync(output.fileno())
+        except:
+            output.close()
+            os.remove(compaction_path)
+            raise
+        output.close()
+
+        self._install_compaction(compaction_path, segment_ids, relocated, dropped_tombstones)
+
+        elapsed = time.time() - start
+        self._metrics['compactions'] += 1
+        self._metrics['last_compaction_seconds'] = elapsed
+        self.logger.info('_compact.  merged segments {} in {:.3f}s, reclaimed {} bytes'.format(segment_ids, elapsed, self._metrics['reclaimed_bytes']))
+
+    def _install_compaction(self, compaction_path, segment_ids, relocated, dropped_tombstones):
+        """ Replaces segment_ids with the compaction output and points the index at the copied records."""
+        old_size = sum(os.path.getsize(self._segment_path(segment_id)) for segment_id in segment_ids)
+
+        for segment_id in segment_ids:
+            self._readers.pop(segment_id).close()
+            del self._dead_bytes[segment_id]
+        self._replace_segments(compaction_path, segment_ids)
+
+        new_segment_id = segment_ids[-1]
+        self._readers[new_segment_id] = open(self._segment_path(new_segment_id), 'rb')
+        self._dead_bytes[new_segment_id] = 0
+
+        for key, old_location, offset, flags in relocated:
+            size = old_location[2]
+            if flags == FLAG_TOMBSTONE:
+                tombstone = self._tombstones.get(key)
+                if tombstone and tombstone[:3] == old_location:
+                    self._tombstones[key] = (new_segment_id, offset, size, tombstone[3])
+                    continue
+            elif self._index.get(key) == old_location:
+                self._index[key] = (new_segment_id, offset, size)
+                continue
+            # superseded while the compaction was running
+            self._dead_bytes[new_segment_id] += size
+
+        for key, location in dropped_tombstones:
+            tombstone = self._tombstones.get(key)
+            if tombstone and tombstone[:3] == location:
+                del self._tombstones[key]
+                self._sorted_tombstones.discard(key)
+                if self.on_tombstone_dropped:
+                    self.on_tombstone_dropped(key, tombstone[3])
+
+        reclaimed_bytes = old_size - os.path.getsize(self._segment_path(new_segment_id))
+        self._metrics['reclaimed_bytes'] += reclaimed_bytes
+        self._metrics['dropped_tombstones'] += len(dropped_tombstones)
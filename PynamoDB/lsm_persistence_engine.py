@@ -0,0 +1,634 @@
+"""
+    lsm_persistence_engine.py
+    ~~~~~~~~~~~~
+    Implements a log-structured merge-tree PersistenceEngine for write-heavy workloads.
+
+    Writes go to a write-ahead log and a sorted in-memory memtable.  Full memtables are flushed to immutable,
+    sorted SSTable files, each carrying a sparse index and a bloom filter so that lookups for missing keys are
+    answered from memory.  Runs of similarly sized SSTables are merged by a size-tiered compactor that is stepped
+    from PynamoServer.process() a slice at a time.
+"""
+
+import bisect
+import cStringIO
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import struct
+import time
+
+import util
+import wire_protocol
+from log_persistence_engine import pack_record, read_records, read_format_version, write_format_version, FLAG_PUT, FLAG_TOMBSTONE
+from persistence_engine import DeletedKeyError
+
+
+TABLE_SUFFIX = '.sst'
+WAL_SUFFIX = '.wal'
+COMPACTION_SUFFIX = '.compact'
+
+# footer layout: metadata block offset, metadata block length, bloom filter offset, bloom filter length, magic
+TABLE_FOOTER = struct.Struct('>QIQI4s')
+TABLE_MAGIC = 'PSST'
+
+
+class BloomFilter(object):
+    """
+    Fixed-size bloom filter over string keys.
+    ----------
+        -sized for an expected number of keys and false positive rate; k bit positions are derived from one md5 digest by double hashing.
+    """
+
+    def __init__(self, num_keys=1, false_positive_rate=0.01, bits=None, num_hashes=None):
+        num_keys = max(num_keys, 1)
+        if bits is None:
+            num_bits = int(math.ceil(-num_keys * math.log(false_positive_rate) / (math.log(2) ** 2)))
+            bits = bytearray((num_bits + 7) // 8)
+        if num_hashes is None:
+            num_hashes = max(1, int(round(len(bits) * 8.0 / num_keys * math.log(2))))
+        self._bits = bits
+        self._num_bits = len(bits) * 8
+        self._num_hashes = num_hashes
+
+    @classmethod
+    def from_string(cls, data):
+        """ Constructor from the output of to_string."""
+        num_hashes, = struct.unpack_from('>B', data)
+        return cls(bits=bytearray(data[1:]), num_hashes=num_hashes)
+
+    def to_string(self):
+        return struct.pack('>B', self._num_hashes) + str(self._bits)
+
+    def _positions(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        h1, h2 = struct.unpack('>QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self._num_bits for i in xrange(self._num_hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class SSTable(object):
+    """
+    Immutable sorted table of records on disk.
+    ----------
+        -layout: sorted records | metadata block (sparse index, key count), wire_protocol encoded | bloom filter | footer.
+        -the sparse index and bloom filter are held in memory; a lookup reads at most one index interval from disk.
+        -reference counted: the engine holds one reference and every range scan in progress another, so a table a
+         compaction replaces stays readable until the last scan over it finishes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._references = 1
+        self._file.seek(-TABLE_FOOTER.size, os.SEEK_END)
+        metadata_offset, metadata_length, bloom_offset, bloom_length, magic = TABLE_FOOTER.unpack(self._file.read(TABLE_FOOTER.size))
+        if magic != TABLE_MAGIC:
+            raise ValueError('{} is not a complete SSTable'.format(path))
+
+        self._file.seek(metadata_offset)
+        metadata = self._file.read(metadata_length)
+        if metadata.startswith('{'):
+            # written before the metadata block was encoded, which it must be now that keys are binary
+            metadata = json.loads(metadata)
+        else:
+            metadata = wire_protocol.decode(metadata)
+        self._file.seek(bloom_offset)
+        self._bloom_filter = BloomFilter.from_string(self._file.read(bloom_length))
+
+        self._index_keys = [key for key, _ in metadata['index']]
+        self._index_offsets = [offset for _, offset in metadata['index']] + [metadata_offset]
+        self.num_keys = metadata['num_keys']
+        self.merged_table_ids = metadata.get('merged', [])
+        self.size = os.path.getsize(path)
+
+    @classmethod
+    def write(cls, path, records, num_keys, index_interval=64, false_positive_rate=0.01, merged_table_ids=None):
+        """
+        Writes records, an iterable of (key, value, timestamp, flags) sorted by key, into a new SSTable at path.
+            -generator: yields after every index_interval records so large merges can be spread over several calls.
+
+        Args:
+        ----------
+        num_keys (int):
+            expected number of records, used to size the bloom filter.
+        merged_table_ids (list of int, optional):
+            ids of the tables a compaction output replaces, recorded so an interrupted compaction can be finished.
+        """
+        bloom_filter = BloomFilter(num_keys, false_positive_rate)
+        index = []
+        count = 0
+        offset = 0
+        with open(path, 'wb') as f:
+            for key, value, timestamp, flags in records:
+                if count % index_interval == 0:
+                    index.append((key, offset))
+                    yield
+                record = pack_record(key, value, timestamp, flags)
+                f.write(record)
+                bloom_filter.add(key)
+                offset += len(record)
+                count += 1
+
+            metadata = wire_protocol.encode({'index': index, 'num_keys': count, 'merged': merged_table_ids or []})
+            bloom = bloom_filter.to_string()
+            f.write(metadata)
+            f.write(bloom)
+            f.write(TABLE_FOOTER.pack(offset, len(metadata), offset + len(metadata), len(bloom), TABLE_MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self):
+        """ Drops the engine's reference to the table.  The file is closed once no range scan still reads it."""
+        self._release()
+
+    def _release(self):
+        self._references -= 1
+        if self._references == 0:
+            self._file.close()
+
+    def might_contain(self, key):
+        return key in self._bloom_filter
+
+    def _read_block(self, position):
+        start, end = self._index_offsets[position], self._index_offsets[position + 1]
+        self._file.seek(start)
+        return read_records(cStringIO.StringIO(self._file.read(end - start)))
+
+    def get(self, key):
+        """
+        Returns:
+            (value, timestamp, flags) of key's record, None if the table doesn't hold key.
+        """
+        position = bisect.bisect_right(self._index_keys, key) - 1
+        if position < 0:
+            return None
+        for _, _, record_key, value, timestamp, flags in self._read_block(position):
+            if record_key == key:
+                return value, timestamp, flags
+            elif record_key > key:
+                break
+        return None
+
+    def __iter__(self):
+        return self.iter_range()
+
+    def iter_range(self, low=None, high=None):
+        """
+        Yields (key, value, timestamp, flags) for the keys in (low, high] in key order, one index interval read at a time.
+            -the sparse index locates the first block to read, so a scan costs O(log n + k).
+            -holds a reference to the table from its first step until it finishes or is discarded.
+        """
+        self._references += 1
+        try:
+            if low is None:
+                start = 0
+            else:
+                start = max(bisect.bisect_right(self._index_keys, low) - 1, 0)
+            for position in xrange(start, len(self._index_keys)):
+                for _, _, key, value, timestamp, flags in self._read_block(position):
+                    if low is not None and key <= low:
+                        continue
+                    if high is not None and key > high:
+                        return
+                    yield key, value, timestamp, flags
+        finally:
+            self._release()
+
+
+class LSMPersistenceEngine(object):
+    """
+    LSM-tree persistence engine.
+    ----------
+        -put/delete append to a write-ahead log and update the sorted memtable; full memtables are flushed to an SSTable.
+        -get checks the memtable, then SSTables newest first, skipping any table whose bloom filter rules the key out.
+        -keys() comes out sorted, merged across the memtable and every SSTable.
+    """
+
+    def __init__(self, directory, memtable_size=4 * 1024 * 1024, sync_every=100, index_interval=64,
+                 false_positive_rate=0.01, compaction_threshold=4, tier_ratio=2.0, compaction_slice=500,
+                 tombstone_grace_period=24 * 60 * 60):
+        """
+        Args:
+        ----------
+        directory (str):
+            directory holding the write-ahead log and SSTables; created if it doesn't exist.
+        memtable_size (int, optional):
+            bytes of write-ahead log after which the memtable is flushed to an SSTable, defaults to 4MB.
+        sync_every (int, optional):
+            number of writes between fsyncs of the write-ahead log, defaults to 100.
+        index_interval (int, optional):
+            number of records between sparse index entries, defaults to 64.
+        false_positive_rate (float, optional):
+            bloom filter false positive rate per SSTable, defaults to 1%.
+        compaction_threshold (int, optional):
+            number of adjacent SSTables of similar size that triggers a compaction, defaults to 4.
+        tier_ratio (float, optional):
+            maximum size ratio between the tables of one tier, defaults to 2.
+        compaction_slice (int, optional):
+            roughly the number of records merged per call to process(), defaults to 500.
+        tombstone_grace_period (int, optional):
+            seconds a tombstone survives compaction for, defaults to a day.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        self._directory = directory
+        self._memtable_size = memtable_size
+        self._sync_every = sync_every
+        self._index_interval = index_interval
+        self._false_positive_rate = false_positive_rate
+        self._compaction_threshold = compaction_threshold
+        self._tier_ratio = tier_ratio
+        self._compaction_slice = compaction_slice
+        self._tombstone_grace_period = tombstone_grace_period
+
+        # key -> (value, timestamp, flags), plus its keys in sorted order
+        self._memtable = dict()
+        self._memtable_keys = []
+        self._wal = None
+        self._wal_size = 0
+        self._unsynced_writes = 0
+
+        # table_id -> SSTable
+        self._tables = dict()
+        self._next_table_id = 0
+
+        self._compactor = None
+        self._metrics = {
+            'flushes': 0,
+            'compactions': 0,
+            'reclaimed_bytes': 0,
+            'compaction_seconds': 0.0,
+            'last_compaction_seconds': 0.0,
+            'bloom_filter_negatives': 0
+        }
+        # called with (key, timestamp) of each tombstone dropped while it was the key's newest record
+        self.on_tombstone_dropped = None
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self._recover()
+
+    @property
+    def metrics(self):
+        """
+        Returns:
+            dict of counters: memtable flushes, compactions, bytes reclaimed, compaction time and lookups answered by bloom filters.
+        """
+        return dict(self._metrics)
+
+    @property
+    def format_version(self):
+        """ Returns the format version of the data stored, as last set with set_format_version; 0 if it never was."""
+        return read_format_version(self._directory)
+
+    def set_format_version(self, version):
+        """ Records version as the format version of the data stored, e.g. once it has been migrated."""
+        write_format_version(self._directory, version)
+
+    @property
+    def table_ids(self):
+        """ Returns the ids of every SSTable, oldest first."""
+        return sorted(self._tables.keys())
+
+    def _path(self, name_id, suffix):
+        return os.path.join(self._directory, '{:08d}{}'.format(name_id, suffix))
+
+    def _list_ids(self, suffix):
+        ids = []
+        for filename in os.listdir(self._directory):
+            name, file_suffix = os.path.splitext(filename)
+            if file_suffix == suffix and name.isdigit():
+                ids.append(int(name))
+        return sorted(ids)
+
+    def _recover(self):
+        """
+        Loads every SSTable and replays write-ahead logs into the memtable.
+            -a compaction output is installed if it was completely written, and removed otherwise.
+        """
+        for filename in os.listdir(self._directory):
+            if filename.endswith(TABLE_SUFFIX + COMPACTION_SUFFIX):
+                path = os.path.join(self._directory, filename)
+                try:
+                    table = SSTable(path)
+                    table.close()
+                    self._replace_tables(path, table.merged_table_ids)
+                except (ValueError, IOError, struct.error):
+                    self.logger.info('_recover.  removing unfinished compaction {}'.format(filename))
+                    os.remove(path)
+
+        for table_id in self._list_ids(TABLE_SUFFIX):
+            self._tables[table_id] = SSTable(self._path(table_id, TABLE_SUFFIX))
+            self._next_table_id = table_id + 1
+
+        wal_ids = self._list_ids(WAL_SUFFIX)
+        self.logger.info('_recover.  {} tables, replaying {} write-ahead logs'.format(len(self._tables), len(wal_ids)))
+        for wal_id in wal_ids:
+            with open(self._path(wal_id, WAL_SUFFIX), 'rb') as f:
+                for _, _, key, value, timestamp, flags in read_records(f):
+                    self._apply(key, value, timestamp, flags)
+
+        # a replayed memtable goes straight to disk so that only one write-ahead log is ever live
+        if self._memtable:
+            self._flush()
+        for wal_id in wal_ids:
+            os.remove(self._path(wal_id, WAL_SUFFIX))
+        self._open_wal()
+
+    def _open_wal(self):
+        self._wal = open(self._path(self._next_table_id, WAL_SUFFIX), 'ab')
+        self._wal_size = 0
+
+    def _replace_tables(self, compaction_path, merged_table_ids):
+        for table_id in merged_table_ids[:-1]:
+            if os.path.exists(self._path(table_id, TABLE_SUFFIX)):
+                os.remove(self._path(table_id, TABLE_SUFFIX))
+        os.rename(compaction_path, self._path(merged_table_ids[-1], TABLE_SUFFIX))
+
+    def _apply(self, key, value, timestamp, flags):
+        if key not in self._memtable:
+            bisect.insort(self._memtable_keys, key)
+        self._memtable[key] = (value, timestamp, flags)
+
+    def _write(self, key, value, timestamp, flags):
+        record = pack_record(key, value, timestamp, flags)
+        self._wal.write(record)
+        self._wal_size += len(record)
+        self._unsynced_writes += 1
+        if self._unsynced_writes >= self._sync_every:
+            self.sync()
+
+        self._apply(key, value, timestamp, flags)
+        if self._wal_size >= self._memtable_size:
+            self._flush()
+            self._rotate_wal()
+
+    def _rotate_wal(self):
+        old_wal_path = self._wal.name
+        self._wal.close()
+        self._unsynced_writes = 0
+        self._open_wal()
+        os.remove(old_wal_path)
+
+    def _flush(self):
+        """ Writes the memtable to a new SSTable and empties it."""
+        table_id = self._next_table_id
+        self._next_table_id += 1
+        path = self._path(table_id, TABLE_SUFFIX)
+        records = ((key,) + self._memtable[key] for key in self._memtable_keys)
+        for _ in SSTable.write(path, records, len(self._memtable_keys), self._index_interval, self._false_positive_rate):
+            pass
+        self._tables[table_id] = SSTable(path)
+        self._memtable = dict()
+        self._memtable_keys = []
+        self._metrics['flushes'] += 1
+        self.logger.debug('_flush.  flushed memtable to table {}'.format(table_id))
+
+    def sync(self):
+        """ Flushes and fsyncs the write-ahead log."""
+        if self._wal and self._unsynced_writes:
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+        self._unsynced_writes = 0
+
+    def close(self):
+        """ Syncs the write-ahead log and closes every open file.  The memtable is rebuilt from the log on reopening."""
+        self.sync()
+        if self._wal:
+            self._wal.close()
+            self._wal = None
+        for table in self._tables.values():
+            table.close()
+        self._tables = dict()
+
+    def _lookup(self, key):
+        """
+        Returns:
+            (value, timestamp, flags) of the newest record for key, None if there is none.
+        """
+        if key in self._memtable:
+            return self._memtable[key]
+
+        checked_disk = False
+        for table_id in reversed(self.table_ids):
+            table = self._tables[table_id]
+            if not table.might_contain(key):
+                continue
+            checked_disk = True
+            record = table.get(key)
+            if record:
+                return record
+
+        if not checked_disk:
+            self._metrics['bloom_filter_negatives'] += 1
+        return None
+
+    @staticmethod
+    def _ranked(records, rank):
+        for record in records:
+            yield (record[0], rank) + tuple(record[1:])
+
+    def _iter_records(self, table_ids=None, include_memtable=True, low=None, high=None):
+        """
+        Yields (key, value, timestamp, flags) for keys in (low, high] in key order, merged across tables (and the memtable),
+        newest record per key.
+            -the tables are those live at the first step; a compaction finishing mid-scan leaves them open until it ends.
+        """
+        if table_ids is None:
+            table_ids = self.table_ids
+        sources = []
+        if include_memtable:
+            memtable = self._memtable
+            start = 0 if low is None else bisect.bisect_right(self._memtable_keys, low)
+            end = len(self._memtable_keys) if high is None else bisect.bisect_right(self._memtable_keys, high)
+            sources.append(self._ranked(((key,) + memtable[key] for key in self._memtable_keys[start:end]), -1))
+        for rank, table_id in enumerate(reversed(table_ids)):
+            sources.append(self._ranked(self._tables[table_id].iter_range(low, high), rank))
+
+        # among equal keys the lowest rank, i.e. the newest source, comes out first
+        previous_key = None
+        for key, _, value, timestamp, flags in heapq.merge(*sources):
+            if key == previous_key:
+                continue
+            previous_key = key
+            yield key, value, timestamp, flags
+
+    def keys(self):
+        """ Returns the live keys in sorted order."""
+        return [key for key, _, _, flags in self._iter_records() if flags != FLAG_TOMBSTONE]
+
+    def sorted_keys(self):
+        """ Returns the live keys in sorted order.  Same as keys(), which is already sorted."""
+        return self.keys()
+
+    def iter_keys(self, low=None, high=None):
+        """ Lazily yields the live keys in (low, high] in sorted order."""
+        for key, _, _, flags in self._iter_records(low=low, high=high):
+            if flags != FLAG_TOMBSTONE:
+                yield key
+
+    def iter_items(self, low=None, high=None):
+        """ Lazily yields (key, value, timestamp) for the live keys in (low, high] in sorted order."""
+        for key, value, timestamp, flags in self._iter_records(low=low, high=high):
+            if flags != FLAG_TOMBSTONE:
+                yield key, value, timestamp
+
+    def iter_tombstones(self, low=None, high=None):
+        """ Lazily yields (key, timestamp of the delete) for the deleted keys in (low, high] in sorted order."""
+        for key, _, timestamp, flags in self._iter_records(low=low, high=high):
+            if flags == FLAG_TOMBSTONE:
+                yield key, timestamp
+
+    def put(self, key, value, timestamp):
+        """ Put key value pair into storage"""
+        self._write(key, value, timestamp, FLAG_PUT)
+        return True
+
+    def get(self, key):
+        """
+        Get key's value
+
+        Raises:
+            DeletedKeyError, a KeyError, if key's newest record is a tombstone.
+        """
+        record = self._lookup(key)
+        if record is None:
+            raise KeyError(key)
+        if record[2] == FLAG_TOMBSTONE:
+            raise DeletedKeyError(key, record[1])
+        return record[0], record[1]
+
+    def delete(self, key, timestamp=None):
+        """
+        Delete key value pair, leaving a tombstone with timestamp, the current time if not given.
+
+        Raises:
+            KeyError if key isn't live and no timestamp is given.  a delete with a timestamp writes its tombstone
+            either way, so a replica that never held key still orders it against later versions.
+        """
+        if timestamp is None:
+            record = self._lookup(key)
+            if record is None or record[2] == FLAG_TOMBSTONE:
+                raise KeyError(key)
+            timestamp = util.current_time()
+        self._write(key, None, timestamp, FLAG_TOMBSTONE)
+        return True
+
+    def process(self):
+        """
+        Steps the background compactor through one slice of work, starting a compaction when a tier fills up.
+
+        Returns:
+            True if a compaction is in progress, False otherwise.
+        """
+        if self._compactor is None:
+            table_ids = self._pick_compaction()
+            if not table_ids:
+                return False
+            self._compactor = self._compact(table_ids)
+
+        start = time.time()
+        try:
+            next(self._compactor)
+        except StopIteration:
+            self._compactor = None
+        except:
+            self.logger.error('process.  compaction failed', exc_info=True)
+            self._compactor = None
+        self._metrics['compaction_seconds'] += time.time() - start
+        return self._compactor is not None
+
+    def _pick_compaction(self):
+        """
+        Returns:
+            the ids of the oldest run of compaction_threshold adjacent tables whose sizes are within tier_ratio of each other.
+            only adjacent tables are merged, so the output can take the newest input's place in the age order.
+        """
+        table_ids = self.table_ids
+        for start in xrange(len(table_ids) - self._compaction_threshold + 1):
+            window = table_ids[start:start + self._compaction_threshold]
+            sizes = [self._tables[table_id].size for table_id in window]
+            if max(sizes) <= self._tier_ratio * min(sizes):
+                return window
+        return None
+
+    def _tombstone_expired(self, timestamp):
+        return timestamp is None or util.add_time(timestamp, self._tombstone_grace_period) < util.current_time()
+
+    def _drop_expired_tombstones(self, records, dropped_tombstones):
+        """ Filters the expired tombstones out of records, appending (key, timestamp) of each to dropped_tombstones."""
+        for record in records:
+            if record[3] == FLAG_TOMBSTONE and self._tombstone_expired(record[2]):
+                dropped_tombstones.append((record[0], record[2]))
+            else:
+                yield record
+
+    def _notify_dropped_tombstones(self, dropped_tombstones):
+        """
+        Calls on_tombstone_dropped for the dropped tombstones that were their key's newest record, i.e. that no newer
+        table or the memtable shadows.
+        """
+        if not self.on_tombstone_dropped:
+            return
+        for key, timestamp in dropped_tombstones:
+            if timestamp is None or self._lookup(key) is not None:
+                continue
+            self.on_tombstone_dropped(key, timestamp)
+
+    def _compact(self, table_ids):
+        """
+        Generator merging table_ids into one SSTable that takes the newest input's id, yielding every compaction_slice records or so.
+            -tombstones past the grace period are dropped when the run includes the oldest table, as there is nothing
+             older left for them to shadow.  younger ones are kept to order the delete against versions replicas send later.
+        """
+        self.logger.info('_compact.  compacting tables {}'.format(table_ids))
+        start = time.time()
+        drop_tombstones = table_ids[0] == self.table_ids[0]
+        records = self._iter_records(table_ids, include_memtable=False)
+        dropped_tombstones = []
+        if drop_tombstones:
+            records = self._drop_expired_tombstones(records, dropped_tombstones)
+
+        compaction_path = self._path(table_ids[-1], TABLE_SUFFIX) + COMPACTION_SUFFIX
+        num_keys = sum(self._tables[table_id].num_keys for table_id in table_ids)
+        merged = 0
+        try:
+            for _ in SSTable.write(compaction_path, records, num_keys, self._index_interval, self._false_positive_rate, merged_table_ids=table_ids):
+                merged += self._index_interval
+                if merged >= self._compaction_slice:
+                    merged = 0
+                    yield
+        except:
+            if os.path.exists(compaction_path):
+                os.remove(compaction_path)
+            raise
+
+        old_size = 0
+        for table_id in table_ids:
+            table = self._tables.pop(table_id)
+            old_size += table.size
+            table.close()
+        self._replace_tables(compaction_path, table_ids)
+        self._tables[table_ids[-1]] = SSTable(self._path(table_ids[-1], TABLE_SUFFIX))
+        self._notify_dropped_tombstones(dropped_tombstones)
+
+        elapsed = time.time() - start
+        self._metrics['compactions'] += 1
+        self._metrics['reclaimed_bytes'] += old_size - self._tables[table_ids[-1]].size
+        self._metrics['last_compaction_seconds'] = elapsed
+        self.logger.info('_compact.  merged tables {} in {:.3f}s'.format(table_ids, elapsed))
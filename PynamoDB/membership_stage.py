@@ -5,99 +5,184 @@ import collections
 import pprint
 import random
 import bisect
+import math
 import sys
 
+# seconds between membership checks with a random node
+MEMBERSHIP_CHECK_INTERVAL = 1
+# seconds a node's contact failures are remembered, extended by each new failure
+CONTACT_FAILURE_TIMEOUT = 10
+# contact failures after which a node is treated as failed and its ranges repaired
+MAX_CONTACT_FAILURES = 3
+# depth of the Merkle tree of each replicated range with one token per node; more tokens get shallower trees
+MERKLE_TREE_DEPTH = 10
+
 class MembershipStage(object):
-    """ Stage for managing ring membeship and failure detection."""
+    """
+    Stage for managing ring membeship and failure detection.
+        -membership checks, anti-entropy, hint replay and the expiry of contact failures run on timers on the server's
+         timer wheel, the periodic ones starting wait_time seconds after start up.
+        -with vnodes, a node replicates many small ranges (low, high] between consecutive tokens of the ring; when a
+         node fails, each of its ranges is streamed to the node taking it over by the first surviving replica of the
+         range, so the repair is spread over the cluster.
+    """
 
-    def __init__(self, server = None,  node_addresses=[], wait_time=30):
+    def __init__(self, server = None,  node_addresses=[], wait_time=30, anti_entropy_interval=10, hint_replay_interval=5, vnodes=1, node_weights=None):
+        """
+        Args:
+        ----------
+        server : PynamoServer object.
+            object through which internal stages can be accessed.
+        node_addresses : list of str
+            'hostname,external_port,internal_port' of every node in the ring.
+        wait_time : int, optional
+            seconds after start up before the periodic checks start, defaults to 30.
+        anti_entropy_interval, hint_replay_interval : int, optional
+            seconds between anti-entropy exchanges and between hint replays, default to 10 and 5.
+        vnodes : int, optional
+            tokens per node of weight 1.0 on the ring, defaults to 1.
+        node_weights : dict, optional
+            node address -> weight, scaling the node's tokens and share of the keys.  nodes not in it have weight 1.0.
+        """
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.debug('__init__')
 
         self._server = server
         self._wait_time = wait_time
+        self._anti_entropy_interval = anti_entropy_interval
+        self._hint_replay_interval = hint_replay_interval
+        # ring the persistence stage's Merkle trees were last built for
+        self._merkle_tree_node_hashes = None
         self._node_lookup = {util.get_hash(str(node_address)) : node_address for node_address in node_addresses}
-        self._consistent_hash_ring = ConsistentHashRing(node_hashes = sorted(self._node_lookup.keys()))
+        weights = {util.get_hash(str(node_address)): weight for node_address, weight in (node_weights or {}).items()}
+        self._consistent_hash_ring = ConsistentHashRing(node_hashes = sorted(self._node_lookup.keys()), num_replicas=self._server.num_replicas, vnodes=vnodes, weights=weights)
+        self._ring_version = self._compute_ring_version()
 
         self.logger.debug('__init__.  node_lookup: {}'.format(self._node_lookup))
 
         self._failed_to_contact_node_hashes = collections.defaultdict(dict)
 
-        self._processor = self._handle_membership_checks()
-
-
+        timer_wheel = self._server.timer_wheel
+        timer_wheel.schedule(self._wait_time, self._periodic, self._handle_membership_check, MEMBERSHIP_CHECK_INTERVAL)
+        timer_wheel.schedule(self._wait_time, self._periodic, self._handle_anti_entropy, self._anti_entropy_interval)
+        timer_wheel.schedule(self._wait_time, self._periodic, self._handle_hint_replay, self._hint_replay_interval)
 
     @property
     def node_hashes(self):
         return self._consistent_hash_ring.hash_ring
 
+    @property
+    def ring_version(self):
+        """ Returns a short digest of the ring membership; nodes with the same view of the ring report the same version."""
+        return self._ring_version
+
+    @property
+    def vnodes(self):
+        return self._consistent_hash_ring.vnodes
+
+    @property
+    def node_weights(self):
+        """ Returns a dict of node_hash -> weight for the nodes whose weight isn't 1.0."""
+        return self._consistent_hash_ring.weights
+
+    def _compute_ring_version(self):
+        return util.get_hash(','.join(str(token) for token in self._consistent_hash_ring.tokens))[:16]
+
+    def ring_addresses(self):
+        """ Returns a dict of node_hash -> 'hostname,external_port,internal_port' for every node in the ring."""
+        return {node_hash: self._node_lookup[node_hash] for node_hash in self.node_hashes}
+
     def remove_node_hash(self, node_hash):
         success = self._consistent_hash_ring.remove_node_hash(node_hash)
         self._server.num_nodes = len(self.node_hashes)
+        self._ring_version = self._compute_ring_version()
         return success
 
-    @util.coroutine
-    def _handle_membership_checks(self):
-        self.logger.debug('_handle_membership_checks')
-        next_check_time = util.add_time(util.current_time(), self._wait_time)
-
-        while True:
-            # handle failures
-            try:
-                to_be_removed = []
-                for node_hash in self._failed_to_contact_node_hashes:
-                    count = self._failed_to_contact_node_hashes[node_hash]['count']
-                    if count >= 3:
-                        if node_hash in self.node_hashes:
-                            self._server.internal_request_stage.handle_unannounced_failure(failure_node_hash=node_hash)
-                        to_be_removed.append(node_hash)
-                # flush stale contact failures
-                for node_hash in self._failed_to_contact_node_hashes:
-                    timeout = self._failed_to_contact_node_hashes[node_hash]['timeout']
-                    if util.current_time() > timeout:
-                        to_be_removed.append(node_hash)
-
-                for node_hash in list(set(to_be_removed)):
-                    try:
-                        del self._failed_to_contact_node_hashes[node_hash]
-                    except:
-                        pass
-
-                # retry contacting failure node hashes:
-                for node_hash in self._failed_to_contact_node_hashes:
-                    if util.current_time() > self._failed_to_contact_node_hashes[node_hash]['timeout']:
-                        self._server.internal_request_stage.handle_membership_check(gossip_node_hash=node_hash)
-
-                if util.current_time() > next_check_time:
-                    self._server.internal_request_stage.handle_membership_check()
-                    next_check_time = util.add_time(util.current_time(), 1)
-                    yield
-                else:
-                    yield
-            except Exception as e:
-                self.logger.error('_handle_membership_checks error: {}, {}'.format(e, sys.exc_info()))
+    def _periodic(self, handler, interval):
+        """
+        Runs handler, then schedules the next run interval seconds later.
+        """
+        try:
+            handler()
+        except Exception as e:
+            self.logger.error('_periodic.  {} error: {}, {}'.format(handler.__name__, e, sys.exc_info()))
+        self._server.timer_wheel.schedule(interval, self._periodic, handler, interval)
+
+    def _handle_membership_check(self):
+        self._server.internal_request_stage.handle_membership_check()
+
+    def _handle_anti_entropy(self):
+        """
+        Rebuilds the Merkle trees if the ring changed since they were built, otherwise syncs one random replicated
+        hash range with one of its other replicas.
+        """
+        node_hashes = tuple(self.node_hashes)
+        if node_hashes != self._merkle_tree_node_hashes:
+            self.logger.info('_handle_anti_entropy.  ring changed, rebuilding Merkle trees')
+            # shallower trees with more tokens per node keep the leaves held in all about the same.  the depth only
+            # depends on the ring, so every replica of a range builds the same tree for it
+            tokens_per_node = len(self._consistent_hash_ring.tokens) / float(max(1, len(node_hashes)))
+            depth = MERKLE_TREE_DEPTH - int(math.log(max(1.0, tokens_per_node), 2))
+            self._server.persistence_stage.rebuild_merkle_trees(self.replicated_ranges(), depth=max(2, depth))
+            self._merkle_tree_node_hashes = node_hashes
+            return
+
+        ranges = self.replicated_ranges()
+        if not ranges:
+            return
+        low, high = random.choice(ranges)
+        peer_node_hashes = [node_hash for node_hash in self._consistent_hash_ring.token_node_hashes(high) if node_hash != self._server.node_hash]
+        if peer_node_hashes:
+            self._server.internal_request_stage.handle_anti_entropy(node_hash=random.choice(peer_node_hashes), low=low, high=high)
+
+    def _handle_hint_replay(self):
+        """
+        Hands off the hints held for every node that is reachable again, i.e. still in the ring with no recent contact
+        failures.  hints for nodes that have left the ring are dropped, as their ranges were re-replicated on removal.
+        """
+        hint_store = self._server.persistence_stage.hint_store
+        for node_hash in hint_store.node_hashes:
+            if node_hash not in self.node_hashes:
+                self.logger.info('_handle_hint_replay.  {} left the ring, dropping its hints'.format(node_hash))
+                hint_store.discard(node_hash)
+            elif node_hash not in self._failed_to_contact_node_hashes:
+                self._server.internal_request_stage.handle_hint_replay(node_hash=node_hash)
 
     def process(self):
+        """
+        Kept for the server's processing cycle; the stage's work runs on timers.
+        """
         self.logger.debug('process')
-        return self._processor.next()
+        return True
 
     def report_contact_failure(self, node_hash=None):
+        """
+        Records a failure to contact node_hash.
+            -after MAX_CONTACT_FAILURES failures, repair of node_hash's ranges is started if it is still in the ring.
+            -failures are forgotten once CONTACT_FAILURE_TIMEOUT seconds pass without another one, or are extended by
+             that much by each new one.
+        """
         self.logger.debug('report_contact_failure')
-        try:
-            self._failed_to_contact_node_hashes[node_hash]['count'] += 1
-        except:
-            self._failed_to_contact_node_hashes[node_hash]['count'] = 1
+        failure = self._failed_to_contact_node_hashes[node_hash]
+        failure['count'] = failure.get('count', 0) + 1
 
+        if failure['count'] >= MAX_CONTACT_FAILURES:
+            self._forget_contact_failures(node_hash)
+            if node_hash in self.node_hashes:
+                self._server.internal_request_stage.handle_unannounced_failure(failure_node_hash=node_hash)
+            return
 
-        try:
-            timeout = self._failed_to_contact_node_hashes[node_hash]['timeout']
-            new_timeout = util.add_time(timeout, 10)
-        except:
-            new_timeout = util.add_time(util.current_time(), 10)
-        finally:
-            self._failed_to_contact_node_hashes[node_hash]['timeout'] = new_timeout
+        if 'timer' in failure:
+            delay = failure['timer'].deadline - self._server.timer_wheel.time() + CONTACT_FAILURE_TIMEOUT
+            failure['timer'].cancel()
+        else:
+            delay = CONTACT_FAILURE_TIMEOUT
+        failure['timer'] = self._server.timer_wheel.schedule(delay, self._forget_contact_failures, node_hash)
 
-        self._failed_to_contact_node_hashes[node_hash]['next_check_time'] = util.add_time(util.current_time(), 1)
+    def _forget_contact_failures(self, node_hash):
+        failure = self._failed_to_contact_node_hashes.pop(node_hash, None)
+        if failure and 'timer' in failure:
+            failure['timer'].cancel()
 
     def node_address(self, node_hash=None):
         """ Returns the  address of a node identified by its hash value in the node ring."""
@@ -107,9 +192,18 @@ class MembershipStage(object):
 
     def get_responsible_node_hashes(self, *args, **kwargs):
         """ Returns num_replicas number of node_hashes responsible for the key"""
-        self.logger.debug('get_responsible_node_hashes')
         return self._consistent_hash_ring.get_responsible_node_hashes(*args, **kwargs)
 
+    def get_handoff_node_hash(self, key_hash, exclude=()):
+        """
+        Returns:
+            the first node clockwise of key_hash that isn't in exclude and hasn't failed to respond recently, None if there
+            is no such node.  used to hold hinted writes for unreachable replicas.
+        """
+        for node_hash in self._consistent_hash_ring.clockwise_node_hashes(key_hash):
+            if node_hash not in exclude and node_hash not in self._failed_to_contact_node_hashes:
+                return node_hash
+
     def get_gossip_node_hashes(self, num_gossip_nodes):
         """ Returns num_replicas number of random node_hashes for gossip protocol """
         active_node_hashes = self.node_hashes
@@ -119,17 +213,46 @@ class MembershipStage(object):
             gossip_node_hashes = random.sample(active_node_hashes, len(active_node_hashes))
         return gossip_node_hashes
 
+    def _failure_diff(self, node_hash):
+        """
+        Returns:
+            ConsistentHashRing.diff of the ring with the ring once node_hash has left: (range, old_node_hashes,
+            new_node_hashes) for each range (low, high] whose replicas change.
+        """
+        ring = self._consistent_hash_ring
+        return ring.diff(ring.without_node_hash(node_hash))
+
     def get_unannounced_failure_repair_node_hashes(self, failure_node_hash=None):
+        """ Returns the nodes sharing a range with failure_node_hash, i.e. those that may have to stream its ranges."""
         self.logger.debug('get_unannounced_failure_repair_node_hashes')
-        try:
-            node_hashes = self.node_hashes
-            num_replicas = self._server.num_replicas
-            failure_node_hash_index = node_hashes.index(failure_node_hash)
-            repair_node_hashes = [node_hashes[i%len(node_hashes)] for i in xrange(failure_node_hash_index-num_replicas+1, failure_node_hash_index+num_replicas)]
-            repair_node_hashes.remove(failure_node_hash)
-        except:
-            pass
-        return repair_node_hashes
+        repair_node_hashes = set()
+        for _, old_node_hashes, _ in self._failure_diff(failure_node_hash):
+            repair_node_hashes.update(old_node_hashes)
+        repair_node_hashes.discard(failure_node_hash)
+        return sorted(repair_node_hashes)
+
+    def _partition_ranges(self):
+        """ Returns:
+                a dict() where:
+                    key: node_hashes
+                    value: list of the hash ranges (low, high] for which the given node_hash is the primary responsible
+                    node, one per token.  the first range of the ring wraps around its end.
+        """
+        ring = self._consistent_hash_ring
+        partition_ranges = collections.defaultdict(list)
+        for index, bounds in enumerate(ring.ranges()):
+            partition_ranges[ring.preference_list(index)[0]].append(bounds)
+        return partition_ranges
+
+    def replicated_ranges(self, node_hash=None):
+        """ Returns:
+                list of the hash ranges (low, high] node_hash holds a replica of, i.e. those it is among the
+                num_replicas nodes responsible for.
+        """
+        if not node_hash:
+            node_hash = self._server.node_hash
+        ring = self._consistent_hash_ring
+        return [bounds for index, bounds in enumerate(ring.ranges()) if node_hash in ring.preference_list(index)]
 
     def _partition_keys(self):
         """ Returns:
@@ -137,17 +260,9 @@ class MembershipStage(object):
                     key: node_hashes
                     value: list of keys for which the given node_hash is responsible
         """
-        keys = sorted(self._server.persistence_stage.keys())
-        partition = dict()
-        left_bound = 0
-        for node_hash in  self.node_hashes:
-            right_bound = bisect.bisect_left(keys, node_hash)
-            partition[node_hash] = keys[left_bound:right_bound]
-            left_bound = right_bound
-        else:
-            partition[self.node_hashes[0]] += keys[right_bound:]
-
-        return partition
+        persistence_stage = self._server.persistence_stage
+        return {node_hash: [key for low, high in ranges for key in persistence_stage.keys_in_range(low, high)]
+                for node_hash, ranges in self._partition_ranges().items()}
 
     def key_value_partition(self):
         """ Returns:
@@ -155,28 +270,34 @@ class MembershipStage(object):
                     key: node_hashes
                     value: dict of {key: values} for which the given node_hash is responsible
         """
-        key_partition = self._partition_keys()
+        persistence_stage = self._server.persistence_stage
         key_value_partition = collections.defaultdict(dict)
-        for node_hash in key_partition:
-            for key in key_partition[node_hash]:
-                reply = self._server.persistence_stage.get(key)
-                key_value_partition[node_hash][key] = {'value': reply['value'], 'timestamp': reply['timestamp']}
+        for node_hash, ranges in self._partition_ranges().items():
+            for low, high in ranges:
+                for key, value, timestamp in persistence_stage.items_in_range(low, high):
+                    key_value_partition[node_hash][key] = {'value': value, 'timestamp': timestamp}
 
         return key_value_partition
 
-    def _partition_for_failure(self, node_hash=None):
+    def _partition_for_failure(self, node_hash=None, source_node_hash=None):
+        """ Returns:
+                a dict() where:
+                    key: node_hashes that become responsible for new hash ranges once node_hash leaves the ring
+                    value: list of the hash ranges (low, high] each of them takes over
+                computed on the current ring, so call before removing node_hash.  only the ranges whose replicas change
+                are included, so a repair streams the keys of those ranges and no others.
+                if source_node_hash is given, only the ranges it is to stream are included: those it is the first
+                surviving replica of.
+        """
         if not node_hash:
             node_hash = self._server.node_hash
-        index_self = self.node_hashes.index(node_hash)
-        num_replicas = self._server.num_replicas
-        old_partition = self.key_value_partition()
-        new_partition = dict()
-        for offset in xrange(1-num_replicas, 1):
-            index_old = index_self + offset
-            index_new = (index_self + offset + num_replicas) % len(self.node_hashes)
-
-            old_responsible_node_hash = self.node_hashes[index_old]
-            new_reponsible_node_hash = self.node_hashes[index_new]
-            new_partition[new_reponsible_node_hash] = old_partition[old_responsible_node_hash]
+        new_partition = collections.defaultdict(list)
+        for bounds, old_node_hashes, new_node_hashes in self._failure_diff(node_hash):
+            survivors = [old_node_hash for old_node_hash in old_node_hashes if old_node_hash != node_hash]
+            if source_node_hash and (not survivors or survivors[0] != source_node_hash):
+                continue
+            for new_node_hash in new_node_hashes:
+                if new_node_hash not in old_node_hashes:
+                    new_partition[new_node_hash].append(bounds)
 
         return new_partition
@@ -0,0 +1,106 @@
+"""
+    merkle_tree.py
+    ~~~~~~~~~~~~
+    Implements MerkleTree, a hash tree over the keys of one hash range used for anti-entropy between replicas.
+"""
+
+import hashlib
+
+import util
+
+RING_SIZE = 2 ** util.TOKEN_BITS
+
+
+def key_digest(key, timestamp):
+    """ Returns the 128-bit digest a (key, timestamp) version contributes to its leaf."""
+    return int(hashlib.md5('{}:{}'.format(key, timestamp)).hexdigest(), 16)
+
+
+class MerkleTree(object):
+    """
+    Fixed-depth hash tree over the hash range (low, high].
+    ----------
+        -the range is split into 2**depth equal leaves; a key belongs to the leaf its token falls into.
+        -each node's digest is the XOR of key_digest(key, timestamp) over every key below it, so a put or delete
+         updates one node per level in O(depth), and two replicas holding the same versions have identical trees.
+         a deleted key contributes the timestamp of its tombstone.
+        -nodes are addressed by (level, index): level 0 is the root, level depth holds the leaves.
+    """
+
+    def __init__(self, low, high, depth=10):
+        """
+        Args:
+        ----------
+        low, high (int):
+            tokens bounding the hash range (low, high]; the range wraps around the ring if low >= high.
+        depth (int, optional):
+            number of levels below the root, defaults to 10 (1024 leaves).
+        """
+        self.low = low
+        self.high = high
+        self.depth = depth
+        self._low = low
+        self._span = (high - low) % RING_SIZE or RING_SIZE
+        self._num_leaves = 2 ** depth
+        self._levels = [[0] * (2 ** level) for level in xrange(depth + 1)]
+
+    @property
+    def root(self):
+        return self._levels[0][0]
+
+    def _offset(self, key):
+        return (util.key_token(key) - self._low) % RING_SIZE or RING_SIZE
+
+    def __contains__(self, key):
+        return self._offset(key) <= self._span
+
+    def leaf_index(self, key):
+        return (self._offset(key) - 1) * self._num_leaves // self._span
+
+    def leaf_range(self, index):
+        """
+        Returns:
+            the hash range (low, high] covered by leaf index, as tokens.
+        """
+        def boundary(i):
+            return (self._low + -(-i * self._span // self._num_leaves)) % RING_SIZE
+        return boundary(index), boundary(index + 1)
+
+    def update(self, key, old_timestamp=None, new_timestamp=None):
+        """
+        Replaces key's old version with its new one, a delete's being its tombstone's.  None stands for no version,
+        i.e. an insert, or a tombstone dropped.
+        """
+        delta = 0
+        if old_timestamp is not None:
+            delta ^= key_digest(key, old_timestamp)
+        if new_timestamp is not None:
+            delta ^= key_digest(key, new_timestamp)
+        if not delta:
+            return
+
+        index = self.leaf_index(key)
+        for level in xrange(self.depth, -1, -1):
+            self._levels[level][index] ^= delta
+            index >>= 1
+
+    def digests(self, level, indices):
+        """
+        Returns:
+            dict of index -> hex digest for the nodes at level.
+        """
+        nodes = self._levels[level]
+        return {index: '{:x}'.format(nodes[index]) for index in indices}
+
+    def differing(self, level, digests):
+        """
+        Returns:
+            sorted list of the indices whose digest at level differs from those given.
+        """
+        nodes = self._levels[level]
+        return sorted(int(index) for index, digest in digests.items() if '{:x}'.format(nodes[int(index)]) != digest)
+
+    @staticmethod
+    def children(indices):
+        """ Returns the indices of the children of the given nodes, one level down."""
+        return [child for index in indices for child in (2 * index, 2 * index + 1)]
@@ -0,0 +1,90 @@
+"""
+    partitioner.py
+    ~~~~~~~~~~~~
+    Partitioners hash keys to the binary key hashes they are stored and placed on the ring under.  a cluster uses one
+    partitioner for its whole life: servers exchange its name with ring membership and hand it to clients with the
+    ring, so every node and client places a key on the same token.
+
+    sha256, the default, is the partitioner of clusters that predate the choice, and stays the default so they keep
+    their placement: it is not the fast choice.  placement only needs keys spread evenly over the ring, so the others
+    serve as well at a fraction of the cost:
+        -'md5': always available, the fallback without extra packages, e.g. on python 2.7.  about twice sha256's
+        throughput on short keys and two to three times on 1KB keys.
+        -'xxh3': xxHash's XXH3 128-bit hash, if the xxhash package (>= 2.0) is installed.
+        -'murmur3': MurmurHash3 x64 128-bit, as in Cassandra's Murmur3Partitioner, if the mmh3 package is installed.
+        -'blake2b': BLAKE2b truncated to 128 bits, from hashlib on python 3.6+ or the pyblake2 package.  on short keys
+        it is slower than sha256.
+"""
+
+import hashlib
+
+import util
+
+DEFAULT_PARTITIONER = 'sha256'
+
+
+class Partitioner(object):
+    """
+    Named hash function from keys to util.KEY_HASH_BYTES-byte binary key hashes.
+    """
+
+    def __init__(self, name, key_hash):
+        """
+        Args:
+        ----------
+        name (str):
+            name the partitioner is recorded under in ring metadata.
+        key_hash (function):
+            returns the util.KEY_HASH_BYTES-byte binary hash of a key.
+        """
+        self.name = name
+        self.key_hash = key_hash
+
+    def __repr__(self):
+        return 'Partitioner({!r})'.format(self.name)
+
+
+def _md5(value):
+    return hashlib.md5(value).digest()
+
+PARTITIONERS = {
+    'sha256': Partitioner('sha256', util.get_key_hash),
+    'md5': Partitioner('md5', _md5)
+}
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+if xxhash is not None and hasattr(xxhash, 'xxh3_128_digest'):
+    PARTITIONERS['xxh3'] = Partitioner('xxh3', xxhash.xxh3_128_digest)
+
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+if mmh3 is not None:
+    PARTITIONERS['murmur3'] = Partitioner('murmur3', mmh3.hash_bytes)
+
+_blake2b = getattr(hashlib, 'blake2b', None)
+if _blake2b is None:
+    try:
+        from pyblake2 import blake2b as _blake2b
+    except ImportError:
+        _blake2b = None
+if _blake2b is not None:
+    PARTITIONERS['blake2b'] = Partitioner('blake2b', lambda value: _blake2b(value, digest_size=util.KEY_HASH_BYTES).digest())
+
+
+def get_partitioner(name=DEFAULT_PARTITIONER):
+    """
+    Returns:
+        the Partitioner called name.
+
+    Raises:
+        ValueError if there is no such partitioner, or its package isn't installed.
+    """
+    try:
+        return PARTITIONERS[name]
+    except KeyError:
+        raise ValueError('unknown or unavailable partitioner {!r}, available: {}'.format(name, ', '.join(sorted(PARTITIONERS))))
@@ -4,26 +4,136 @@
     Implements put, get, delete methods for PersistenceStage.  Using an actual persistence engine (i.e. MySQL, BDB), one would implement the three methods themselves.
     """
 
+import heapq
+
+import util
+from sorted_index import SortedKeyIndex
+
+
+class DeletedKeyError(KeyError):
+    """ Raised by an engine's get for a key whose newest record is a tombstone, with the timestamp of the delete."""
+
+    def __init__(self, key, timestamp):
+        KeyError.__init__(self, key)
+        self.timestamp = timestamp
+
 
 class PersistenceEngine(object):
-    """ Basic persistence engine implemented as a regular Python dict."""
+    """
+    Basic persistence engine implemented as a regular Python dict, with a sorted index of its keys for range scans.
+        -deletes given a timestamp leave a tombstone, so the delete can be ordered against other versions of the key.
+        -process() purges tombstones older than tombstone_grace_period, purge_slice per call, calling
+         on_tombstone_dropped(key, timestamp), if set, for each.
+    """
 
-    def __init__(self):
+    def __init__(self, tombstone_grace_period=24 * 60 * 60, purge_slice=500):
+        """
+        Args:
+        ----------
+        tombstone_grace_period (int, optional):
+            seconds a tombstone is kept for, defaults to a day.
+        purge_slice (int, optional):
+            maximum number of tombstones process() purges per call, defaults to 500.
+        """
+        self._tombstone_grace_period = tombstone_grace_period
+        self._purge_slice = purge_slice
         self._persistence = dict()
+        self._sorted_keys = SortedKeyIndex()
+        # key -> timestamp of its delete, plus its keys in sorted order
+        self._tombstones = dict()
+        self._sorted_tombstones = SortedKeyIndex()
+        # heap of (timestamp, key) of the tombstones written, oldest first; entries for tombstones since replaced or
+        # removed are skipped when popped
+        self._tombstone_heap = []
+        self._metrics = {
+            'dropped_tombstones': 0
+        }
+        # called with (key, timestamp) of each tombstone purged while it was the key's newest record
+        self.on_tombstone_dropped = None
+
+    @property
+    def metrics(self):
+        return dict(self._metrics)
 
     def keys(self):
         return self._persistence.keys()
 
+    def sorted_keys(self):
+        return list(self._sorted_keys)
+
+    def iter_keys(self, low=None, high=None):
+        """ Lazily yields the keys in (low, high] in sorted order."""
+        return self._sorted_keys.irange(low, high)
+
+    def iter_items(self, low=None, high=None):
+        """ Lazily yields (key, value, timestamp) for the keys in (low, high] in sorted order."""
+        for key in self._sorted_keys.irange(low, high):
+            try:
+                record = self._persistence[key]
+            except KeyError:
+                continue
+            yield key, record['value'], record['timestamp']
+
+    def iter_tombstones(self, low=None, high=None):
+        """ Lazily yields (key, timestamp of the delete) for the deleted keys in (low, high] in sorted order."""
+        for key in self._sorted_tombstones.irange(low, high):
+            timestamp = self._tombstones.get(key)
+            if timestamp is not None:
+                yield key, timestamp
+
     def put(self, key, value, timestamp):
         """ Put key value pair into storage"""
+        if key not in self._persistence:
+            self._sorted_keys.add(key)
         self._persistence[key] = {'value': value, 'timestamp': timestamp}
+        if self._tombstones.pop(key, None) is not None:
+            self._sorted_tombstones.discard(key)
         return True
 
     def get(self, key):
         """ Get key's value """
+        if key in self._tombstones:
+            raise DeletedKeyError(key, self._tombstones[key])
         return self._persistence[key]['value'], self._persistence[key]['timestamp']
 
-    def delete(self, key):
-        """ Delete key value pair """
-        del self._persistence[key]
+    def delete(self, key, timestamp=None):
+        """
+        Delete key value pair, leaving a tombstone if timestamp is given.
+
+        Raises:
+            KeyError if key isn't present and no timestamp is given.  a delete with a timestamp records its tombstone
+            either way, so a replica that never held key still orders it against later versions.
+        """
+        if key not in self._persistence and timestamp is None:
+            raise KeyError(key)
+        if key in self._persistence:
+            del self._persistence[key]
+            self._sorted_keys.discard(key)
+        if timestamp is not None:
+            self._tombstones[key] = timestamp
+            self._sorted_tombstones.add(key)
+            heapq.heappush(self._tombstone_heap, (timestamp, key))
         return True
+
+    def process(self):
+        """
+        Background maintenance hook called once per server loop: purges up to purge_slice expired tombstones.
+
+        Returns:
+            True if expired tombstones are left to purge, False otherwise.
+        """
+        heap = self._tombstone_heap
+        for _ in xrange(self._purge_slice):
+            if not heap or not self._tombstone_expired(heap[0][0]):
+                return False
+            timestamp, key = heapq.heappop(heap)
+            if self._tombstones.get(key) == timestamp:
+                del self._tombstones[key]
+                self._sorted_tombstones.discard(key)
+                self._metrics['dropped_tombstones'] += 1
+                if self.on_tombstone_dropped:
+                    self.on_tombstone_dropped(key, timestamp)
+        return bool(heap) and self._tombstone_expired(heap[0][0])
+
+    def _tombstone_expired(self, timestamp):
+        return util.add_time(timestamp, self._tombstone_grace_period) < util.current_time()
@@ -1,32 +1,227 @@
+import bisect
+import itertools
 import logging
 import util
-from persistence_engine import PersistenceEngine
+import vector_clock
+from persistence_engine import PersistenceEngine, DeletedKeyError
+from hint_store import HintStore
+from merkle_tree import MerkleTree
+
+# format version of the data PersistenceStage stores: 1 since keys are binary key hashes rather than hex
+FORMAT_VERSION = 1
+# timestamp of the tombstones left under the legacy keys upgraded, long past any grace period so engines purge them
+LEGACY_TOMBSTONE_TIMESTAMP = 1
 
 class PersistenceStage(object):
     """
     Stage for managing key-value persistence.
     """
 
-    def __init__(self, server=None):
+    def __init__(self, server=None, persistence_engine=None, hint_engine=None, vector_clocks=False):
+        """
+        Args:
+        ----------
+        server : PynamoServer object.
+            object through which internal stages can be accessed.
+        persistence_engine : object implementing put/get/delete/keys, optional.
+            storage backend, e.g. LogPersistenceEngine.  defaults to the in-memory PersistenceEngine.
+        hint_engine : object implementing put/get/delete/keys, optional.
+            separate storage backend for hinted handoff writes.  defaults to the in-memory PersistenceEngine.
+        vector_clocks : bool, optional
+            if True, values are lists of sibling versions (see vector_clock) and puts merge them into the stored ones
+            rather than replace them, defaults to False.
+        """
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.debug('__init__')
 
         self._server = server
-        self._persistence_engine = PersistenceEngine()
+        if persistence_engine is None:
+            persistence_engine = PersistenceEngine()
+        self._persistence_engine = persistence_engine
+        self._persistence_engine.on_tombstone_dropped = self._handle_dropped_tombstone
+        self._hint_store = HintStore(persistence_engine=hint_engine)
+        self._vector_clocks = vector_clocks
+
+        # (low, high) -> MerkleTree for each hash range this node replicates
+        self._merkle_trees = dict()
+        # the trees sorted by the high end of their range, and the greatest key hash of those ends, to find the tree holding a key
+        self._sorted_merkle_trees = []
+        self._merkle_tree_highs = []
+
+        self._upgrade_legacy_keys(hint_engine)
+
+    @staticmethod
+    def _outdated(engine):
+        """ Returns True if engine records a format version older than FORMAT_VERSION.  in-memory engines record none."""
+        return getattr(engine, 'format_version', FORMAT_VERSION) < FORMAT_VERSION
+
+    def _upgrade_legacy_keys(self, hint_engine):
+        """
+        Moves the versions, tombstones and hints stored under hex key hashes, as keys were stored before they were
+        binary, to their binary key hashes.
+            -tombstones move as deletes with their own timestamp, so they still order the delete against the versions
+             replicas send later.
+            -the legacy keys are left with a tombstone at LEGACY_TOMBSTONE_TIMESTAMP, which the engine purges like any
+             expired one.
+            -runs once per engine: each is scanned only while its recorded format version is older than FORMAT_VERSION,
+             which is recorded once it has been upgraded.
+        """
+        legacy_keys = []
+        legacy_tombstones = []
+        if self._outdated(self._persistence_engine):
+            for key in self._persistence_engine.iter_keys():
+                key_hash = util.from_legacy_key(key)
+                if key_hash:
+                    legacy_keys.append((key, key_hash))
+            for key, timestamp in self._persistence_engine.iter_tombstones():
+                key_hash = util.from_legacy_key(key)
+                # those at LEGACY_TOMBSTONE_TIMESTAMP were left by an upgrade interrupted before it was recorded
+                if key_hash and timestamp != LEGACY_TOMBSTONE_TIMESTAMP:
+                    legacy_tombstones.append((key, key_hash, timestamp))
+            for key, key_hash in legacy_keys:
+                value, timestamp = self._persistence_engine.get(key)
+                self._persistence_engine.put(key_hash, value, timestamp)
+                self._persistence_engine.delete(key, LEGACY_TOMBSTONE_TIMESTAMP)
+            for key, key_hash, timestamp in legacy_tombstones:
+                self._persistence_engine.delete(key_hash, timestamp)
+                self._persistence_engine.delete(key, LEGACY_TOMBSTONE_TIMESTAMP)
+            self._persistence_engine.set_format_version(FORMAT_VERSION)
+
+        legacy_hints = []
+        if self._outdated(hint_engine):
+            for node_hash in self._hint_store.node_hashes:
+                for key, value, timestamp, command in self._hint_store.iter_hints(node_hash):
+                    key_hash = util.from_legacy_key(key)
+                    if key_hash:
+                        legacy_hints.append((node_hash, key, key_hash, value, timestamp, command))
+            for node_hash, key, key_hash, value, timestamp, command in legacy_hints:
+                self._hint_store.add(node_hash, key_hash, command, value, timestamp)
+                self._hint_store.remove(node_hash, key, timestamp)
+            hint_engine.set_format_version(FORMAT_VERSION)
+
+        if legacy_keys or legacy_tombstones or legacy_hints:
+            self.logger.info('_upgrade_legacy_keys.  moved {} keys, {} tombstones and {} hints to binary key hashes'.format(
+                len(legacy_keys), len(legacy_tombstones), len(legacy_hints)))
+
+    @property
+    def metrics(self):
+        """
+        Returns:
+            dict of the persistence engine's counters, e.g. bytes reclaimed and time spent compacting.
+        """
+        return self._persistence_engine.metrics
+
+    @property
+    def hint_store(self):
+        """
+        Returns:
+            HintStore holding writes accepted on behalf of unreachable replicas.
+        """
+        return self._hint_store
 
     def keys(self):
-    """
-    Returns:
-        list of keys present in the persistence engine.
-    """
+        """
+        Returns:
+            list of keys present in the persistence engine.
+        """
         return self._persistence_engine.keys()
 
+    def sorted_keys(self):
+        """
+        Returns:
+            list of keys present in the persistence engine, in sorted order.  engines that keep keys sorted return them as is.
+        """
+        return self._persistence_engine.sorted_keys()
+
+    def _iter_range(self, iterate, low, high):
+        """
+        Applies iterate to the key hashes of the token range (low, high], splitting it in two when it wraps around the
+        ring.
+        """
+        if low is not None and high is not None and low >= high:
+            return itertools.chain(iterate(util.token_key_bound(low), None), iterate(None, util.token_key_bound(high)))
+        return iterate(util.token_key_bound(low), util.token_key_bound(high))
+
+    def keys_in_range(self, low=None, high=None):
+        """
+        Returns:
+            lazy iterator over the keys in token range (low, high], in ring order.
+            a range with low >= high wraps around the end of the ring.
+        """
+        return self._iter_range(self._persistence_engine.iter_keys, low, high)
+
+    def items_in_range(self, low=None, high=None):
+        """
+        Returns:
+            lazy iterator of (key, value, timestamp) over the keys in token range (low, high], in ring order.
+            a range with low >= high wraps around the end of the ring.
+        """
+        return self._iter_range(self._persistence_engine.iter_items, low, high)
+
+    def tombstones_in_range(self, low=None, high=None):
+        """
+        Returns:
+            lazy iterator of (key, timestamp of the delete) over the deleted keys in token range (low, high], in ring order.
+            a range with low >= high wraps around the end of the ring.
+        """
+        return self._iter_range(self._persistence_engine.iter_tombstones, low, high)
+
+    def process(self):
+        """
+        Gives the persistence and hint engines a slice of time for background work such as compaction.
+        """
+        hint_work = self._hint_store.process()
+        return self._persistence_engine.process() or hint_work
+
+    def rebuild_merkle_trees(self, ranges, depth=10):
+        """
+        Builds a MerkleTree for each hash range (low, high] in ranges from the keys currently stored, replacing any old trees.
+            -tombstones are versions like any other, so replicas that disagree about a delete have differing trees.
+            -called when the ranges this node replicates change; afterwards put/delete keep the trees up to date.
+            -the trees of ranges this node already kept at the same depth are up to date, and kept as they are, so only
+             the keys of new ranges are read.
+        """
+        self.logger.debug('rebuild_merkle_trees.  ranges: {}'.format(len(ranges)))
+        merkle_trees = dict()
+        for low, high in ranges:
+            tree = self._merkle_trees.get((low, high))
+            if tree is None or tree.depth != depth:
+                tree = MerkleTree(low, high, depth)
+                for key, _, timestamp in self.items_in_range(low, high):
+                    tree.update(key, new_timestamp=timestamp)
+                for key, timestamp in self.tombstones_in_range(low, high):
+                    tree.update(key, new_timestamp=timestamp)
+            merkle_trees[(low, high)] = tree
+        self._merkle_trees = merkle_trees
+        self._sorted_merkle_trees = [merkle_trees[bounds] for bounds in sorted(merkle_trees, key=lambda bounds: bounds[1])]
+        self._merkle_tree_highs = [util.token_key_bound(tree.high) for tree in self._sorted_merkle_trees]
+
+    def merkle_tree(self, low, high):
+        """
+        Returns:
+            the MerkleTree over hash range (low, high], None if this node keeps no tree for exactly that range.
+        """
+        return self._merkle_trees.get((low, high))
+
+    def _handle_dropped_tombstone(self, key, timestamp):
+        """ Removes the tombstone the engine purged after its grace period from the Merkle tree holding key."""
+        self._update_merkle_trees(key, timestamp, None)
+
+    def _update_merkle_trees(self, key, old_timestamp, new_timestamp):
+        """ Updates the tree whose range holds key, if any: the ranges don't overlap, so it's the one ending first at or after key."""
+        if self._sorted_merkle_trees:
+            index = bisect.bisect_left(self._merkle_tree_highs, key) % len(self._sorted_merkle_trees)
+            tree = self._sorted_merkle_trees[index]
+            if key in tree:
+                tree.update(key, old_timestamp, new_timestamp)
+
     def put(self, key, value, timestamp=None):
         """
-        Compares timestamps of old and new values if key is already present in hash ring.
+        Compares timestamps of old and new values if key is already present in hash ring, or was deleted: a version
+        no newer than the one stored, or than the delete, is ignored.
 
         Returns:
-            error code \x00 if put is successful
+            error code \x00 if put is successful, or superseded by a newer version
             error code \x06 if unknown error is encountered
         """
 
@@ -37,30 +232,90 @@ class PersistenceStage(object):
                         'error_code' : None
                         }
 
+        if self._vector_clocks:
+            return self._put_versions(key, value, reply)
+
         if not timestamp:
-            new_timestamp = util.current_time()
+            new_timestamp = self._server.clock.now()
         else:
             new_timestamp = timestamp
         try:
-            old_timestamp = self._persistence_engine.get(key)['timestamp']
+            _, old_timestamp = self._persistence_engine.get(key)
+        except DeletedKeyError as deleted:
+            if new_timestamp > deleted.timestamp:
+                self._persistence_engine.put(key, value, new_timestamp)
+                self._update_merkle_trees(key, deleted.timestamp, new_timestamp)
+            reply['error_code'] = '\x00'
         except KeyError:
             self._persistence_engine.put(key, value, new_timestamp)
+            self._update_merkle_trees(key, None, new_timestamp)
             reply['error_code'] = '\x00'
         except:
             reply['error_code'] = '\x06'
         else:
             if new_timestamp > old_timestamp:
                 self._persistence_engine.put(key, value, new_timestamp)
-                reply['error_code'] = '\x00'
+                self._update_merkle_trees(key, old_timestamp, new_timestamp)
+            reply['error_code'] = '\x00'
         finally:
             return reply
 
 
+    def _put_versions(self, key, versions, reply):
+        """
+        Merges versions, a list of [value, clock] versions, with the siblings stored for key, dropping every version
+        another one supersedes.  the siblings are stored with the timestamp of their latest write.  if key was deleted,
+        versions last written before the delete are dropped too.
+        """
+        try:
+            try:
+                old_versions, old_timestamp = self._persistence_engine.get(key)
+            except DeletedKeyError as deleted:
+                old_versions, old_timestamp = [], deleted.timestamp
+                versions = [version for version in versions if vector_clock.latest_timestamp([version]) > deleted.timestamp]
+            except KeyError:
+                old_versions, old_timestamp = [], None
+            new_versions = vector_clock.reconcile(old_versions + versions)
+            if new_versions != old_versions:
+                new_timestamp = vector_clock.latest_timestamp(new_versions)
+                self._persistence_engine.put(key, new_versions, new_timestamp)
+                self._update_merkle_trees(key, old_timestamp, new_timestamp)
+        except:
+            reply['error_code'] = '\x06'
+        else:
+            reply['error_code'] = '\x00'
+        return reply
+
+    def put_hint(self, node_hash, key, command, value=None, timestamp=None):
+        """
+        Stores a put or delete meant for the unreachable replica node_hash in the hint store, to be handed off later.
+
+        Returns:
+            error code \x00 if the hint is stored or superseded by a newer one
+            error code \x06 if unknown error is encountered
+        """
+
+        self.logger.debug('put_hint')
+
+        reply = {   'type': 'reply',
+                        'node_hash' : self._server.node_hash,
+                        'error_code' : None
+                        }
+
+        try:
+            self._hint_store.add(node_hash, key, command, value, timestamp or self._server.clock.now())
+        except:
+            reply['error_code'] = '\x06'
+        else:
+            reply['error_code'] = '\x00'
+        finally:
+            return reply
+
     def get(self, key):
         """
         Returns:
             (error code \x00, value) if get is successful
-            (error code \x01, None) if key inexistant
+            (error code \x01, None) if key inexistant, with the timestamp of its tombstone if it was deleted
             (error code \x06, None) if unknown error is encountered
         """
 
@@ -75,6 +330,9 @@ class PersistenceStage(object):
 
         try:
             reply['value'], reply['timestamp'] = self._persistence_engine.get(key)
+        except DeletedKeyError as deleted:
+            reply['error_code'] = '\x01'
+            reply['timestamp'] = deleted.timestamp
         except KeyError:
             reply['error_code'] = '\x01'
         except:
@@ -84,10 +342,13 @@ class PersistenceStage(object):
         finally:
             return reply
 
-    def delete(self, key):
+    def delete(self, key, timestamp=None):
         """
+        Deletes key as of timestamp, the server clock's time if not given, leaving a tombstone that orders the delete
+        against the versions replicas send later.  a delete no newer than the version stored is ignored.
+
         Returns:
-            error code \x00 if delete is successful
+            error code \x00 if delete is successful, or superseded by a newer version
             error code \x01 if key inexistant
             error code \x06 if unknown error is encountered
         """
@@ -98,14 +359,27 @@ class PersistenceStage(object):
                         'node_hash' : self._server.node_hash,
                         'error_code' : None
                         }
+        if not timestamp:
+            timestamp = self._server.clock.now()
         try:
-            self._persistence_engine.delete(key)
-        except KeyError:
-            reply['error_code'] = '\x01'
+            try:
+                _, old_timestamp = self._persistence_engine.get(key)
+            except DeletedKeyError as deleted:
+                if timestamp > deleted.timestamp:
+                    self._persistence_engine.delete(key, timestamp)
+                    self._update_merkle_trees(key, deleted.timestamp, timestamp)
+                reply['error_code'] = '\x01'
+            except KeyError:
+                self._persistence_engine.delete(key, timestamp)
+                self._update_merkle_trees(key, None, timestamp)
+                reply['error_code'] = '\x01'
+            else:
+                if timestamp > old_timestamp:
+                    self._persistence_engine.delete(key, timestamp)
+                    self._update_merkle_trees(key, old_timestamp, timestamp)
+                reply['error_code'] = '\x00'
         except:
             reply['error_code'] = '\x06'
-        else:
-            reply['error_code'] = '\x00'
         finally:
             return reply
 
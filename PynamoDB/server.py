@@ -1,10 +1,16 @@
-import asyncore
 import getopt
 import logging
+import os
 import sys
 import util
+import partitioner as partitioners
 
+from event_loop import EventLoop
+from hybrid_logical_clock import HybridLogicalClock
+from log_persistence_engine import LogPersistenceEngine
+from lsm_persistence_engine import LSMPersistenceEngine
 from persistence_stage import PersistenceStage
+from timer_wheel import TimerWheel
 from membership_stage import MembershipStage
 from external_request_stage import ExternalRequestStage
 from internal_request_stage import InternalRequestStage
@@ -14,10 +20,14 @@ logging.basicConfig(filename='pynamo.log',
                     format='%(asctime)s - %(levelname)s - %(name)s - %(message)s'
                     )
 
+# seconds between runs of the stages for time-driven work: membership checks, transfer timeouts, compaction
+HOUSEKEEPING_INTERVAL = 0.1
+
 class PynamoServer(object):
     """
     PynamoDB server that manages request/membership/persistence stages.
-        -alternates between asyncore.loop polling of channels and server.process polling of server stages.
+        -runs on an EventLoop: the stages are processed right after socket events and every HOUSEKEEPING_INTERVAL
+         seconds, and the server blocks in poll() in between.
 
     Attributes:
     ----------
@@ -29,10 +39,14 @@ class PynamoServer(object):
         handles communications with clients.
     internal_request_stage (InternalRequestStage):
         handles communications with other nodes.
+    timer_wheel (TimerWheel):
+        deadlines of the stages, coordinators and channels; advanced at the start of every process().
+    clock (HybridLogicalClock):
+        stamps the versions of writes; kept ahead of the timestamps carried by internal messages.
     """
 
-    def __init__(self, hostname, external_port, internal_port, public_dns_name, node_addresses, wait_time=30, num_replicas=3):
-         """
+    def __init__(self, hostname, external_port, internal_port, public_dns_name, node_addresses, wait_time=30, num_replicas=3, persistence_engine=None, read_quorum=None, write_quorum=None, hint_engine=None, event_loop=None, vector_clocks=False, vnodes=1, node_weights=None, partitioner=partitioners.DEFAULT_PARTITIONER):
+        """
         Args:
         ----------
         hostname (str):
@@ -49,18 +63,53 @@ class PynamoServer(object):
             number of seconds before internal nodes start communicating with each other, defaults to 30s.
         num_replicas(int, optional):
             number of replicas for each key-value pair, defaults to 3.
+        persistence_engine(object, optional):
+            storage backend handed to the PersistenceStage, e.g. LogPersistenceEngine.  defaults to the in-memory PersistenceEngine.
+        read_quorum(int, optional):
+            number of replicas that must answer a get before the client is replied to, defaults to num_replicas.
+        write_quorum(int, optional):
+            number of replicas that must acknowledge a put/delete before the client is replied to, defaults to num_replicas.
+        hint_engine(object, optional):
+            storage backend for writes held on behalf of unreachable replicas.  defaults to the in-memory PersistenceEngine.
+        event_loop(EventLoop, optional):
+            loop the server runs on once started, defaults to a new EventLoop.  servers in one process may share one.
+        vector_clocks(bool, optional):
+            if True, concurrent writes to a key are kept as siblings, returned by get along with a context token for the
+            put resolving them, instead of the write with the latest timestamp winning.  must be the same on every node
+            of a ring, from its first write.  defaults to False.
+        vnodes(int, optional):
+            number of tokens each node of weight 1.0 owns on the hash ring.  more tokens even out the share of keys each
+            node holds and spread the repair of a failed node over the cluster.  must be the same on every node of a
+            ring.  defaults to 1.
+        node_weights(dict, optional):
+            'hostname,external_port,internal_port' -> weight scaling the node's tokens, e.g. 2.0 for a node with twice
+            the capacity.  nodes not in it have weight 1.0.  must be the same on every node of a ring.
+        partitioner(str, optional):
+            name of the partitioner hashing keys onto the ring, see partitioner.PARTITIONERS.  must be the same on every
+            node of a ring, from its first write; nodes ignore the membership messages of nodes using another one.
+            defaults to 'sha256', which keeps the placement of older clusters but is not faster; 'md5' is, without
+            extra packages.
         """
         self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
         self.logger.info('__init__')
 
         self._num_replicas = num_replicas
+        self._read_quorum = read_quorum or num_replicas
+        self._write_quorum = write_quorum or num_replicas
 
         self.hostname = hostname
         self.external_port = external_port
         self.internal_port = internal_port
 
-        self._persistence_stage = PersistenceStage(server=self)
-        self._membership_stage = MembershipStage(server=self, node_addresses=node_addresses, wait_time=wait_time)
+        self._event_loop = event_loop or EventLoop()
+        self._housekeeping_handle = None
+        self._timer_wheel = TimerWheel()
+        self._clock = HybridLogicalClock()
+
+        self._vector_clocks = vector_clocks
+        self._partitioner = partitioners.get_partitioner(partitioner)
+        self._persistence_stage = PersistenceStage(server=self, persistence_engine=persistence_engine, hint_engine=hint_engine, vector_clocks=vector_clocks)
+        self._membership_stage = MembershipStage(server=self, node_addresses=node_addresses, wait_time=wait_time, vnodes=vnodes, node_weights=node_weights)
         self._external_request_stage = ExternalRequestStage(server=self, hostname=hostname, external_port=external_port)
         self._internal_request_stage = InternalRequestStage(server=self, hostname=hostname, internal_port=internal_port)
 
@@ -73,8 +122,8 @@ class PynamoServer(object):
         self.logger.debug('__init__ complete.')
 
     @classmethod
-    def from_node_list(cls, node_file, self_dns_name, wait_time):
-         """
+    def from_node_list(cls, node_file, self_dns_name, wait_time, data_dir=None, engine='log', read_quorum=None, write_quorum=None, partitioner=partitioners.DEFAULT_PARTITIONER):
+        """
         Constructor from node list with format:
             'public_dns_name, external_port, internal_port'
 
@@ -82,6 +131,12 @@ class PynamoServer(object):
             node_file (str) : path to node file.
             self_dns_name (str) : own public dns name.
             wait_time(int): number of seconds before internal nodes start communicating with each other, defaults to 30s.
+            data_dir(str, optional): directory for a disk-backed persistence engine, with hinted writes logged under data_dir/hints.
+                keys and hints are kept in memory only if omitted.
+            engine(str, optional): disk-backed engine to use with data_dir, 'log' (LogPersistenceEngine) or 'lsm' (LSMPersistenceEngine).
+            read_quorum, write_quorum(int, optional): replies needed before answering a get or a put/delete, default to num_replicas.
+            partitioner(str, optional): name of the partitioner hashing keys onto the ring, defaults to 'sha256'.  'md5'
+                is faster and needs no extra packages, see partitioner.py.
 
         Returns:
             True if successful, False otherwise.
@@ -97,23 +152,72 @@ class PynamoServer(object):
                 public_dns_name, external_port, internal_port = node_address.split(',')
                 if public_dns_name == self_dns_name:
                     print '0.0.0.0', external_port, internal_port
+                    if data_dir and engine == 'lsm':
+                        persistence_engine = LSMPersistenceEngine(directory=data_dir)
+                    elif data_dir:
+                        persistence_engine = LogPersistenceEngine(directory=data_dir)
+                    else:
+                        persistence_engine = None
+                    if data_dir:
+                        hint_engine = LogPersistenceEngine(directory=os.path.join(data_dir, 'hints'))
+                    else:
+                        hint_engine = None
                     server = cls(   hostname='0.0.0.0',
                                  public_dns_name=self_dns_name,
                                  external_port=int(external_port),
                                  internal_port=int(internal_port),
                                  node_addresses=node_addresses,
-                                 wait_time=int(wait_time))
+                                 wait_time=int(wait_time),
+                                 persistence_engine=persistence_engine,
+                                 read_quorum=read_quorum,
+                                 write_quorum=write_quorum,
+                                 hint_engine=hint_engine,
+                                 partitioner=partitioner)
                     return server
 
             return True
         except:
             return False
 
+    def start(self):
+        """
+        Registers the server with its event loop; event_loop.run_forever() then serves requests.
+        """
+        self.logger.info('start')
+        self._event_loop.add_io_callback(self.process)
+        self._housekeeping_handle = self._event_loop.call_soon(self._housekeeping)
+
+    def stop(self):
+        """
+        Unregisters the server from its event loop.
+        """
+        self.logger.info('stop')
+        self._event_loop.remove_io_callback(self.process)
+        if self._housekeeping_handle:
+            self._housekeeping_handle.cancel()
+            self._housekeeping_handle = None
+
+    def _housekeeping(self):
+        """
+        Processes the stages for time-driven work, then runs again after HOUSEKEEPING_INTERVAL, or right away while the
+        persistence stage has background work left.
+        """
+        delay = 0 if self.process() else HOUSEKEEPING_INTERVAL
+        self._housekeeping_handle = self._event_loop.call_later(delay, self._housekeeping)
+
     def process(self):
         """
         Instructs processors to process requests.
-                Called after each asynchronous loop.
+                Called after each batch of socket events and on the housekeeping timer.
+
+        Returns:
+            True if the persistence stage has background work left, False otherwise.
         """
+        try:
+            self.timer_wheel.advance()
+        except:
+            self.logger.error('timer_wheel .advance() error, {}.'.format(sys.exc_info()))
+
         try:
             self.internal_request_stage.process()
         except:
@@ -129,6 +233,12 @@ class PynamoServer(object):
         except:
             self.logger.error('membership_stage .process() error, {}.'.format(sys.exc_info()))
 
+        try:
+            return bool(self.persistence_stage.process())
+        except:
+            self.logger.error('persistence_stage .process() error, {}.'.format(sys.exc_info()))
+        return False
+
     def _immediate_shutdown(self):
         """
         Instructs ExternalRequestStage and InternalRequestStage to immediately stop listening.
@@ -138,6 +248,22 @@ class PynamoServer(object):
         self.external_request_stage._immediate_shutdown()
 
 
+    @property
+    def event_loop(self):
+        return self._event_loop
+
+    @property
+    def timer_wheel(self):
+        return self._timer_wheel
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def vector_clocks(self):
+        return self._vector_clocks
+
     @property
     def persistence_stage(self):
         return self._persistence_stage
@@ -154,10 +280,22 @@ class PynamoServer(object):
     def internal_request_stage(self):
         return self._internal_request_stage
 
+    @property
+    def partitioner(self):
+        return self._partitioner
+
     @property
     def num_replicas(self):
         return self._num_replicas
 
+    @property
+    def read_quorum(self):
+        return self._read_quorum
+
+    @property
+    def write_quorum(self):
+        return self._write_quorum
+
     @property
     def node_hash(self):
         return self._node_hash
@@ -174,15 +312,30 @@ class PynamoServer(object):
     def is_accepting_internal_requests(self):
         return not self._internal_shutdown_flag
 
+USAGE = """server.py -i <nodelistfile> -d <public_dns_name> -w <wait_time> [-p <data_dir> [-e <log|lsm>]] [-R <read_quorum>] [-W <write_quorum>] [-H <partitioner>]
+
+  -H <partitioner>  hashes keys onto the ring, the same on every node for the cluster's whole life:
+      sha256   default, always available.  the placement of clusters that predate -H; not faster.
+      md5      always available.  the fastest without extra packages, about 2x sha256.
+      xxh3     needs the xxhash package (>= 2.0).
+      murmur3  needs the mmh3 package.
+      blake2b  hashlib on python 3.6+, otherwise needs the pyblake2 package.
+    available here: {}"""
+
 def main(argv):
     try:
-      opts, args = getopt.getopt(argv,"hi:d:w:")
+      opts, args = getopt.getopt(argv,"hi:d:w:p:e:R:W:H:")
     except getopt.GetoptError:
-      print 'server.py -i <nodelistfile> -d <public_dns_name> -w <wait_time>'
+      print USAGE.format(', '.join(sorted(partitioners.PARTITIONERS)))
       sys.exit(2)
+    data_dir = None
+    engine = 'log'
+    read_quorum = None
+    write_quorum = None
+    partitioner = partitioners.DEFAULT_PARTITIONER
     for opt, arg in opts:
       if opt == '-h':
-         print  'server.py -i <nodelistfile> -d <public_dns_name> -w <wait_time>'
+         print USAGE.format(', '.join(sorted(partitioners.PARTITIONERS)))
          sys.exit()
       elif opt in ("-i"):
          node_file = arg
@@ -190,13 +343,23 @@ def main(argv):
          self_dns_name = arg
       elif opt in ("-w"):
         wait_time = int(arg)
-
-    server = PynamoServer.from_node_list(node_file=node_file, self_dns_name=self_dns_name, wait_time=wait_time)
-
+      elif opt in ("-p"):
+        data_dir = arg
+      elif opt in ("-e"):
+        engine = arg
+      elif opt in ("-R"):
+        read_quorum = int(arg)
+      elif opt in ("-W"):
+        write_quorum = int(arg)
+      elif opt in ("-H"):
+        partitioner = arg
+
+    server = PynamoServer.from_node_list(node_file=node_file, self_dns_name=self_dns_name, wait_time=wait_time, data_dir=data_dir, engine=engine, read_quorum=read_quorum, write_quorum=write_quorum, partitioner=partitioner)
+
+    server.start()
     while True:
         try:
-            asyncore.loop(timeout=0.001, count=1)
-            server.process()
+            server.event_loop.run_forever()
         except:
             server._immediate_shutdown()
 
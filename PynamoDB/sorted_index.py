@@ -0,0 +1,126 @@
+"""
+    sorted_index.py
+    ~~~~~~~~~~~~
+    Implements SortedKeyIndex, an ordered set of keys supporting O(log n) inserts/removals and lazy range scans.
+"""
+
+import bisect
+import itertools
+
+
+class SortedKeyIndex(object):
+    """
+    Ordered set of keys stored as a list of sorted sublists.
+    ----------
+        -each sublist holds at most 2 * load keys; _maxes holds the last key of each sublist, so locating a key is two bisects.
+        -irange(low, high) lazily yields the keys in (low, high] in O(log n + k), and keeps working if keys are added
+         or removed between iterations.
+    """
+
+    def __init__(self, keys=None, load=1000):
+        """
+        Args:
+        ----------
+        keys (iterable, optional):
+            initial keys.
+        load (int, optional):
+            target sublist length, defaults to 1000.
+        """
+        self._load = load
+        self._lists = []
+        self._maxes = []
+        self._len = 0
+        if keys:
+            self.update(keys)
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        position = bisect.bisect_left(self._maxes, key)
+        if position == len(self._maxes):
+            return False
+        sublist = self._lists[position]
+        return sublist[bisect.bisect_left(sublist, key)] == key
+
+    def __iter__(self):
+        return self.irange()
+
+    def update(self, keys):
+        """ Adds every key in keys, rebuilding the sublists in one pass."""
+        keys = sorted(set(itertools.chain(itertools.chain.from_iterable(self._lists), keys)))
+        self._lists = [keys[i:i + self._load] for i in xrange(0, len(keys), self._load)]
+        self._maxes = [sublist[-1] for sublist in self._lists]
+        self._len = len(keys)
+
+    def add(self, key):
+        """ Adds key to the index if it isn't present already."""
+        if not self._maxes:
+            self._lists.append([key])
+            self._maxes.append(key)
+            self._len += 1
+            return
+
+        position = bisect.bisect_left(self._maxes, key)
+        if position == len(self._maxes):
+            position -= 1
+            sublist = self._lists[position]
+            sublist.append(key)
+            self._maxes[position] = key
+        else:
+            sublist = self._lists[position]
+            index = bisect.bisect_left(sublist, key)
+            if sublist[index] == key:
+                return
+            sublist.insert(index, key)
+        self._len += 1
+
+        if len(sublist) > 2 * self._load:
+            half = sublist[self._load:]
+            del sublist[self._load:]
+            self._maxes[position] = sublist[-1]
+            self._lists.insert(position + 1, half)
+            self._maxes.insert(position + 1, half[-1])
+
+    def discard(self, key):
+        """ Removes key from the index if it is present."""
+        position = bisect.bisect_left(self._maxes, key)
+        if position == len(self._maxes):
+            return
+        sublist = self._lists[position]
+        index = bisect.bisect_left(sublist, key)
+        if sublist[index] != key:
+            return
+        del sublist[index]
+        self._len -= 1
+        if sublist:
+            self._maxes[position] = sublist[-1]
+        else:
+            del self._lists[position]
+            del self._maxes[position]
+
+    def irange(self, low=None, high=None):
+        """
+        Lazily yields the keys k with low < k <= high in sorted order.  None leaves that side unbounded.
+            -each step re-locates its position from the last key yielded, so the index may change while iterating.
+        """
+        lower = low
+        while self._lists:
+            if lower is None:
+                position, index = 0, 0
+            else:
+                position = bisect.bisect_right(self._maxes, lower)
+                if position == len(self._maxes):
+                    return
+                index = bisect.bisect_right(self._lists[position], lower)
+
+            sublist = self._lists[position]
+            if high is not None and sublist[-1] >= high:
+                for key in sublist[index:bisect.bisect_right(sublist, high)]:
+                    yield key
+                return
+
+            chunk = sublist[index:]
+            for key in chunk:
+                yield key
+            lower = chunk[-1]
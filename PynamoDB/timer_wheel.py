@@ -0,0 +1,180 @@
+"""
+    timer_wheel.py
+    ~~~~~~~~~~~~
+    Implements TimerWheel, a hierarchical timing wheel holding the server's deadlines: request timeouts and retries,
+    channel idle timeouts, partition transfer timeouts and the membership stage's periodic checks.
+"""
+
+import logging
+import math
+import sys
+
+import util
+
+
+class Timer(object):
+    """ A callback scheduled on a TimerWheel; cancel() removes it from the wheel."""
+
+    __slots__ = ('deadline', 'callback', 'args', '_wheel', '_slot')
+
+    def __init__(self, wheel, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        # set of timers self is held in, None once expired or cancelled
+        self._slot = None
+
+    @property
+    def active(self):
+        return self._slot is not None
+
+    def cancel(self):
+        self.callback = None
+        self.args = ()
+        if self._slot is not None:
+            self._slot.discard(self)
+            self._slot = None
+            self._wheel._num_timers -= 1
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timing wheel on the monotonic clock.
+    ----------
+        -time is divided into ticks of resolution seconds.  level 0 has a slot per tick for the next slots ticks,
+         level 1 a slot per slots ticks for the next slots ** 2 ticks, and so on; deadlines further out than the top
+         level reaches wait in its last slot and are placed again as they come into range.
+        -scheduling and cancelling are O(1); advance() does O(1) work per tick plus the timers it expires, moving the
+         timers of a higher level slot down whenever the level below wraps around.
+        -timers fire at most one tick late, in deadline order between slots but in no particular order within one.
+    """
+
+    def __init__(self, resolution=0.01, slots=256, levels=4, clock=util.monotonic_time):
+        """
+        Args:
+        ----------
+        resolution (float, optional):
+            seconds per tick, defaults to 10ms.
+        slots (int, optional):
+            slots per level, defaults to 256.
+        levels (int, optional):
+            number of levels, defaults to 4, i.e. deadlines up to 256 ** 4 ticks (about 1.4 years) away fire on time.
+        clock (function, optional):
+            returns the current time in seconds, defaults to util.monotonic_time.
+        """
+        self.logger = logging.getLogger('{}'.format(self.__class__.__name__))
+        self.logger.debug('__init__')
+
+        self._resolution = resolution
+        self._slots = slots
+        self._levels = levels
+        self._clock = clock
+        self._wheels = [[set() for _ in xrange(slots)] for _ in xrange(levels)]
+        # ticks spanned by one slot of each level
+        self._spans = [slots ** level for level in xrange(levels)]
+        self._tick = self._to_tick(clock())
+        self._num_timers = 0
+
+        self._metrics = {
+            'scheduled': 0,
+            'expired': 0,
+            'cascaded': 0
+        }
+
+    def __len__(self):
+        """ Returns the number of timers waiting to expire."""
+        return self._num_timers
+
+    @property
+    def metrics(self):
+        return dict(self._metrics)
+
+    def time(self):
+        """ Returns the wheel's clock, in seconds."""
+        return self._clock()
+
+    def _to_tick(self, seconds):
+        return int(seconds / self._resolution)
+
+    def schedule(self, delay, callback, *args):
+        """
+        Schedules callback(*args) to run once delay seconds have passed.
+
+        Returns:
+            Timer that can cancel the call.
+        """
+        timer = Timer(self, self._clock() + delay, callback, args)
+        self._insert(timer, self._tick + 1)
+        self._num_timers += 1
+        self._metrics['scheduled'] += 1
+        return timer
+
+    def _insert(self, timer, earliest_tick):
+        """ Places timer in the slot of the first tick at or after its deadline, but no earlier than earliest_tick."""
+        expiry_tick = max(int(math.ceil(timer.deadline / self._resolution)), earliest_tick)
+        ticks = expiry_tick - self._tick
+        for level in xrange(self._levels):
+            if ticks < self._spans[level] * self._slots:
+                break
+        else:
+            # beyond the top level: wait in its last slot
+            expiry_tick = self._tick + self._spans[level] * (self._slots - 1)
+        timer._slot = self._wheels[level][(expiry_tick // self._spans[level]) % self._slots]
+        timer._slot.add(timer)
+
+    def _cascade(self, level):
+        """
+        Moves the timers of the current slot of level down to the levels below.
+
+        Returns:
+            the index of the slot.
+        """
+        index = (self._tick // self._spans[level]) % self._slots
+        timers, self._wheels[level][index] = self._wheels[level][index], set()
+        for timer in timers:
+            # the current tick's level 0 slot is expired right after cascading
+            self._insert(timer, self._tick)
+        self._metrics['cascaded'] += len(timers)
+        return index
+
+    def advance(self):
+        """
+        Moves the wheel to the current time, running the callbacks of the timers that expired on the way.
+            -callbacks run after their own tick has been reached, so timers they schedule fire on a later advance.
+            -exceptions raised by callbacks are logged, not propagated.
+
+        Returns:
+            the number of timers expired.
+        """
+        target_tick = self._to_tick(self._clock())
+        num_expired = 0
+        while self._tick < target_tick:
+            if not self._num_timers:
+                self._tick = target_tick
+                break
+            self._tick += 1
+            index = self._tick % self._slots
+            if index == 0:
+                for level in xrange(1, self._levels):
+                    if self._cascade(level):
+                        break
+
+            timers, self._wheels[0][index] = self._wheels[0][index], set()
+            self._num_timers -= len(timers)
+            for timer in timers:
+                timer._slot = None
+            for timer in timers:
+                # an earlier callback may have cancelled it
+                if timer.callback is not None:
+                    num_expired += 1
+                    self._run(timer)
+
+        self._metrics['expired'] += num_expired
+        return num_expired
+
+    def _run(self, timer):
+        try:
+            timer.callback(*timer.args)
+        except Exception:
+            self.logger.error('_run.  {} raised {}'.format(timer.callback, sys.exc_info()))
@@ -4,26 +4,131 @@
     contains utility functions.
 """
 
+import binascii
+import calendar
+import ctypes
+import ctypes.util
 import json
 import hashlib
 import datetime
 import math
+import os
+import struct
+import sys
+import time
 
 
+# timestamps are 64-bit integers: milliseconds since the epoch above LOGICAL_BITS bits of hybrid logical clock counter
+LOGICAL_BITS = 16
+_LEGACY_FORMATS = ("%Y-%m-%d %H:%M:%S.%f", "%Y-%m-%d %H:%M:%S")
+
+def timestamp_from_seconds(seconds):
+    """ Returns the timestamp of seconds since the epoch, with a logical counter of 0."""
+    return int(seconds * 1000) << LOGICAL_BITS
+
 def current_time():
-    return str(datetime.datetime.utcnow())
+    """ Returns the wall clock as a timestamp; versions are taken from the server's HybridLogicalClock instead."""
+    return timestamp_from_seconds(time.time())
 
 def add_time(timestamp, seconds):
-    previous_timestamp = to_datetime(timestamp)
-    return str(previous_timestamp + datetime.timedelta(seconds=seconds))
+    return timestamp + (int(seconds * 1000) << LOGICAL_BITS)
 
 def to_datetime(timestamp):
-    return datetime.datetime.strptime(str(timestamp), "%Y-%m-%d %H:%M:%S.%f")
+    return datetime.datetime.utcfromtimestamp((timestamp >> LOGICAL_BITS) / 1000.0)
+
+def to_timestamp(value):
+    """
+    Returns:
+        value as a timestamp, converting the 'YYYY-MM-DD HH:MM:SS.ffffff' UTC strings versions were stamped with before
+        timestamps were integers.  None is returned unchanged.
+    """
+    if value is None or isinstance(value, (int, long)):
+        return value
+    for legacy_format in _LEGACY_FORMATS:
+        try:
+            moment = datetime.datetime.strptime(str(value), legacy_format)
+        except ValueError:
+            continue
+        return timestamp_from_seconds(calendar.timegm(moment.timetuple()) + moment.microsecond / 1e6)
+    raise ValueError('unrecognized timestamp: {!r}'.format(value))
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _monotonic_clock():
+    """ Returns a function reading CLOCK_MONOTONIC through libc's clock_gettime, or time.time if it is unavailable."""
+    try:
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).clock_gettime
+    except (OSError, AttributeError, TypeError):
+        return time.time
+    clock_id = 6 if sys.platform == 'darwin' else 1
+    timespec = _Timespec()
+
+    def monotonic_time():
+        if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return monotonic_time
+
+# seconds since an arbitrary point, never going backwards; for deadlines and intervals, not for timestamps
+monotonic_time = _monotonic_clock()
+
+# keys are stored under the first KEY_HASH_BYTES bytes of their sha256 digest
+KEY_HASH_BYTES = 16
+# ring tokens are the first TOKEN_BITS bits of a node's or key's hash, as an unsigned integer
+TOKEN_BITS = 64
+_TOKEN = struct.Struct('>Q')
+# appended to a packed token, sorts after the rest of every key hash starting with it
+_TOKEN_BOUND_SUFFIX = '\xff' * (KEY_HASH_BYTES - _TOKEN.size)
 
 def get_hash(value):
     """ Return a 32-byte hash of value as a hex string"""
     return hashlib.sha256(value).hexdigest()
 
+def get_key_hash(value):
+    """ Returns the KEY_HASH_BYTES-byte binary hash a key is stored and placed on the ring under."""
+    return hashlib.sha256(value).digest()[:KEY_HASH_BYTES]
+
+def get_token(value):
+    """ Returns the ring token of value, the first TOKEN_BITS bits of its sha256 digest."""
+    return _TOKEN.unpack_from(hashlib.sha256(value).digest())[0]
+
+def node_token(node_hash):
+    """ Returns the ring token of a node, the first TOKEN_BITS bits of its hex node_hash."""
+    return int(node_hash[:TOKEN_BITS / 4], 16)
+
+def key_token(key_hash):
+    """ Returns the ring token of a binary key hash."""
+    return _TOKEN.unpack_from(key_hash)[0]
+
+def token_key_bound(token):
+    """
+    Returns:
+        the greatest key hash with the given token, so the key hashes of the token range (low, high] are those in
+        (token_key_bound(low), token_key_bound(high)].  None is returned unchanged, for unbounded ranges.
+    """
+    if token is None:
+        return None
+    return _TOKEN.pack(token) + _TOKEN_BOUND_SUFFIX
+
+def to_hex(key_hash):
+    """ Returns the hex form of a binary key hash, for logs."""
+    return binascii.hexlify(key_hash)
+
+def from_legacy_key(key):
+    """
+    Returns:
+        the binary key hash of key if it is a 64-character hex key hash, as keys were stored before they were binary,
+        None otherwise.
+    """
+    if len(key) != 64:
+        return None
+    try:
+        return binascii.unhexlify(key[:2 * KEY_HASH_BYTES])
+    except TypeError:
+        return None
+
 def offset_hex(hex_string, offset=1):
     """ Returns hex string offset by the given amount.
         Useful for generating keys for which a given node_hash is reponsible, i.e. offset the node's hash by a negative amount
@@ -71,7 +176,8 @@ class ErrorCode(object):
                 '\x03': "Error code: {}.  System overload.".format([error_code]),
                 '\x04': "Error code: {}.  Internal KVStore failure.".format([error_code]),
                 '\x05': "Error code: {}.  Unrecognized command.".format([error_code]),
-                '\x06': "Error code: {}.  Unrecognized error: {}.".format([error_code], sys.exc_info()[0])
+                '\x06': "Error code: {}.  Unrecognized error: {}.".format([error_code], sys.exc_info()[0]),
+                '\x10': "Error code: {}.  Replica unreachable.".format([error_code])
             }[self.error_code]
         except KeyError:
             self.logger.warn('Error code %s not found.', error, exc_info=True)
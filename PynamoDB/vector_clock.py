@@ -0,0 +1,108 @@
+"""
+    vector_clock.py
+    ~~~~~~~~~~~~
+    Vector clocks and sibling versions, for servers that detect concurrent writes instead of keeping the last one.
+
+    A clock is a dict of actor -> [counter, timestamp]: the actor is the node that coordinated a write, the counter
+    the number of writes it coordinated in the history of the version, and the timestamp that of its latest one, used
+    to prune the clock.  A version is a [value, clock] pair, and a key stores the list of versions none of which
+    descends from another, i.e. its siblings.  clients get the siblings along with a context token, the merged clock
+    of the versions they read, and hand it back with their next put, which then supersedes every version they saw.
+"""
+
+import base64
+
+import wire_protocol
+
+# entries a clock keeps before dropping the ones written longest ago
+MAX_ENTRIES = 10
+# characters of a node hash identifying it in clocks
+ACTOR_LENGTH = 16
+
+
+def actor(node_hash):
+    """ Returns the id of node_hash in clocks."""
+    return node_hash[:ACTOR_LENGTH]
+
+def increment(clock, actor, timestamp, max_entries=MAX_ENTRIES):
+    """
+    Returns:
+        a copy of clock recording one more write coordinated by actor at timestamp.  if the clock then has more than
+        max_entries entries, the ones with the oldest timestamps are dropped, which may turn a later write by their
+        actors into a sibling rather than a successor.
+    """
+    clock = dict((entry_actor, list(entry)) for entry_actor, entry in clock.iteritems())
+    counter = clock[actor][0] if actor in clock else 0
+    clock[actor] = [counter + 1, timestamp]
+    if len(clock) > max_entries:
+        for entry_actor, _ in sorted(clock.iteritems(), key=lambda item: item[1][1])[:len(clock) - max_entries]:
+            del clock[entry_actor]
+    return clock
+
+def descends(clock, other):
+    """ Returns True if clock has seen every write other has, i.e. a version with clock supersedes one with other."""
+    for entry_actor, (counter, _) in other.iteritems():
+        entry = clock.get(entry_actor)
+        if entry is None or entry[0] < counter:
+            return False
+    return True
+
+def merge(clocks):
+    """ Returns the clock that has seen every write any of clocks has."""
+    merged = dict()
+    for clock in clocks:
+        for entry_actor, entry in clock.iteritems():
+            if entry_actor not in merged or entry[0] > merged[entry_actor][0]:
+                merged[entry_actor] = list(entry)
+    return merged
+
+def latest_timestamp(versions):
+    """ Returns the timestamp of the latest write recorded in versions, None if there are none."""
+    timestamps = [timestamp for _, clock in versions for _, timestamp in clock.itervalues()]
+    return max(timestamps) if timestamps else None
+
+def reconcile(versions):
+    """
+    Returns:
+        the siblings among versions, i.e. the versions not superseded by another, with duplicates dropped, ordered by
+        latest_timestamp so replicas holding the same siblings store them identically.
+    """
+    siblings = []
+    for version in versions:
+        _, clock = version
+        if any(descends(sibling_clock, clock) for _, sibling_clock in siblings):
+            continue
+        siblings = [sibling for sibling in siblings if not descends(clock, sibling[1])]
+        siblings.append(version)
+    siblings.sort(key=lambda version: (latest_timestamp([version]), sorted(version[1].iteritems())))
+    return siblings
+
+def new_version(value, context, actor, timestamp):
+    """
+    Returns:
+        the versions to store for a put of value coordinated by actor: a single version superseding every version
+        context was read from.
+    """
+    return [[value, increment(decode_context(context), actor, timestamp)]]
+
+def encode_context(clock):
+    """ Returns the context token handed to clients for clock."""
+    return base64.urlsafe_b64encode(wire_protocol.encode(clock))
+
+def decode_context(context):
+    """
+    Returns:
+        the clock of a context token, an empty clock if context is None.
+
+    Raises:
+        ValueError if context isn't a context token.
+    """
+    if context is None:
+        return dict()
+    try:
+        clock = wire_protocol.decode(base64.urlsafe_b64decode(str(context)))
+    except TypeError:
+        raise ValueError('invalid context token')
+    if not isinstance(clock, dict):
+        raise ValueError('invalid context token')
+    return clock
@@ -0,0 +1,348 @@
+"""
+    wire_protocol.py
+    ~~~~~~~~~~~~
+    Implements the binary message encoding and framing used between clients and nodes, and MessageChannel, the
+    asynchat channel base class that speaks it.
+
+    A binary frame is FRAME_MARKER, a 4-byte payload length and the payload, a message encoded by encode().  Channels
+    also still speak the original framing, a JSON object followed by a terminator; since JSON messages always start
+    with '{', the receiving end of a connection tells the two apart from its first byte and answers in kind.
+"""
+
+import asynchat
+import asyncore
+import errno
+import json
+import socket
+import struct
+
+FRAMING_JSON = 'json'
+FRAMING_BINARY = 'binary'
+
+FRAME_MARKER = '\x93'
+FRAME_HEADER = struct.Struct('>cI')
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+RECEIVE_BUFFER_SIZE = 64 * 1024
+# times a grown receive buffer must be drained without a large frame before it shrinks back
+SHRINK_AFTER_DRAINS = 32
+
+# strings common to most messages, sent as their index in this list.  append only: both ends must agree.
+WELL_KNOWN_STRINGS = [
+    'type', 'command', 'key', 'value', 'timestamp', 'request_id', 'error_code', 'node_hash',
+    'reply', 'internal request', 'external request', 'put', 'get', 'delete',
+    '\x00', '\x01', '\x06', '\x10', 'items', 'keys', 'results', 'ring_version', 'hint',
+    'batch_put', 'batch_get', 'batch_delete', 'r', 'w', 'partition chunk', 'transfer_id', 'sequence', 'last',
+    'membership', 'hash ring', 'info', 'membership check', 'anti entropy', 'range', 'depth', 'level', 'digests',
+    'hlc', 'context', 'siblings', 'partitioner'
+]
+_WELL_KNOWN_TAGS = dict((string, 'w' + chr(index)) for index, string in enumerate(WELL_KNOWN_STRINGS))
+
+_BYTES = [chr(i) for i in xrange(256)]
+_LENGTH = struct.Struct('>I')
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+_MIN_INT, _MAX_INT = -2 ** 63, 2 ** 63 - 1
+
+
+def _encode(obj, write):
+    obj_type = type(obj)
+    if obj_type is str:
+        tag = _WELL_KNOWN_TAGS.get(obj)
+        if tag:
+            write(tag)
+        elif len(obj) < 256:
+            write('b')
+            write(_BYTES[len(obj)])
+            write(obj)
+        else:
+            write('s')
+            write(_LENGTH.pack(len(obj)))
+            write(obj)
+    elif obj_type is dict:
+        if len(obj) < 256:
+            write('m')
+            write(_BYTES[len(obj)])
+        else:
+            write('M')
+            write(_LENGTH.pack(len(obj)))
+        for key, value in obj.iteritems():
+            _encode(key, write)
+            _encode(value, write)
+    elif obj_type is unicode:
+        tag = _WELL_KNOWN_TAGS.get(obj)
+        if tag:
+            write(tag)
+        else:
+            data = obj.encode('utf-8')
+            write('u')
+            write(_LENGTH.pack(len(data)))
+            write(data)
+    elif obj_type is list or obj_type is tuple:
+        if len(obj) < 256:
+            write('l')
+            write(_BYTES[len(obj)])
+        else:
+            write('L')
+            write(_LENGTH.pack(len(obj)))
+        for item in obj:
+            _encode(item, write)
+    elif obj is None:
+        write('N')
+    elif obj_type is bool:
+        write('T' if obj else 'F')
+    elif obj_type is int or obj_type is long:
+        if 0 <= obj < 256:
+            write('c')
+            write(_BYTES[obj])
+        elif _MIN_INT <= obj <= _MAX_INT:
+            write('i')
+            write(_INT.pack(obj))
+        else:
+            data = str(obj)
+            write('n')
+            write(_BYTES[len(data)])
+            write(data)
+    elif obj_type is float:
+        write('d')
+        write(_FLOAT.pack(obj))
+    else:
+        raise TypeError('cannot encode {!r}'.format(obj))
+
+
+def encode(obj):
+    """
+    Returns:
+        the compact binary encoding of obj, made of dicts, lists, tuples, str, unicode, int, long, float, bool and None.
+        str values are sent as raw bytes, so values need not be text.
+    """
+    parts = []
+    _encode(obj, parts.append)
+    return ''.join(parts)
+
+
+def _decode(data, offset):
+    tag = data[offset]
+    if tag == 'w':
+        return WELL_KNOWN_STRINGS[ord(data[offset + 1])], offset + 2
+    elif tag == 'b':
+        end = offset + 2 + ord(data[offset + 1])
+        return data[offset + 2:end], end
+    elif tag == 'm' or tag == 'M':
+        if tag == 'm':
+            length, offset = ord(data[offset + 1]), offset + 2
+        else:
+            length, offset = _LENGTH.unpack_from(data, offset + 1)[0], offset + 5
+        obj = {}
+        for _ in xrange(length):
+            key, offset = _decode(data, offset)
+            obj[key], offset = _decode(data, offset)
+        return obj, offset
+    elif tag == 'c':
+        return ord(data[offset + 1]), offset + 2
+    elif tag == 's' or tag == 'u':
+        start = offset + 5
+        end = start + _LENGTH.unpack_from(data, offset + 1)[0]
+        if tag == 'u':
+            return data[start:end].decode('utf-8'), end
+        return data[start:end], end
+    elif tag == 'l' or tag == 'L':
+        if tag == 'l':
+            length, offset = ord(data[offset + 1]), offset + 2
+        else:
+            length, offset = _LENGTH.unpack_from(data, offset + 1)[0], offset + 5
+        obj = []
+        for _ in xrange(length):
+            item, offset = _decode(data, offset)
+            obj.append(item)
+        return obj, offset
+    elif tag == 'N':
+        return None, offset + 1
+    elif tag == 'T':
+        return True, offset + 1
+    elif tag == 'F':
+        return False, offset + 1
+    elif tag == 'i':
+        return _INT.unpack_from(data, offset + 1)[0], offset + 9
+    elif tag == 'n':
+        end = offset + 2 + ord(data[offset + 1])
+        return long(data[offset + 2:end]), end
+    elif tag == 'd':
+        return _FLOAT.unpack_from(data, offset + 1)[0], offset + 9
+    raise ValueError('unknown tag {!r} at offset {}'.format(tag, offset))
+
+
+def decode(data):
+    """
+    Returns:
+        the object encoded in data by encode().
+
+    Raises:
+        ValueError if data is not a valid encoding.
+    """
+    try:
+        obj, offset = _decode(data, 0)
+    except (IndexError, struct.error) as e:
+        raise ValueError('truncated message: {}'.format(e))
+    if offset != len(data):
+        raise ValueError('{} trailing bytes after message'.format(len(data) - offset))
+    return obj
+
+
+def pack_frame(message):
+    """ Returns message encoded as a binary frame."""
+    payload = encode(message)
+    return FRAME_HEADER.pack(FRAME_MARKER, len(payload)) + payload
+
+
+class MessageChannel(asynchat.async_chat):
+    """
+    asynchat channel exchanging whole messages, in binary frames or as JSON followed by a terminator.
+    ----------
+        -incoming data is read with recv_into straight into a reusable bytearray, and messages are decoded from
+         buffer views of it: a message is never joined from fragments, only its decoded values are copied out.
+        -the buffer grows to fit the largest frame seen and shrinks back after SHRINK_AFTER_DRAINS drains without
+         another large frame, so a stream of large frames reuses one allocation.
+        -a channel created with framing=None, i.e. the accepting end of a connection, picks the framing from the first
+         byte it receives and replies in the same framing, so JSON clients keep working.
+        -subclasses implement _process_message(message) and send with push(self.pack_message(message)).
+    """
+
+    def __init__(self, sock=None, framing=None, terminator="\r\n", buffer_size=RECEIVE_BUFFER_SIZE):
+        """
+        Args:
+        ----------
+        sock (socket, optional):
+            connected socket for the accepting end of a connection; create_socket/connect otherwise.
+        framing (str, optional):
+            FRAMING_BINARY or FRAMING_JSON to send in, None to detect it from the first byte received.
+        terminator (str, optional):
+            terminator following JSON messages, defaults to "\\r\\n".
+        buffer_size (int, optional):
+            initial size of the receive buffer in bytes, defaults to RECEIVE_BUFFER_SIZE.
+        """
+        asynchat.async_chat.__init__(self, sock)
+        self._framing = framing
+        self._json_terminator = terminator
+        self._buffer_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        # unprocessed data is self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+        # offset from self._start already searched for the JSON terminator
+        self._scanned = 0
+        self._drains_since_growth = 0
+
+    @property
+    def framing(self):
+        return self._framing
+
+    def pack_message(self, message):
+        """ Returns message packed for this channel's framing."""
+        if self._framing == FRAMING_JSON:
+            return json.dumps(message) + self._json_terminator
+        return pack_frame(message)
+
+    def handle_read(self):
+        """
+        Implements asyncore.dispatcher's handle_read method.
+            -receives into the free tail of the buffer, making room for the frame being read first, then processes
+             every complete message.
+        """
+        self._reserve(self._next_message_size())
+        num_bytes = self._recv_into(memoryview(self._buffer)[self._end:])
+        if not num_bytes:
+            return
+        self._end += num_bytes
+        self._process_buffer()
+
+    def _recv_into(self, view):
+        """
+        Socket recv_into with asyncore.dispatcher.recv's error handling.
+
+        Returns:
+            number of bytes received, 0 if none were available or the connection was closed.
+        """
+        try:
+            num_bytes = self.socket.recv_into(view)
+        except socket.error as e:
+            if e.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            if e.args[0] == errno.EWOULDBLOCK:
+                return 0
+            raise
+        if not num_bytes:
+            self.handle_close()
+        return num_bytes
+
+    def _next_message_size(self):
+        """ Returns the size of the next message if known from its frame header, else the size of a frame header."""
+        available = self._end - self._start
+        if self._framing == FRAMING_BINARY and available >= FRAME_HEADER.size:
+            return FRAME_HEADER.size + self._frame_length()
+        return FRAME_HEADER.size
+
+    def _frame_length(self):
+        marker, length = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        if marker != FRAME_MARKER or length > MAX_FRAME_SIZE:
+            raise ValueError('invalid frame header {!r}'.format(str(self._buffer[self._start:self._start + FRAME_HEADER.size])))
+        return length
+
+    def _reserve(self, message_size):
+        """
+        Makes sure the buffer has room for message_size bytes from self._start and some free space at its end,
+        moving the unprocessed data to the front or growing the buffer if needed.
+        """
+        available = self._end - self._start
+        if message_size > self._buffer_size:
+            self._drains_since_growth = 0
+        elif available == 0 and len(self._buffer) > self._buffer_size:
+            self._drains_since_growth += 1
+            if self._drains_since_growth >= SHRINK_AFTER_DRAINS:
+                # drop the room made for large frames
+                self._buffer = bytearray(self._buffer_size)
+        if available == 0:
+            self._start = self._end = 0
+        size = max(message_size, available + 1)
+        if self._start + size <= len(self._buffer) and self._end < len(self._buffer):
+            return
+        if size > len(self._buffer):
+            grown = bytearray(max(size, 2 * len(self._buffer)))
+            grown[:available] = memoryview(self._buffer)[self._start:self._end]
+            self._buffer = grown
+        else:
+            # the regions may overlap, so copy through a slice
+            self._buffer[:available] = self._buffer[self._start:self._end]
+        self._start, self._end = 0, available
+
+    def _process_buffer(self):
+        """ Passes every complete message in the buffer to _process_message."""
+        while self._start < self._end:
+            if self._framing is None:
+                if self._buffer[self._start] == ord(FRAME_MARKER):
+                    self._framing = FRAMING_BINARY
+                else:
+                    self._framing = FRAMING_JSON
+
+            if self._framing == FRAMING_JSON:
+                end = self._buffer.find(self._json_terminator, self._start + self._scanned, self._end)
+                if end < 0:
+                    self._scanned = max(0, self._end - self._start - len(self._json_terminator) + 1)
+                    return
+                message = json.loads(buffer(self._buffer, self._start, end - self._start)[:])
+                self._start = end + len(self._json_terminator)
+                self._scanned = 0
+            else:
+                if self._end - self._start < FRAME_HEADER.size:
+                    return
+                length = self._frame_length()
+                payload_start = self._start + FRAME_HEADER.size
+                if self._end - payload_start < length:
+                    return
+                message = decode(buffer(self._buffer, payload_start, length))
+                self._start = payload_start + length
+
+            self._process_message(message)
+
+    def _process_message(self, message):
+        raise NotImplementedError
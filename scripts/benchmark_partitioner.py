@@ -0,0 +1,57 @@
+"""
+    benchmark_partitioner.py
+    ~~~~~~~~~~~~
+    Measures the key hashing throughput of every partitioner available, and the balance of the keys it places on rings
+    of 10 and 100 nodes, with one token per node and with vnodes: the share of the keys held by the busiest node
+    relative to an even split.
+
+    Run with:
+    cd PynamoDB; python ../scripts/benchmark_partitioner.py
+"""
+
+import collections
+import time
+
+import util
+from consistent_hash_ring import ConsistentHashRing
+from partitioner import PARTITIONERS
+
+KEY_LENGTHS = [16, 1024]
+NUM_KEYS = 200000
+RINGS = [(10, 1), (10, 64), (100, 1), (100, 64)]
+
+
+def hashes_per_second(key_hash, keys):
+    start = time.time()
+    for key in keys:
+        key_hash(key)
+    return len(keys) / (time.time() - start)
+
+
+def max_load(ring, key_hashes):
+    """ Returns the keys of the busiest primary node over those of an even split."""
+    loads = collections.Counter(ring.get_responsible_node_hashes(key_hash)[0] for key_hash in key_hashes)
+    return max(loads.values()) / (float(len(key_hashes)) / len(ring))
+
+
+def main():
+    names = sorted(PARTITIONERS)
+    rings = [ConsistentHashRing(node_hashes=[util.get_hash('node{}'.format(index)) for index in xrange(num_nodes)], vnodes=vnodes)
+             for num_nodes, vnodes in RINGS]
+
+    print '{:>10}'.format('') + ''.join('{:>16}'.format('{}B keys/s'.format(length)) for length in KEY_LENGTHS) + \
+        ''.join('{:>14}'.format('{}x{} load'.format(num_nodes, vnodes)) for num_nodes, vnodes in RINGS)
+    for name in names:
+        key_hash = PARTITIONERS[name].key_hash
+        throughputs = []
+        for length in KEY_LENGTHS:
+            keys = ['{:0{}d}'.format(index, length) for index in xrange(NUM_KEYS / 10 if length > 100 else NUM_KEYS)]
+            throughputs.append(hashes_per_second(key_hash, keys))
+        key_hashes = [key_hash('key{}'.format(index)) for index in xrange(NUM_KEYS)]
+        loads = [max_load(ring, key_hashes) for ring in rings]
+        print '{:>10}'.format(name) + ''.join('{:>16.0f}'.format(throughput) for throughput in throughputs) + \
+            ''.join('{:>14.3f}'.format(load) for load in loads)
+
+
+if __name__ == '__main__':
+    main()
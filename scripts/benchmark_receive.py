@@ -0,0 +1,93 @@
+"""
+    benchmark_receive.py
+    ~~~~~~~~~~~~
+    Measures receive throughput of binary frames of 1 KB, 64 KB and 16 MB through MessageChannel's bytearray receive
+    buffer, against the previous receive path that collected asynchat fragments and joined them per frame.
+
+    Run with:
+    cd PynamoDB; python ../scripts/benchmark_receive.py
+"""
+
+import asynchat
+import asyncore
+import socket
+import threading
+import time
+
+from wire_protocol import MessageChannel, FRAME_HEADER, FRAMING_BINARY, decode, pack_frame
+
+SIZES = [(1024, 20000), (64 * 1024, 2000), (16 * 1024 * 1024, 10)]
+
+
+class JoiningChannel(asynchat.async_chat):
+    """ Previous receive path: asynchat byte-count terminators, fragments joined at each terminator."""
+
+    def __init__(self, sock):
+        asynchat.async_chat.__init__(self, sock)
+        self._read_buffer = []
+        self._frame_length = None
+        self.set_terminator(FRAME_HEADER.size)
+        self.num_messages = 0
+
+    def collect_incoming_data(self, data):
+        self._read_buffer.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self._read_buffer)
+        self._read_buffer = []
+        if self._frame_length is None:
+            _, self._frame_length = FRAME_HEADER.unpack(data)
+            self.set_terminator(self._frame_length)
+            return
+        self._frame_length = None
+        self.set_terminator(FRAME_HEADER.size)
+        decode(data)
+        self.num_messages += 1
+
+
+class CountingChannel(MessageChannel):
+
+    def __init__(self, sock):
+        MessageChannel.__init__(self, sock, framing=FRAMING_BINARY)
+        self.num_messages = 0
+
+    def _process_message(self, message):
+        self.num_messages += 1
+
+
+def run(channel_class, frame, count):
+    """ Returns the seconds taken to receive count copies of frame on a channel_class."""
+    sender, receiver = socket.socketpair()
+    channel = channel_class(receiver)
+    data = frame * max(1, (1024 * 1024) / len(frame))
+    num_writes = count / (len(data) / len(frame))
+
+    def send():
+        for _ in xrange(num_writes):
+            sender.sendall(data)
+
+    start = time.time()
+    thread = threading.Thread(target=send)
+    thread.start()
+    while channel.num_messages < num_writes * (len(data) / len(frame)):
+        asyncore.loop(timeout=1, count=1)
+    elapsed = time.time() - start
+    thread.join()
+    channel.close()
+    sender.close()
+    return elapsed, channel.num_messages
+
+
+def main():
+    print '{:>10} {:>18} {:>18} {:>8}'.format('size', 'joined MB/s', 'bytearray MB/s', 'speedup')
+    for size, count in SIZES:
+        frame = pack_frame({'key': 'k' * 64, 'value': 'v' * size})
+        results = []
+        for channel_class in (JoiningChannel, CountingChannel):
+            elapsed, num_messages = run(channel_class, frame, count)
+            results.append(num_messages * len(frame) / elapsed / 1024 / 1024)
+        print '{:>10} {:>18.1f} {:>18.1f} {:>7.2f}x'.format(size, results[0], results[1], results[1] / results[0])
+
+
+if __name__ == '__main__':
+    main()
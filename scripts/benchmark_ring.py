@@ -0,0 +1,58 @@
+"""
+    benchmark_ring.py
+    ~~~~~~~~~~~~
+    Measures ConsistentHashRing lookups per second on rings of 10, 100 and 1000 nodes, with one token per node and
+    with vnodes, against the previous lookup that walked the ring clockwise for every key, and the time taken to
+    rebuild the preference lists after a membership change.
+
+    Run with:
+    cd PynamoDB; python ../scripts/benchmark_ring.py
+"""
+
+import bisect
+import time
+
+import util
+from consistent_hash_ring import ConsistentHashRing
+
+NODE_COUNTS = [10, 100, 1000]
+VNODES = [1, 64]
+NUM_KEYS = 100000
+
+
+class WalkingRing(ConsistentHashRing):
+    """ Previous lookup: a debug log, then a walk clockwise from the key collecting num_replicas distinct nodes."""
+
+    def get_responsible_node_hashes(self, key_hash=None):
+        self.logger.debug('get_responsible_node_hashes.  key_hash, num_replicas: {}, {}'.format(key_hash, self.num_replicas))
+        if self._tokens and key_hash:
+            return self.preference_list(bisect.bisect_left(self._tokens, key_hash), exclude='')
+        else:
+            return list()
+
+
+def lookups_per_second(ring, key_hashes):
+    get_responsible_node_hashes = ring.get_responsible_node_hashes
+    start = time.time()
+    for key_hash in key_hashes:
+        get_responsible_node_hashes(key_hash)
+    return len(key_hashes) / (time.time() - start)
+
+
+def main():
+    key_hashes = [util.get_hash('key{}'.format(index)) for index in xrange(NUM_KEYS)]
+    print '{:>6} {:>7} {:>16} {:>16} {:>8} {:>11}'.format('nodes', 'vnodes', 'walk lookups/s', 'cached lookups/s', 'speedup', 'rebuild ms')
+    for num_nodes in NODE_COUNTS:
+        node_hashes = [util.get_hash('node{}'.format(index)) for index in xrange(num_nodes)]
+        for vnodes in VNODES:
+            walking = lookups_per_second(WalkingRing(node_hashes=node_hashes, vnodes=vnodes), key_hashes)
+            ring = ConsistentHashRing(node_hashes=node_hashes[1:], vnodes=vnodes)
+            start = time.time()
+            ring.add_node_hash(node_hashes[0])
+            rebuild = time.time() - start
+            cached = lookups_per_second(ring, key_hashes)
+            print '{:>6} {:>7} {:>16.0f} {:>16.0f} {:>7.2f}x {:>11.1f}'.format(num_nodes, vnodes, walking, cached, cached / walking, rebuild * 1000)
+
+
+if __name__ == '__main__':
+    main()
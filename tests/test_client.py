@@ -0,0 +1,236 @@
+"""
+    test_client.py
+    ~~~~~~~~~~~~
+    Tests that PynamoClientPool pipelines requests, matches replies to their futures by request id, routes by ring and
+    fails over to another replica when one is down, and splits batches by replica, answering per key.  also tests that
+    writable() only reports queued requests, which the loop writes together, and that waiting on a future blocks rather
+    than polls.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import asyncore
+import socket
+import time
+import unittest
+
+import util
+import client
+from client import PynamoClient, PynamoClientPool
+from wire_protocol import MessageChannel, FRAMING_BINARY, FRAMING_JSON
+
+
+NODE_ADDRESS = 'localhost,50100,50101'
+OTHER_NODE_ADDRESS = 'localhost,50102,50103'
+
+
+class ReversingServer(asyncore.dispatcher):
+    """
+    Fake server that holds every batch of requests it reads and answers them in reverse order.  the value of a key is
+    the key, and keys starting with 'bad' fail.
+    """
+
+    def __init__(self, port, nodes=(NODE_ADDRESS,), num_replicas=1):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.bind(('localhost', port))
+        self.listen(5)
+        self.channels = []
+        self.nodes = nodes
+        self.num_replicas = num_replicas
+
+    def handle_accept(self):
+        sock, _ = self.accept()
+        self.channels.append(ReversingChannel(self, sock))
+
+    def kill(self):
+        """ Closes every connection and stops listening, as a server that died would."""
+        for channel in self.channels:
+            channel.close()
+        self.close()
+
+
+class ReversingChannel(MessageChannel):
+
+    def __init__(self, server, sock):
+        MessageChannel.__init__(self, sock)
+        self.server = server
+        self.requests = []
+
+    def _process_message(self, request):
+        self.requests.append(request)
+
+    def handle_read(self):
+        MessageChannel.handle_read(self)
+        for request in reversed(self.requests):
+            if request['command'] == 'ring':
+                nodes = {util.get_hash(node_address): node_address for node_address in self.server.nodes}
+                reply = {'error_code': '\x00', 'nodes': nodes, 'num_replicas': self.server.num_replicas}
+            elif request['command'].startswith('batch_'):
+                keys = [key for key, _ in request['items']] if 'items' in request else request['keys']
+                reply = {'error_code': '\x00', 'results': [self.result(key) for key in keys]}
+            else:
+                reply = {'error_code': '\x00', 'value': request['key']}
+            reply['request_id'] = request['request_id']
+            reply['ring_version'] = 'version'
+            self.push(self.pack_message(reply))
+        self.requests = []
+
+    def result(self, key):
+        if key.startswith('bad'):
+            return {'error_code': '\x06'}
+        return {'error_code': '\x00', 'value': key}
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.port = 50100
+        self.server = ReversingServer(self.port)
+        self.pool = PynamoClientPool([('localhost', self.port)], connections_per_server=2, token_aware=False)
+
+    def tearDown(self):
+        self.pool.close()
+        for channel in self.server.channels:
+            channel.close()
+        self.server.close()
+
+    def test_replies_matched_by_request_id(self):
+        futures = [self.pool.get(str(i)) for i in xrange(100)]
+        replies = self.pool.wait(futures, timeout=5)
+        self.assertEqual([reply['value'] for reply in replies], [str(i) for i in xrange(100)])
+        self.assertEqual(len(self.server.channels), 2)
+        self.assertEqual([channel.framing for channel in self.server.channels], [FRAMING_BINARY] * 2)
+
+    def test_json_framing(self):
+        pool = PynamoClientPool([('localhost', self.port)], token_aware=False, framing=FRAMING_JSON)
+        self.assertEqual(pool.get('key').result(timeout=5)['value'], 'key')
+        self.assertEqual(self.server.channels[-1].framing, FRAMING_JSON)
+        pool.close()
+
+    def test_callback(self):
+        values = []
+        future = self.pool.put('key', 'value')
+        future.add_done_callback(lambda future: values.append(future.result()['value']))
+        future.result(timeout=5)
+        self.assertEqual(values, ['key'])
+
+    def test_token_aware_routing(self):
+        pool = PynamoClientPool([('localhost', self.port)])
+        pool.refresh_ring().result(timeout=5)
+        self.assertEqual(pool.ring_version, 'version')
+        future = pool.get('key')
+        self.assertEqual(future.address, ('localhost', 50100))
+        self.assertEqual(future.result(timeout=5)['value'], 'key')
+        pool.close()
+
+    def test_dead_replica(self):
+        """ requests to a dead replica go to the other one, which is used until the dead one accepts connections again."""
+        nodes = (NODE_ADDRESS, OTHER_NODE_ADDRESS)
+        self.server.nodes, self.server.num_replicas = nodes, 2
+        other_server = ReversingServer(self.port + 2, nodes, 2)
+        dead_address = ('localhost', self.port + 2)
+        pool = PynamoClientPool([('localhost', self.port)], connections_per_server=1)
+        pool.refresh_ring().result(timeout=5)
+        pool.wait([pool.put(str(i), 'value') for i in xrange(20)], timeout=5)
+        self.assertEqual(len(other_server.channels), 1)
+
+        other_server.kill()
+        futures = [pool.get(str(i)) for i in xrange(20)]
+        replies = pool.wait(futures, timeout=5)
+        self.assertEqual([reply['value'] for reply in replies], [str(i) for i in xrange(20)])
+        self.assertEqual(set(future.address for future in futures), set([('localhost', self.port)]))
+        self.assertIn(dead_address, pool._unreachable_addresses)
+
+        # still in the ring and refusing connections, so still skipped after the ring is fetched again
+        pool.refresh_ring().result(timeout=5)
+        self.assertEqual(pool.get('key').result(timeout=5)['value'], 'key')
+        self.assertIn(dead_address, pool._unreachable_addresses)
+
+        other_server = ReversingServer(self.port + 2, nodes, 2)
+        pool.refresh_ring().result(timeout=5)
+        deadline = time.time() + 5
+        while dead_address in pool._unreachable_addresses and time.time() < deadline:
+            asyncore.loop(timeout=0.01, count=1)
+        self.assertNotIn(dead_address, pool._unreachable_addresses)
+        pool.close()
+        other_server.kill()
+
+    def test_batch(self):
+        """ a batch is split by the replica of each key, and answered with a result per key in order, failed ones included."""
+        nodes = (NODE_ADDRESS, OTHER_NODE_ADDRESS)
+        self.server.nodes = nodes
+        other_server = ReversingServer(self.port + 2, nodes)
+        pool = PynamoClientPool([('localhost', self.port)], connections_per_server=1)
+        pool.refresh_ring().result(timeout=5)
+        keys = [str(i) for i in xrange(20)] + ['bad key']
+        reply = pool.batch_get(keys).result(timeout=5)
+        self.assertEqual(reply['results'][:-1], [{'error_code': '\x00', 'value': key} for key in keys[:-1]])
+        self.assertEqual(reply['results'][-1], {'error_code': '\x06'})
+        self.assertTrue(other_server.channels)
+        self.assertEqual(pool.batch_put([]).result(timeout=5), {'error_code': '\x00', 'results': []})
+
+        # the part meant for a dead server goes to the live one
+        other_server.kill()
+        reply = pool.batch_put([(key, 'value') for key in keys]).result(timeout=5)
+        self.assertEqual([result['error_code'] for result in reply['results']], ['\x00'] * 20 + ['\x06'])
+        pool.close()
+
+    def test_queued_writes(self):
+        connection = self.pool._connection(('localhost', self.port))
+        while not connection.connected:
+            asyncore.loop(timeout=0.01, count=1)
+        futures = [connection.send_request({'command': 'get', 'key': str(i)}) for i in xrange(3)]
+
+        # writable() only reports the queued requests
+        for _ in xrange(3):
+            self.assertTrue(connection.writable())
+        self.assertEqual(len(connection._write_buffer), 3)
+        self.assertFalse(connection.producer_fifo)
+
+        # the next pass of the loop writes them together; the server reads them in one go, so answers them reversed
+        replies = []
+        for future in futures:
+            future.add_done_callback(lambda future: replies.append(future.result()['value']))
+        self.pool.wait(futures, timeout=5)
+        self.assertEqual(replies, ['2', '1', '0'])
+        self.assertFalse(connection.writable())
+
+    def test_result_blocks(self):
+        """ result() waits on the socket map for the time left rather than polling it in a loop."""
+        silent = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        silent.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        silent.bind(('localhost', self.port + 4))
+        silent.listen(5)
+        pool = PynamoClientPool([('localhost', self.port + 4)], token_aware=False)
+        future = pool.get('key')
+        polls = []
+        poll = client._poll
+        client._poll = lambda timeout: polls.append(timeout) or poll(timeout)
+        try:
+            start = time.time()
+            self.assertRaises(socket.timeout, future.result, 0.3)
+        finally:
+            client._poll = poll
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertLess(len(polls), 10)
+        pool.close()
+        silent.close()
+
+    def test_shared_messages(self):
+        pynamo_client = PynamoClient('localhost', self.port)
+        calls = [('put', ('key', 'value', 2, 'context')), ('get', ('key', 1)), ('delete', ('key',)),
+                 ('batch_put', ([('key', 'value')], 3)), ('batch_get', (['key'],)), ('batch_delete', (['key'], 2))]
+        for command, args in calls:
+            getattr(pynamo_client, command)(*args)
+            self.assertEqual(getattr(self.pool, command)(*args).request, pynamo_client.requests[-1])
+        self.assertEqual(pynamo_client.requests[0], {'command': 'put', 'key': 'key', 'value': 'value', 'w': 2, 'context': 'context'})
+        pynamo_client.close()
+
+    def test_lost_connection(self):
+        self.pool.close()
+        self.server.close()
+        future = PynamoClientPool([('localhost', self.port + 1)], token_aware=False).get('key')
+        self.assertEqual(future.result(timeout=5)['error_code'], '\x10')
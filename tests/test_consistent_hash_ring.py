@@ -49,3 +49,56 @@ class TestSequenceFunctions(unittest.TestCase):
         self.consistent_hash_ring = consistent_hash_ring.ConsistentHashRing(node_hashes)
         responsible_node_hashes =  self.consistent_hash_ring.get_responsible_node_hashes('EE', 3)
         self.assertEqual(responsible_node_hashes, ['F', 'A', 'B'])
+
+    def test_preference_list_cache(self):
+        node_hashes = [util.get_hash(str(x)) for x in xrange(10)]
+        ring = consistent_hash_ring.ConsistentHashRing(node_hashes, vnodes=8)
+        key_hashes = [util.get_key_hash('key{}'.format(x)) for x in xrange(200)]
+        for key_hash in key_hashes:
+            index = consistent_hash_ring.bisect.bisect_left(ring.tokens, util.key_token(key_hash))
+            responsible_node_hashes = ring.get_responsible_node_hashes(key_hash)
+            self.assertIsInstance(responsible_node_hashes, tuple)
+            self.assertIs(responsible_node_hashes, ring.preference_list(index))
+            # the walk used for exclusions agrees with the cache
+            self.assertEqual(responsible_node_hashes, ring.preference_list(index, exclude='not a node'))
+        self.assertIs(ring.get_responsible_node_hashes(util.token_key_bound(ring.tokens[-1] + 1)), ring.preference_list(0))
+        self.assertIs(ring.token_node_hashes(ring.tokens[3]), ring.preference_list(3))
+
+        ring.remove_node_hash(node_hashes[0])
+        for key_hash in key_hashes:
+            self.assertNotIn(node_hashes[0], ring.get_responsible_node_hashes(key_hash))
+        ring.add_node_hash(node_hashes[0])
+        self.assertEqual(len(ring.tokens), 80)
+        self.assertEqual(ring.get_responsible_node_hashes(None), ())
+
+    def test_diff(self):
+        node_hashes = [util.get_hash(str(x)) for x in xrange(10)]
+        ring = consistent_hash_ring.ConsistentHashRing(node_hashes, vnodes=8)
+        self.assertEqual(ring.diff(consistent_hash_ring.ConsistentHashRing(node_hashes, vnodes=8)), [])
+        self.assertEqual(ring.diff(consistent_hash_ring.ConsistentHashRing()), [])
+
+        without = ring.without_node_hash(node_hashes[0])
+        self.assertEqual(len(ring.tokens), 80)
+        self.assertEqual(len(without.tokens), 72)
+        changes = ring.diff(without)
+        self.assertTrue(changes)
+        for (low, high), node_hashes_before, node_hashes_after in changes:
+            self.assertIn(node_hashes[0], node_hashes_before)
+            self.assertNotIn(node_hashes[0], node_hashes_after)
+        # adjacent ranges that changed the same way are merged
+        for ((_, high), before, after), ((low, _), next_before, next_after) in zip(changes, changes[1:]):
+            self.assertFalse(high == low and (before, after) == (next_before, next_after))
+
+        # the ranges reported are exactly those of the keys whose replicas change
+        highs = [high for (_, high), _, _ in changes]
+        for x in xrange(2000):
+            key_hash = util.get_key_hash('key{}'.format(x))
+            before = ring.get_responsible_node_hashes(key_hash)
+            after = without.get_responsible_node_hashes(key_hash)
+            index = consistent_hash_ring.bisect.bisect_left(highs, util.key_token(key_hash)) % len(changes)
+            (low, high), node_hashes_before, node_hashes_after = changes[index]
+            in_range = (low < util.key_token(key_hash) <= high) if low < high else \
+                (util.key_token(key_hash) > low or util.key_token(key_hash) <= high)
+            self.assertEqual(in_range, before != after)
+            if in_range:
+                self.assertEqual((before, after), (node_hashes_before, node_hashes_after))
@@ -0,0 +1,76 @@
+"""
+    test_event_loop.py
+    ~~~~~~~~~~~~
+    Tests EventLoop's callbacks and timers, and that it wakes for socket events and io callbacks.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import asyncore
+import socket
+import time
+import unittest
+
+from event_loop import EventLoop
+
+
+class ReadingChannel(asyncore.dispatcher):
+
+    def __init__(self, sock, socket_map):
+        asyncore.dispatcher.__init__(self, sock, map=socket_map)
+        self.data = []
+
+    def handle_read(self):
+        self.data.append(self.recv(1024))
+
+    def writable(self):
+        return False
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.socket_map = dict()
+        self.loop = EventLoop(socket_map=self.socket_map, max_wait=0.5)
+        self.calls = []
+
+    def test_call_soon(self):
+        self.loop.call_soon(self.calls.append, 1)
+        self.loop.call_soon(lambda: self.loop.call_soon(self.calls.append, 3))
+        self.loop.call_soon(self.calls.append, 2)
+        self.loop.run_once()
+        self.assertEqual(self.calls, [1, 2])
+        self.loop.run_once()
+        self.assertEqual(self.calls, [1, 2, 3])
+
+    def test_call_later(self):
+        self.loop.call_later(0.05, self.calls.append, 'later')
+        self.loop.call_later(0.01, self.calls.append, 'sooner')
+        self.loop.call_later(0.02, self.calls.append, 'cancelled').cancel()
+        start = time.time()
+        while len(self.calls) < 2:
+            self.loop.run_once()
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(self.calls, ['sooner', 'later'])
+
+    def test_run_forever(self):
+        self.loop.call_later(0.01, self.loop.stop)
+        self.loop.call_soon(lambda: 1 / 0)
+        self.loop.run_forever()
+        self.assertFalse(self.loop.running)
+        self.assertEqual(self.loop.metrics['callbacks'], 2)
+
+    def test_io_callback(self):
+        sender, receiver = socket.socketpair()
+        channel = ReadingChannel(receiver, self.socket_map)
+        self.loop.add_io_callback(lambda: self.calls.append(''.join(channel.data)))
+        sender.send('data')
+        start = time.time()
+        self.assertEqual(self.loop.run_once(), 1)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(self.calls, ['data'])
+        self.assertEqual(self.loop.run_once(), 0)
+        self.assertEqual(self.calls, ['data'])
+        channel.close()
+        sender.close()
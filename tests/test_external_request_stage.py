@@ -0,0 +1,96 @@
+"""
+    test_external_request_stage.py
+    ~~~~~~~~~~~~
+    Tests that ExternalRequestStage only processes the channels with replies ready, and that a channel is scheduled
+    once its coordinator has a reply.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import unittest
+
+from external_request_stage import ExternalRequestStage, ExternalRequestCoordinator
+
+EXTERNAL_PORT = 50300
+
+
+class PolledChannel(object):
+    """ Channel counting the times it is processed."""
+
+    def __init__(self):
+        self._scheduled = False
+        self.polls = 0
+
+    def process(self):
+        self.polls += 1
+
+    def handle_completion(self, coordinator):
+        self.completed = coordinator
+        self.stage.schedule(self)
+
+
+class FakeMembershipStage(object):
+
+    ring_version = 'version'
+
+
+class FakeInternalRequestStage(object):
+    """ Records the reply listener of every request handed to it, which tests answer."""
+
+    def __init__(self):
+        self.reply_listeners = []
+
+    def handle_internal_message(self, message=None, reply_listener=None, internal_channel=None):
+        self.reply_listeners.append(reply_listener)
+
+
+class FakeServer(object):
+
+    def __init__(self):
+        self._external_shutdown_flag = False
+        self.membership_stage = FakeMembershipStage()
+        self.internal_request_stage = FakeInternalRequestStage()
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.stage = ExternalRequestStage(server=self.server, external_port=EXTERNAL_PORT, hostname='localhost')
+        self.channels = [PolledChannel() for _ in xrange(3)]
+        for channel in self.channels:
+            channel.stage = self.stage
+            self.stage._channels.add(channel)
+
+    def tearDown(self):
+        self.stage._channels.clear()
+        self.stage.close()
+
+    def polls(self):
+        return [channel.polls for channel in self.channels]
+
+    def test_idle_channels_not_polled(self):
+        for _ in xrange(5):
+            self.stage.process()
+        self.assertEqual(self.polls(), [0, 0, 0])
+
+        # a channel scheduled several times before the stage runs is processed once
+        self.stage.schedule(self.channels[2])
+        self.stage.schedule(self.channels[2])
+        self.stage.process()
+        self.stage.process()
+        self.assertEqual(self.polls(), [0, 0, 1])
+
+    def test_channel_scheduled_on_reply(self):
+        channel = self.channels[0]
+        coordinator = ExternalRequestCoordinator(server=self.server, request={'command': 'get', 'request_id': 7}, channel=channel)
+        coordinator.process()
+        self.stage.process()
+        self.assertEqual(self.polls(), [0, 0, 0])
+
+        self.server.internal_request_stage.reply_listeners[0].send({'error_code': '\x00', 'value': 'value'})
+        self.assertIs(channel.completed, coordinator)
+        self.stage.process()
+        self.assertEqual(self.polls(), [1, 0, 0])
+        self.assertEqual(coordinator.reply, {'error_code': '\x00', 'value': 'value', 'request_id': 7, 'ring_version': 'version'})
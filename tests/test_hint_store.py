@@ -0,0 +1,79 @@
+"""
+    test_hint_store.py
+    ~~~~~~~~~~~~
+    Tests HintStore's add, iter_hints, remove and discard methods, and that hints survive a restart on a disk-backed engine.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import shutil
+import tempfile
+import unittest
+
+import util
+from hint_store import HintStore
+from log_persistence_engine import LogPersistenceEngine
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.h = HintStore()
+        self.node_hash = util.get_hash('node')
+        self.other_node_hash = util.get_hash('other node')
+        self.key = util.get_hash('key')
+        self.timestamp = util.current_time()
+
+    def test_add_iter_hints(self):
+        self.h.add(self.node_hash, self.key, 'put', 'value', self.timestamp)
+        self.h.add(self.other_node_hash, self.key, 'delete', None, self.timestamp)
+        self.assertEqual(list(self.h.iter_hints(self.node_hash)), [(self.key, 'value', self.timestamp, 'put')])
+        self.assertEqual(sorted(self.h.node_hashes), sorted([self.node_hash, self.other_node_hash]))
+        self.assertEqual(len(self.h), 2)
+
+    def test_newest_hint_wins(self):
+        newer_timestamp = util.add_time(self.timestamp, 1)
+        self.assertTrue(self.h.add(self.node_hash, self.key, 'put', 'new', newer_timestamp))
+        self.assertFalse(self.h.add(self.node_hash, self.key, 'put', 'old', self.timestamp))
+        self.assertEqual(list(self.h.iter_hints(self.node_hash)), [(self.key, 'new', newer_timestamp, 'put')])
+        self.assertEqual(len(self.h), 1)
+
+    def test_remove(self):
+        self.h.add(self.node_hash, self.key, 'put', 'value', self.timestamp)
+        self.h.add(self.node_hash, self.key, 'put', 'newer', util.add_time(self.timestamp, 1))
+        self.assertFalse(self.h.remove(self.node_hash, self.key, self.timestamp))
+        self.assertTrue(self.h.remove(self.node_hash, self.key, util.add_time(self.timestamp, 1)))
+        self.assertEqual(list(self.h.iter_hints(self.node_hash)), [])
+        self.assertEqual(self.h.node_hashes, [])
+
+    def test_discard(self):
+        for i in xrange(10):
+            self.h.add(self.node_hash, util.get_hash(str(i)), 'put', str(i), self.timestamp)
+        self.h.add(self.other_node_hash, self.key, 'put', 'value', self.timestamp)
+        self.h.discard(self.node_hash)
+        self.assertEqual(self.h.node_hashes, [self.other_node_hash])
+        self.assertEqual(len(self.h), 1)
+
+    def test_recovery(self):
+        directory = tempfile.mkdtemp()
+        try:
+            engine = LogPersistenceEngine(directory)
+            h = HintStore(persistence_engine=engine)
+            h.add(self.node_hash, self.key, 'put', 'value', self.timestamp)
+            engine.close()
+
+            engine = LogPersistenceEngine(directory)
+            h = HintStore(persistence_engine=engine)
+            self.assertEqual(h.node_hashes, [self.node_hash])
+            self.assertEqual(list(h.iter_hints(self.node_hash)), [(self.key, 'value', self.timestamp, 'put')])
+            engine.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_binary_keys(self):
+        keys = ['\x00' * util.KEY_HASH_BYTES, '~' + '\x00' * 15, '\xff' * util.KEY_HASH_BYTES]
+        for key in keys:
+            self.h.add(self.node_hash, key, 'put', 'value', self.timestamp)
+        self.h.add(self.other_node_hash, keys[0], 'put', 'value', self.timestamp)
+        self.assertEqual([key for key, _, _, _ in self.h.iter_hints(self.node_hash)], keys)
@@ -0,0 +1,65 @@
+"""
+    test_hybrid_logical_clock.py
+    ~~~~~~~~~~~~
+    Tests that HybridLogicalClock's timestamps always increase and order after the timestamps it observes, and the
+    conversion of the string timestamps versions were stamped with before.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import unittest
+
+import util
+from hybrid_logical_clock import HybridLogicalClock
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1400000000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.wall = FakeClock()
+        self.clock = HybridLogicalClock(max_offset=0.5, clock=self.wall)
+
+    def test_follows_wall_clock(self):
+        first = self.clock.now()
+        self.assertEqual(first, util.timestamp_from_seconds(self.wall.now))
+        self.wall.now += 1
+        self.assertEqual(self.clock.now(), util.add_time(first, 1))
+
+    def test_never_goes_backwards(self):
+        timestamps = [self.clock.now() for _ in xrange(100)]
+        self.wall.now -= 10
+        timestamps.extend(self.clock.now() for _ in xrange(100))
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+        # the counter breaks the ties, the millisecond stays that of the latest wall clock reading
+        self.assertEqual(timestamps[-1] >> util.LOGICAL_BITS, timestamps[0] >> util.LOGICAL_BITS)
+
+    def test_update(self):
+        remote = util.add_time(self.clock.now(), 0.2)
+        self.assertTrue(self.clock.update(remote))
+        self.assertGreater(self.clock.now(), remote)
+        self.assertTrue(self.clock.update(remote - 1))
+        self.assertEqual(self.clock.metrics['observed'], 1)
+
+    def test_update_beyond_max_offset(self):
+        remote = util.add_time(self.clock.now(), 60)
+        self.assertFalse(self.clock.update(remote))
+        self.assertLess(self.clock.now(), remote)
+        self.assertEqual(self.clock.metrics['rejected'], 1)
+
+    def test_legacy_timestamps(self):
+        self.assertEqual(util.to_timestamp('2014-05-13 16:53:20.250000'), util.timestamp_from_seconds(1400000000.25))
+        self.assertEqual(util.to_timestamp('2014-05-13 16:53:20'), util.timestamp_from_seconds(1400000000))
+        self.assertEqual(util.to_timestamp(12345), 12345)
+        self.assertIsNone(util.to_timestamp(None))
+        self.assertRaises(ValueError, util.to_timestamp, 'yesterday')
+        self.assertEqual(str(util.to_datetime(util.timestamp_from_seconds(1400000000.25))), '2014-05-13 16:53:20.250000')
@@ -0,0 +1,610 @@
+"""
+    test_internal_request_stage.py
+    ~~~~~~~~~~~~
+    Tests that PartitionTransfer streams items in bounded, acknowledged chunks with at most a window of them in flight,
+    that failure repair streams tombstones along with the values of a range, that coordinators answer the client
+    once a read or write quorum has replied, that batches answer per key and hand off writes for a down replica, and
+    that pooled channels multiplex requests to a peer, time them out and fail them when the connection drops, and that
+    InternalRequestStage only steps the coordinators that are ready.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import asyncore
+import collections
+import socket
+import time
+import unittest
+
+import util
+from hybrid_logical_clock import HybridLogicalClock
+from internal_request_stage import InternalRequestCoordinator, InternalRequestStage, PartitionTransfer, REQUEST_TIMEOUT
+from persistence_stage import PersistenceStage
+from timer_wheel import TimerWheel
+from wire_protocol import MessageChannel
+
+PEER_PORT = 50200
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Recorder(object):
+    """ Listener recording every message it is sent."""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message):
+        self.messages.append(message)
+
+
+class FakeMembershipStage(object):
+    """
+    Knows the port each peer listens on, on localhost, and records the contact failures reported.  replicas maps keys to
+    their responsible nodes, and handoff_node_hashes lists the nodes hints go to, in ring order.
+    """
+
+    def __init__(self, ports):
+        self.ports = ports
+        self.replicas = dict()
+        self.handoff_node_hashes = []
+        self.contact_failures = []
+
+    def node_address(self, node_hash):
+        return 'localhost', self.ports[node_hash]
+
+    def get_responsible_node_hashes(self, key):
+        return self.replicas[key]
+
+    def get_handoff_node_hash(self, key, exclude=()):
+        for node_hash in self.handoff_node_hashes:
+            if node_hash not in exclude:
+                return node_hash
+
+    def report_contact_failure(self, node_hash=None):
+        self.contact_failures.append(node_hash)
+
+
+class FakeInternalRequestStage(object):
+    """ Records the coordinators scheduled and the requests sent to other nodes, which tests answer through their listener."""
+
+    def __init__(self):
+        self._metrics = collections.Counter()
+        self.scheduled = []
+        self.requests = []
+
+    def schedule(self, coordinator):
+        self.scheduled.append(coordinator)
+
+    def send_request(self, node_hash=None, message=None, listener=None, coordinator=None, timeout=None, on_timeout=None):
+        self.requests.append((node_hash, message, listener))
+
+
+class SteppedCoordinator(object):
+    """ Coordinator counting the times it is stepped, complete once done is set."""
+
+    def __init__(self):
+        self._scheduled = False
+        self._channels = []
+        self.steps = 0
+        self.done = False
+
+    def process(self):
+        self.steps += 1
+        return self.done
+
+    def _cancel_timers(self):
+        pass
+
+
+class FakeServer(object):
+    """ Just enough of PynamoServer for a PersistenceStage and InternalRequestCoordinators, on a fake clock."""
+
+    def __init__(self, node_hash, ports=None):
+        self.node_hash = node_hash
+        self.num_replicas = 3
+        self.read_quorum = 2
+        self.write_quorum = 2
+        self.vector_clocks = False
+        self.terminator = '\r\n'
+        self.clock = HybridLogicalClock()
+        self.time = FakeClock()
+        self.timer_wheel = TimerWheel(clock=self.time)
+        self.membership_stage = FakeMembershipStage(ports or {})
+        self.internal_request_stage = FakeInternalRequestStage()
+        self.persistence_stage = PersistenceStage(server=self)
+
+    def advance(self, seconds):
+        self.time.now += seconds
+        self.timer_wheel.advance()
+
+
+class FakePeer(asyncore.dispatcher):
+    """ Fake node handing every message it receives to handler(channel, message), and sending back the reply it returns, if any."""
+
+    def __init__(self, port, handler):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.bind(('localhost', port))
+        self.listen(5)
+        self.handler = handler
+        self.channels = []
+        self.messages = []
+
+    def handle_accept(self):
+        sock, _ = self.accept()
+        self.channels.append(FakePeerChannel(self, sock))
+
+    def kill(self):
+        for channel in self.channels:
+            channel.close()
+        self.close()
+
+
+class FakePeerChannel(MessageChannel):
+
+    def __init__(self, peer, sock):
+        MessageChannel.__init__(self, sock)
+        self.peer = peer
+
+    def _process_message(self, message):
+        self.peer.messages.append(message)
+        reply = self.peer.handler(self, message)
+        if reply is not None:
+            self.reply(reply)
+
+    def reply(self, reply):
+        self.push(self.pack_message(reply))
+
+
+def ack(message, error_code='\x00'):
+    return {'type': 'reply', 'error_code': error_code, 'node_hash': 'peer', 'transfer_id': message['transfer_id'], 'sequence': message['sequence']}
+
+
+def peer_reply(message, **fields):
+    """ Returns the reply of the peer to a request sent over a pooled channel."""
+    return dict(type='reply', error_code='\x00', node_hash=util.get_hash('peer'), request_id=message['request_id'], **fields)
+
+
+def run_until(condition, step=lambda: None, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        asyncore.loop(timeout=0.01, count=1)
+        step()
+    return condition()
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.peer_node_hash = util.get_hash('peer')
+        self.server = FakeServer(util.get_hash('node'), ports={self.peer_node_hash: PEER_PORT})
+        self.peer = None
+        self.channels = []
+        self.stage = None
+
+    def tearDown(self):
+        for channel in self.channels:
+            channel.close()
+        if self.peer:
+            self.peer.kill()
+        if self.stage:
+            self.stage.handle_close()
+
+    def start_stage(self, pool_size=2):
+        """ Replaces the server's fake InternalRequestStage with a real one, whose pooled channels connect to the peer."""
+        self.stage = InternalRequestStage(server=self.server, internal_port=PEER_PORT + 1, hostname='localhost', pool_size=pool_size)
+        self.server.internal_request_stage = self.stage
+
+    def start_peer(self, handler):
+        self.peer = FakePeer(PEER_PORT, handler)
+
+    def transfer(self, items, **kwargs):
+        completion = Recorder()
+        transfer = PartitionTransfer(server=self.server, node_hash=self.peer_node_hash, items=items, completion_listener=completion, **kwargs)
+        self.channels.append(transfer.channel)
+        return transfer, completion
+
+    def items(self, num_items, value='value'):
+        return [(util.get_key_hash(str(i)), value, i) for i in xrange(num_items)]
+
+    def chunks(self):
+        return [message for message in self.peer.messages if message['type'] == 'partition chunk']
+
+    def test_chunking(self):
+        self.start_peer(lambda channel, message: ack(message))
+        items = self.items(10)
+        transfer, completion = self.transfer(items, max_chunk_items=3)
+        self.assertTrue(run_until(lambda: transfer.complete, transfer.process))
+        transfer.process()
+
+        chunks = self.chunks()
+        self.assertEqual([len(chunk['items']) for chunk in chunks], [3, 3, 3, 1])
+        self.assertEqual([chunk['sequence'] for chunk in chunks], [0, 1, 2, 3])
+        self.assertEqual([chunk['last'] for chunk in chunks], [False, False, False, True])
+        self.assertEqual([tuple(item) for chunk in chunks for item in chunk['items']], items)
+        self.assertEqual(completion.messages, [True])
+
+        # about 133 bytes per item: a chunk closes once it holds 250
+        self.peer.messages = []
+        transfer, completion = self.transfer(self.items(5, 'v' * 100), max_chunk_bytes=250)
+        self.assertTrue(run_until(lambda: transfer.complete, transfer.process))
+        self.assertEqual([len(chunk['items']) for chunk in self.chunks()], [2, 2, 1])
+
+    def test_flow_control(self):
+        held = []
+        self.start_peer(lambda channel, message: held.append((channel, message)))
+        transfer, completion = self.transfer(self.items(10), max_chunk_items=1, window=2)
+        run_until(lambda: len(held) >= 2, transfer.process)
+        for _ in xrange(10):
+            transfer.process()
+            asyncore.loop(timeout=0.01, count=1)
+        self.assertEqual(len(held), 2)
+
+        # each acknowledgement lets one more chunk go out
+        channel, message = held.pop(0)
+        channel.reply(ack(message))
+        self.assertTrue(run_until(lambda: len(self.chunks()) == 3, transfer.process))
+        self.assertEqual(self.chunks()[-1]['sequence'], 2)
+        self.assertFalse(transfer.complete)
+
+        while not transfer.complete:
+            self.assertTrue(run_until(lambda: held, transfer.process))
+            channel, message = held.pop(0)
+            channel.reply(ack(message))
+            run_until(lambda: transfer.complete or held, transfer.process)
+        transfer.process()
+        self.assertEqual(len(self.chunks()), 11)
+        self.assertEqual(completion.messages, [True])
+
+    def test_rejected_chunk(self):
+        self.start_peer(lambda channel, message: ack(message, error_code='\x06'))
+        transfer, completion = self.transfer(self.items(10), max_chunk_items=1)
+        self.assertTrue(run_until(lambda: transfer.complete, transfer.process))
+        transfer.process()
+        self.assertTrue(transfer.failed)
+        self.assertEqual(completion.messages, [False])
+
+    def test_timeout(self):
+        self.start_peer(lambda channel, message: None)
+        transfer, completion = self.transfer(self.items(10), max_chunk_items=1, timeout=30)
+        run_until(lambda: self.chunks(), transfer.process)
+        self.server.advance(29)
+        self.assertFalse(transfer.complete)
+        self.server.advance(2)
+        self.assertTrue(transfer.failed)
+        transfer.process()
+        self.assertEqual(completion.messages, [False])
+
+    def test_stream_partition_tombstones(self):
+        receiver = FakeServer(self.peer_node_hash)
+        receiver_coordinator = InternalRequestCoordinator(server=receiver)
+        self.start_peer(lambda channel, message: receiver_coordinator._handle_partition_chunk(message))
+
+        key, deleted_key = util.get_key_hash('key'), util.get_key_hash('deleted key')
+        timestamp = self.server.clock.now()
+        self.server.persistence_stage.put(key, 'value', timestamp)
+        self.server.persistence_stage.put(deleted_key, 'value', timestamp)
+        self.server.persistence_stage.delete(deleted_key, timestamp + 2)
+        # the receiver holds the value from a replica that missed the delete
+        receiver.persistence_stage.put(deleted_key, 'value', timestamp + 1)
+
+        coordinator = InternalRequestCoordinator(server=self.server)
+        coordinator._stream_partition(self.peer_node_hash, [(None, None)])
+        self.channels.extend(transfer.channel for transfer in coordinator._transfers)
+        self.assertTrue(run_until(lambda: not coordinator._transfers, coordinator.process))
+
+        self.assertEqual(receiver.persistence_stage.get(key)['value'], 'value')
+        reply = receiver.persistence_stage.get(deleted_key)
+        self.assertEqual((reply['error_code'], reply['timestamp']), ('\x01', timestamp + 2))
+
+    def external_request(self, command, **fields):
+        """ Starts the coordinator of an external request for self.key, replicated on this node, a and b."""
+        self.key = util.get_key_hash('key')
+        self.a, self.b = util.get_hash('a'), util.get_hash('b')
+        self.server.membership_stage.replicas[self.key] = [self.server.node_hash, self.a, self.b]
+        message = dict(type='external request', command=command, key=self.key, timestamp=self.server.clock.now(), **fields)
+        reply_listener = Recorder()
+        coordinator = InternalRequestCoordinator(server=self.server, message=message, reply_listener=reply_listener)
+        coordinator.process()
+        return coordinator, reply_listener
+
+    def reply(self, node_hash, **fields):
+        """ Hands the coordinator the reply of node_hash to the request it was sent."""
+        for request_node_hash, _, listener in self.server.internal_request_stage.requests:
+            if request_node_hash == node_hash:
+                listener.send(dict(type='reply', error_code='\x00', node_hash=node_hash, **fields))
+
+    def test_get_quorum(self):
+        timestamp = self.server.clock.now()
+        self.server.persistence_stage.put(util.get_key_hash('key'), 'value', timestamp)
+        coordinator, reply_listener = self.external_request('get')
+        self.assertEqual([node_hash for node_hash, _, _ in self.server.internal_request_stage.requests], [self.a, self.b])
+        self.assertEqual(reply_listener.messages, [])
+
+        # R = 2: the local replica and a have replied, b is still pending
+        self.reply(self.a, value='value', timestamp=timestamp)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00', 'value': 'value'}])
+        self.assertFalse(coordinator.complete)
+        self.reply(self.b, value='value', timestamp=timestamp)
+        self.assertEqual(len(reply_listener.messages), 1)
+        self.assertTrue(coordinator.complete)
+
+    def test_put_quorum(self):
+        coordinator, reply_listener = self.external_request('put', value='value')
+        self.reply(self.b)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00'}])
+        self.assertFalse(coordinator.complete)
+        self.reply(self.a)
+        self.assertTrue(coordinator.complete)
+
+    def test_stale_put(self):
+        # the local replica already holds a newer version: the put is superseded, which counts towards W
+        self.server.persistence_stage.put(util.get_key_hash('key'), 'newer value', util.add_time(self.server.clock.now(), 60))
+        coordinator, reply_listener = self.external_request('put', value='value', w=1)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00'}])
+        self.assertEqual(self.server.persistence_stage.get(self.key)['value'], 'newer value')
+
+    def test_quorum_capped(self):
+        for command, fields in [('get', {'r': 5}), ('put', {'w': 5, 'value': 'value'})]:
+            self.server.internal_request_stage.requests = []
+            coordinator, reply_listener = self.external_request(command, **fields)
+            self.assertEqual(coordinator._quorum(coordinator._message, 3), 3)
+            self.reply(self.a)
+            self.assertEqual(reply_listener.messages, [])
+            self.reply(self.b)
+            self.assertEqual(len(reply_listener.messages), 1)
+
+    def batch_request(self, command, keys, **fields):
+        """
+        Starts the coordinator of an external batch for keys: the first is replicated on this node, a and b, the others
+        on a, b and c.
+        """
+        self.a, self.b, self.c, self.d = [util.get_hash(name) for name in 'abcd']
+        self.keys = [util.get_key_hash(key) for key in keys]
+        self.server.membership_stage.replicas[self.keys[0]] = [self.server.node_hash, self.a, self.b]
+        for key in self.keys[1:]:
+            self.server.membership_stage.replicas[key] = [self.a, self.b, self.c]
+        if command == 'batch_put':
+            fields['items'] = [[key, 'value ' + str(index)] for index, key in enumerate(self.keys)]
+        else:
+            fields['keys'] = self.keys
+        message = dict(type='external request', command=command, timestamp=self.server.clock.now(), **fields)
+        reply_listener = Recorder()
+        coordinator = InternalRequestCoordinator(server=self.server, message=message, reply_listener=reply_listener)
+        coordinator.process()
+        return coordinator, reply_listener
+
+    def batch_requests(self):
+        """ Returns node_hash -> (request, listener) of the batches sent to other nodes."""
+        return {node_hash: (request, listener) for node_hash, request, listener in self.server.internal_request_stage.requests}
+
+    def batch_reply(self, node_hash, results=None, error_code='\x00'):
+        """ Hands the coordinator the reply of node_hash to its batch, successful for every key unless results are given."""
+        request, listener = self.batch_requests()[node_hash]
+        num_keys = len(request.get('items') or request.get('keys'))
+        reply = dict(type='reply', error_code=error_code, node_hash=node_hash)
+        if error_code == '\x00':
+            reply['results'] = results or [{'error_code': '\x00'}] * num_keys
+        listener.send(reply)
+
+    def test_batch_put(self):
+        coordinator, reply_listener = self.batch_request('batch_put', ['key', 'other key'])
+        requests = self.batch_requests()
+        self.assertEqual(sorted(requests), sorted([self.a, self.b, self.c]))
+        self.assertEqual([key for key, _ in requests[self.a][0]['items']], self.keys)
+        self.assertEqual([key for key, _ in requests[self.c][0]['items']], self.keys[1:])
+        self.assertEqual(self.server.persistence_stage.get(self.keys[0])['value'], 'value 0')
+
+        # the first key has W = 2 with a's reply, the other needs b or c as well
+        self.batch_reply(self.a)
+        self.assertEqual(reply_listener.messages, [])
+        self.batch_reply(self.c)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00', 'results': [{'error_code': '\x00'}] * 2}])
+        self.assertFalse(coordinator.complete)
+        self.batch_reply(self.b)
+        self.assertTrue(coordinator.complete)
+
+    def test_batch_partial_failure(self):
+        coordinator, reply_listener = self.batch_request('batch_get', ['key', 'other key', 'missing key'])
+        timestamp = self.server.clock.now()
+        found = {'error_code': '\x00', 'value': 'value', 'timestamp': timestamp}
+        missing = {'error_code': '\x01', 'value': None}
+        for node_hash in [self.a, self.b, self.c]:
+            self.batch_reply(node_hash, [missing, found, missing])
+        # the local replica misses the first key too; a reply per key, in order
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00', 'results': [missing, {'error_code': '\x00', 'value': 'value'}, missing]}])
+
+        # a node that fails its whole batch fails only the keys it holds
+        self.server.internal_request_stage.requests = []
+        coordinator, reply_listener = self.batch_request('batch_put', ['key', 'other key'], w=3)
+        self.batch_reply(self.a, [{'error_code': '\x00'}, {'error_code': '\x06'}])
+        self.batch_reply(self.b)
+        self.batch_reply(self.c, error_code='\x06')
+        results = reply_listener.messages[0]['results']
+        self.assertEqual(results[0]['error_code'], '\x00')
+        self.assertNotEqual(results[1]['error_code'], '\x00')
+
+    def test_batch_hinted_handoff(self):
+        self.server.membership_stage.handoff_node_hashes = [util.get_hash('d')]
+        coordinator, reply_listener = self.batch_request('batch_delete', ['key', 'other key'], w=3)
+        self.batch_reply(self.b)
+        self.batch_reply(self.c)
+        self.batch_reply(self.a, error_code='\x10')
+
+        # both keys a held go to d in one batch, with a hint naming a
+        request, _ = self.batch_requests()[self.d]
+        self.assertEqual((request['command'], request['keys'], request['hint']), ('batch_delete', self.keys, self.a))
+        self.assertEqual(self.server.internal_request_stage._metrics['hinted_writes'], 2)
+        self.assertEqual(reply_listener.messages, [])
+
+        # the hinted writes count towards W
+        self.batch_reply(self.d)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00', 'results': [{'error_code': '\x00'}] * 2}])
+        self.assertTrue(coordinator.complete)
+
+        # d is down as well and no node is left for the hints: the client is answered once every node has replied
+        self.server.internal_request_stage.requests = []
+        coordinator, reply_listener = self.batch_request('batch_put', ['key'], w=3)
+        self.batch_reply(self.a, error_code='\x10')
+        self.batch_reply(self.b)
+        self.assertEqual(reply_listener.messages, [])
+        self.batch_reply(self.d, error_code='\x10')
+        self.assertEqual(len(self.server.internal_request_stage.requests), 3)
+        self.assertEqual(len(reply_listener.messages), 1)
+        self.assertTrue(coordinator.complete)
+
+    def test_batch_hint_stored(self):
+        coordinator = InternalRequestCoordinator(server=self.server)
+        keys = [util.get_key_hash('key'), util.get_key_hash('other key')]
+        timestamp, replica = self.server.clock.now(), util.get_hash('replica')
+        reply = coordinator._handle_request_locally({'type': 'internal request', 'command': 'batch_put', 'items': [[key, 'value'] for key in keys],
+                                                     'timestamp': timestamp, 'hint': replica})
+        self.assertEqual(reply['results'], [{'error_code': '\x00'}] * 2)
+        self.assertEqual(sorted(self.server.persistence_stage._hint_store.iter_hints(replica)), sorted((key, 'value', timestamp, 'put') for key in keys))
+        self.assertEqual(self.server.persistence_stage.get(keys[0])['error_code'], '\x01')
+
+    def test_pooled_multiplexing(self):
+        held = []
+        self.start_peer(lambda channel, message: held.append((channel, message)))
+        self.start_stage(pool_size=2)
+        listeners = [Recorder() for _ in xrange(10)]
+        for n, listener in enumerate(listeners):
+            self.stage.send_request(node_hash=self.peer_node_hash, message={'type': 'internal request', 'command': 'get', 'n': n}, listener=listener)
+
+        # ten requests in flight on two connections, answered in reverse order
+        self.assertTrue(run_until(lambda: len(held) == 10))
+        self.assertEqual(len(self.peer.channels), 2)
+        self.assertEqual(sorted(channel.num_pending for channel in self.stage._pools[self.peer_node_hash]), [5, 5])
+        for channel, message in reversed(held):
+            channel.reply(peer_reply(message, n=message['n']))
+        self.assertTrue(run_until(lambda: all(listener.messages for listener in listeners)))
+        self.assertEqual([[reply['n'] for reply in listener.messages] for listener in listeners], [[n] for n in xrange(10)])
+
+        # a reply to a request that is no longer awaited is dropped
+        channel, message = held[0]
+        channel.reply(peer_reply(message, n=message['n']))
+        run_until(lambda: False, timeout=0.1)
+        self.assertEqual(len(listeners[0].messages), 1)
+        self.assertEqual([channel.num_pending for channel in self.stage._pools[self.peer_node_hash]], [0, 0])
+
+    def get_request(self):
+        """ Starts the coordinator of an external get answered by the peer alone."""
+        key = util.get_key_hash('key')
+        self.server.membership_stage.replicas[key] = [self.peer_node_hash]
+        message = {'type': 'external request', 'command': 'get', 'key': key, 'timestamp': self.server.clock.now()}
+        reply_listener = Recorder()
+        coordinator = InternalRequestCoordinator(server=self.server, message=message, reply_listener=reply_listener)
+        coordinator.process()
+        return coordinator, reply_listener
+
+    def test_pooled_timeout(self):
+        held = []
+        self.start_peer(lambda channel, message: held.append((channel, message)))
+        self.start_stage(pool_size=1)
+        coordinator, reply_listener = self.get_request()
+        self.assertTrue(run_until(lambda: held))
+
+        # unanswered in time: the request is sent again with a new id, and the late reply to the first is ignored
+        self.server.advance(REQUEST_TIMEOUT + 0.1)
+        self.assertTrue(run_until(lambda: len(held) == 2))
+        self.assertEqual(self.stage.metrics['retries'], 1)
+        self.assertNotEqual(held[0][1]['request_id'], held[1][1]['request_id'])
+        for channel, message in held:
+            channel.reply(peer_reply(message, value='value', timestamp=1))
+        self.assertTrue(run_until(lambda: reply_listener.messages))
+        run_until(lambda: False, timeout=0.1)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00', 'value': 'value'}])
+        self.assertEqual(self.server.membership_stage.contact_failures, [])
+
+        # after max_retries the peer is reported and the request fails
+        held[:] = []
+        coordinator, reply_listener = self.get_request()
+        for attempt in xrange(4):
+            self.assertTrue(run_until(lambda: len(held) == attempt + 1))
+            self.server.advance(REQUEST_TIMEOUT + 0.1)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x10', 'value': None}])
+        self.assertEqual(self.server.membership_stage.contact_failures, [self.peer_node_hash])
+
+    def test_pooled_connection_dropped(self):
+        held = []
+        self.start_peer(lambda channel, message: held.append((channel, message)))
+        self.start_stage(pool_size=1)
+        listeners = [Recorder() for _ in xrange(3)]
+        timeouts = []
+        for listener in listeners:
+            self.stage.send_request(node_hash=self.peer_node_hash, message={'type': 'internal request', 'command': 'get'}, listener=listener,
+                                    timeout=REQUEST_TIMEOUT, on_timeout=lambda: timeouts.append(True))
+        self.assertTrue(run_until(lambda: len(held) == 3))
+
+        # every request in flight fails once, the channel leaves the pool and the timeouts are cancelled
+        self.peer.kill()
+        self.assertTrue(run_until(lambda: all(listener.messages for listener in listeners)))
+        for listener in listeners:
+            self.assertEqual(listener.messages, [{'type': 'reply', 'error_code': '\x10', 'node_hash': self.peer_node_hash}])
+        self.assertEqual(self.stage._pools[self.peer_node_hash], [])
+        self.server.advance(REQUEST_TIMEOUT + 0.1)
+        self.assertEqual(timeouts, [])
+
+        # the next request opens a new connection
+        self.peer = FakePeer(PEER_PORT, lambda channel, message: peer_reply(message))
+        listener = Recorder()
+        self.stage.send_request(node_hash=self.peer_node_hash, message={'type': 'internal request', 'command': 'get'}, listener=listener)
+        self.assertTrue(run_until(lambda: listener.messages))
+        self.assertEqual(listener.messages[0]['error_code'], '\x00')
+
+    def test_ready_coordinators(self):
+        self.start_stage()
+        coordinators = [SteppedCoordinator() for _ in xrange(3)]
+        for coordinator in coordinators:
+            self.stage._add_coordinator(coordinator)
+        self.stage.process()
+        self.assertEqual([coordinator.steps for coordinator in coordinators], [1, 1, 1])
+
+        # nothing is ready: nothing is stepped
+        self.stage.process()
+        self.assertEqual([coordinator.steps for coordinator in coordinators], [1, 1, 1])
+
+        # a coordinator scheduled by several events is stepped once
+        for _ in xrange(3):
+            self.stage.schedule(coordinators[1])
+        coordinators[1].done = True
+        self.stage.process()
+        self.assertEqual([coordinator.steps for coordinator in coordinators], [1, 2, 1])
+        self.assertNotIn(coordinators[1], self.stage._coordinators)
+
+        # a finished coordinator is not stepped again
+        self.stage.schedule(coordinators[1])
+        self.stage.process()
+        self.assertEqual([coordinator.steps for coordinator in coordinators], [1, 2, 1])
+
+    def test_coordinator_stepped_on_reply(self):
+        held = []
+        self.start_peer(lambda channel, message: held.append((channel, message)))
+        self.start_stage()
+        coordinator, reply_listener = self.get_request()
+        steps = []
+        process = coordinator.process
+        coordinator.process = lambda: steps.append(True) or process()
+        self.stage._coordinators.add(coordinator)
+
+        # waiting for the peer: not stepped however often the stage runs
+        self.assertTrue(run_until(lambda: held, self.stage.process))
+        for _ in xrange(10):
+            self.stage.process()
+        self.assertEqual(steps, [])
+
+        channel, message = held[0]
+        channel.reply(peer_reply(message, value='value', timestamp=1))
+        self.assertTrue(run_until(lambda: steps, self.stage.process))
+        self.assertEqual(len(steps), 1)
+        self.assertEqual(reply_listener.messages, [{'error_code': '\x00', 'value': 'value'}])
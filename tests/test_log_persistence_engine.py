@@ -0,0 +1,175 @@
+"""
+    test_log_persistence_engine.py
+    ~~~~~~~~~~~~
+    Tests LogPersistenceEngine's put, get, delete methods, segment rollover and log replay on recovery.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import log_persistence_engine
+import persistence_stage
+import util
+from log_persistence_engine import LogPersistenceEngine
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.p = LogPersistenceEngine(self.directory)
+        self.key = util.get_hash('key')
+        self.timestamp = util.current_time()
+
+    def tearDown(self):
+        self.p.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self, **kwargs):
+        self.p.close()
+        self.p = LogPersistenceEngine(self.directory, **kwargs)
+
+    def test_put_get(self):
+        self.p.put(self.key, 'value', self.timestamp)
+        self.assertEqual(self.p.get(self.key), ('value', self.timestamp))
+
+    def test_overwrite(self):
+        self.p.put(self.key, 'old_value', self.timestamp)
+        self.p.put(self.key, 'new_value', self.timestamp)
+        self.assertEqual(self.p.get(self.key)[0], 'new_value')
+        self.assertEqual(self.p.keys(), [self.key])
+
+    def test_delete(self):
+        self.p.put(self.key, 'value', self.timestamp)
+        self.p.delete(self.key)
+        with self.assertRaises(KeyError):
+            self.p.get(self.key)
+        with self.assertRaises(KeyError):
+            self.p.delete(self.key)
+
+    def test_recovery(self):
+        for i in xrange(100):
+            self.p.put(util.get_hash(str(i)), str(i), self.timestamp)
+        self.p.delete(util.get_hash('0'))
+        self.reopen()
+
+        self.assertEqual(len(self.p.keys()), 99)
+        self.assertEqual(self.p.get(util.get_hash('50')), ('50', self.timestamp))
+        with self.assertRaises(KeyError):
+            self.p.get(util.get_hash('0'))
+
+    def test_segment_rollover(self):
+        self.reopen(max_segment_size=1024)
+        for i in xrange(100):
+            self.p.put(util.get_hash(str(i)), str(i), self.timestamp)
+        self.assertTrue(len(self.p.segment_ids) > 1)
+
+        self.reopen(max_segment_size=1024)
+        for i in xrange(100):
+            self.assertEqual(self.p.get(util.get_hash(str(i)))[0], str(i))
+
+    def test_torn_write_recovery(self):
+        self.p.put(self.key, 'value', self.timestamp)
+        self.p.close()
+        path = os.path.join(self.directory, os.listdir(self.directory)[0])
+        with open(path, 'ab') as f:
+            f.write('\x00\x01\x02')
+
+        self.p = LogPersistenceEngine(self.directory)
+        self.assertEqual(self.p.get(self.key)[0], 'value')
+        self.p.put(util.get_hash('other'), 'other', self.timestamp)
+        self.reopen()
+        self.assertEqual(self.p.get(util.get_hash('other'))[0], 'other')
+
+    def fill_segments(self, n):
+        for i in xrange(n):
+            self.p.put(util.get_hash(str(i % 20)), str(i), self.timestamp)
+
+    def compact(self):
+        while self.p.process():
+            pass
+
+    def test_compaction(self):
+        self.reopen(max_segment_size=1024, compaction_threshold=2, compaction_slice=3)
+        self.fill_segments(200)
+        self.p.delete(util.get_hash('0'))
+        num_segments = len(self.p.segment_ids)
+
+        self.compact()
+
+        self.assertTrue(len(self.p.segment_ids) < num_segments)
+        self.assertEqual(self.p.metrics['compactions'], 1)
+        self.assertTrue(self.p.metrics['reclaimed_bytes'] > 0)
+        for i in xrange(1, 20):
+            self.assertEqual(self.p.get(util.get_hash(str(i)))[0], str(180 + i))
+
+        self.reopen(max_segment_size=1024)
+        self.assertEqual(len(self.p.keys()), 19)
+        self.assertEqual(self.p.get(util.get_hash('19'))[0], '199')
+
+    def test_compaction_keeps_concurrent_writes(self):
+        self.reopen(max_segment_size=1024, compaction_threshold=2, compaction_slice=1)
+        self.fill_segments(200)
+        self.p.process()
+        self.p.put(util.get_hash('1'), 'concurrent', self.timestamp)
+        self.p.delete(util.get_hash('2'))
+        self.compact()
+
+        self.assertEqual(self.p.get(util.get_hash('1'))[0], 'concurrent')
+        with self.assertRaises(KeyError):
+            self.p.get(util.get_hash('2'))
+
+        self.reopen()
+        self.assertEqual(self.p.get(util.get_hash('1'))[0], 'concurrent')
+        with self.assertRaises(KeyError):
+            self.p.get(util.get_hash('2'))
+
+    def test_compaction_drops_expired_tombstones(self):
+        self.reopen(max_segment_size=1024, compaction_threshold=2, tombstone_grace_period=0)
+        self.fill_segments(20)
+        for i in xrange(20):
+            self.p.delete(util.get_hash(str(i)))
+        self.fill_segments(200)
+        for i in xrange(20):
+            self.p.delete(util.get_hash(str(i)))
+        self.p.put(util.get_hash('last'), 'last', self.timestamp)
+        self.compact()
+
+        self.assertTrue(self.p.metrics['dropped_tombstones'] > 0)
+        self.reopen()
+        self.assertEqual(self.p.keys(), [util.get_hash('last')])
+
+    def test_iter_items(self):
+        keys = sorted(util.get_hash(str(i)) for i in xrange(100))
+        for key in keys:
+            self.p.put(key, key, self.timestamp)
+        self.p.delete(keys[20])
+
+        self.assertEqual(list(self.p.iter_keys(keys[10], keys[30])), keys[11:20] + keys[21:31])
+        self.assertEqual(list(self.p.iter_items(keys[10], keys[12])), [(key, key, self.timestamp) for key in keys[11:13]])
+
+    def test_legacy_string_timestamps(self):
+        record = log_persistence_engine.pack_record(self.key, 'value', '2014-05-13 16:53:20.250000')
+        self.assertEqual(log_persistence_engine.unpack_record(record)[2], util.timestamp_from_seconds(1400000000.25))
+
+    def test_legacy_hex_keys(self):
+        self.p.put(self.key, 'value', self.timestamp)
+        self.p.put('short key', 'other', self.timestamp)
+        persistence_stage.PersistenceStage(persistence_engine=self.p)
+        self.reopen()
+        self.assertEqual(self.p.get(util.get_key_hash('key')), ('value', self.timestamp))
+        self.assertEqual(self.p.get('short key'), ('other', self.timestamp))
+        with self.assertRaises(KeyError):
+            self.p.get(self.key)
+
+        # the upgrade is recorded, so later stages don't scan the keys again
+        self.assertEqual(self.p.format_version, persistence_stage.FORMAT_VERSION)
+        other_key = util.get_hash('other key')
+        self.p.put(other_key, 'value', self.timestamp)
+        persistence_stage.PersistenceStage(persistence_engine=self.p)
+        self.assertEqual(self.p.get(other_key), ('value', self.timestamp))
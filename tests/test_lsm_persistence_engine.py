@@ -0,0 +1,130 @@
+"""
+    test_lsm_persistence_engine.py
+    ~~~~~~~~~~~~
+    Tests LSMPersistenceEngine's put, get, delete methods, memtable flushes, bloom filters, sorted keys and compaction.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import shutil
+import tempfile
+import unittest
+
+import util
+from lsm_persistence_engine import LSMPersistenceEngine, BloomFilter
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.p = LSMPersistenceEngine(self.directory, memtable_size=2048, index_interval=4, compaction_threshold=3)
+        self.timestamp = util.current_time()
+
+    def tearDown(self):
+        self.p.close()
+        shutil.rmtree(self.directory)
+
+    def reopen(self):
+        self.p.close()
+        self.p = LSMPersistenceEngine(self.directory, memtable_size=2048, index_interval=4, compaction_threshold=3)
+
+    def put_n(self, n, prefix=''):
+        for i in xrange(n):
+            self.p.put(util.get_hash(str(i)), prefix + str(i), self.timestamp)
+
+    def test_put_get_across_flushes(self):
+        self.put_n(100)
+        self.assertTrue(self.p.metrics['flushes'] > 0)
+        for i in xrange(100):
+            self.assertEqual(self.p.get(util.get_hash(str(i))), (str(i), self.timestamp))
+
+    def test_newest_value_wins(self):
+        self.put_n(100)
+        self.put_n(10, prefix='new')
+        self.assertEqual(self.p.get(util.get_hash('5'))[0], 'new5')
+        self.assertEqual(self.p.get(util.get_hash('50'))[0], '50')
+
+    def test_delete(self):
+        self.put_n(100)
+        self.p.delete(util.get_hash('5'))
+        with self.assertRaises(KeyError):
+            self.p.get(util.get_hash('5'))
+        with self.assertRaises(KeyError):
+            self.p.delete(util.get_hash('5'))
+        self.assertFalse(util.get_hash('5') in self.p.keys())
+
+    def test_keys_sorted(self):
+        self.put_n(100)
+        self.assertEqual(self.p.keys(), sorted(util.get_hash(str(i)) for i in xrange(100)))
+
+    def test_bloom_filter_negative_lookup(self):
+        self.put_n(100)
+        with self.assertRaises(KeyError):
+            self.p.get(util.get_hash('missing'))
+        self.assertEqual(self.p.metrics['bloom_filter_negatives'], 1)
+
+    def test_recovery(self):
+        self.put_n(100)
+        self.p.delete(util.get_hash('99'))
+        self.reopen()
+        self.assertEqual(len(self.p.keys()), 99)
+        self.assertEqual(self.p.get(util.get_hash('98'))[0], '98')
+
+    def test_compaction(self):
+        for prefix in ['a', 'b', 'c', 'd']:
+            self.put_n(50, prefix=prefix)
+        self.p.delete(util.get_hash('0'))
+        num_tables = len(self.p.table_ids)
+
+        while self.p.process():
+            pass
+
+        self.assertTrue(self.p.metrics['compactions'] > 0)
+        self.assertTrue(len(self.p.table_ids) < num_tables)
+        self.assertEqual(self.p.get(util.get_hash('1'))[0], 'd1')
+        with self.assertRaises(KeyError):
+            self.p.get(util.get_hash('0'))
+
+        self.reopen()
+        self.assertEqual(self.p.get(util.get_hash('49'))[0], 'd49')
+        self.assertEqual(len(self.p.keys()), 49)
+
+    def test_compaction_during_scan(self):
+        self.put_n(4000)
+        self.assertTrue(len(self.p.table_ids) >= 3)
+        scan = self.p.iter_items()
+        scanned = [next(scan)[0] for _ in xrange(100)]
+        while self.p.process():
+            pass
+        self.assertTrue(self.p.metrics['compactions'] > 0)
+        scanned.extend(key for key, _, _ in scan)
+        self.assertEqual(scanned, sorted(util.get_hash(str(i)) for i in xrange(4000)))
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter(100, 0.01)
+        for i in xrange(100):
+            bloom_filter.add(str(i))
+        bloom_filter = BloomFilter.from_string(bloom_filter.to_string())
+        for i in xrange(100):
+            self.assertTrue(str(i) in bloom_filter)
+        false_positives = sum(str(i) in bloom_filter for i in xrange(100, 10100))
+        self.assertTrue(false_positives < 300)
+
+    def test_iter_items(self):
+        self.put_n(100)
+        self.p.delete(util.get_hash('5'))
+        keys = sorted(util.get_hash(str(i)) for i in xrange(100) if i != 5)
+        self.assertEqual(list(self.p.iter_keys(keys[10], keys[60])), keys[11:61])
+        self.assertEqual([key for key, _, _ in self.p.iter_items(None, keys[3])], keys[:4])
+
+    def test_binary_keys(self):
+        keys = [util.get_key_hash(str(i)) for i in xrange(100)]
+        for i, key in enumerate(keys):
+            self.p.put(key, str(i), self.timestamp)
+        self.reopen()
+        self.assertTrue(self.p.metrics['flushes'] > 0)
+        for i, key in enumerate(keys):
+            self.assertEqual(self.p.get(key)[0], str(i))
+        self.assertEqual(list(self.p.keys()), sorted(keys))
@@ -0,0 +1,81 @@
+"""
+    test_merkle_tree.py
+    ~~~~~~~~~~~~
+    Tests MerkleTree's incremental updates, leaf ranges and digest comparison.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import random
+import unittest
+
+import util
+from merkle_tree import MerkleTree
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.low = util.get_token('low')
+        self.high = util.get_token('high')
+        self.keys = [util.get_key_hash(str(i)) for i in xrange(1000)]
+        self.timestamp = util.current_time()
+
+    def tearDown(self):
+        pass
+
+    def build(self, keys, low=None, high=None, depth=6):
+        tree = MerkleTree(low or self.low, high or self.high, depth)
+        for key in keys:
+            if key in tree:
+                tree.update(key, new_timestamp=self.timestamp)
+        return tree
+
+    def test_order_independent(self):
+        shuffled = list(self.keys)
+        random.shuffle(shuffled)
+        self.assertEqual(self.build(self.keys).root, self.build(shuffled).root)
+
+    def test_update_and_delete(self):
+        tree = self.build(self.keys)
+        root = tree.root
+        key = [key for key in self.keys if key in tree][0]
+        tree.update(key, self.timestamp, 'newer')
+        self.assertNotEqual(tree.root, root)
+        tree.update(key, 'newer', self.timestamp)
+        self.assertEqual(tree.root, root)
+        tree.update(key, self.timestamp, None)
+        self.assertEqual(tree.root, self.build([k for k in self.keys if k != key]).root)
+
+    def test_leaf_range(self):
+        tree = self.build([])
+        for key in self.keys:
+            if key in tree:
+                low, high = tree.leaf_range(tree.leaf_index(key))
+                token = util.key_token(key)
+                if low < high:
+                    self.assertTrue(low < token <= high)
+                else:
+                    self.assertTrue(token > low or token <= high)
+        self.assertEqual(tree.leaf_range(0)[0], self.low)
+        self.assertEqual(tree.leaf_range(2 ** tree.depth - 1)[1], self.high)
+
+    def test_wrapping_range(self):
+        tree = self.build(self.keys, low=self.high, high=self.low)
+        other = self.build(self.keys)
+        for key in self.keys:
+            self.assertTrue((key in tree) != (key in other))
+
+    def test_differing(self):
+        tree = self.build(self.keys)
+        missing = [key for key in self.keys if key in tree][0]
+        other = self.build([key for key in self.keys if key != missing])
+
+        indices = [0]
+        for level in xrange(tree.depth + 1):
+            indices = tree.differing(level, other.digests(level, indices))
+            self.assertEqual(len(indices), 1)
+            if level < tree.depth:
+                indices = tree.children(indices)
+        self.assertEqual(indices, [tree.leaf_index(missing)])
@@ -0,0 +1,42 @@
+"""
+    test_partitioner.py
+    ~~~~~~~~~~~~
+    Tests that every available partitioner hashes keys to fixed-width binary key hashes spread evenly over the ring,
+    that sha256 places keys as before partitioners were pluggable, and that unknown partitioners are refused.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import collections
+import unittest
+
+import partitioner
+import util
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def test_default(self):
+        default = partitioner.get_partitioner()
+        self.assertEqual(default.name, 'sha256')
+        self.assertEqual(default.key_hash('key'), util.get_key_hash('key'))
+        self.assertIn('md5', partitioner.PARTITIONERS)
+
+    def test_key_hashes(self):
+        for name, key_partitioner in partitioner.PARTITIONERS.items():
+            key_hash = key_partitioner.key_hash('key')
+            self.assertEqual(len(key_hash), util.KEY_HASH_BYTES, name)
+            self.assertIsInstance(key_hash, str)
+            self.assertEqual(key_partitioner.key_hash('key'), key_hash)
+            self.assertNotEqual(key_partitioner.key_hash('other key'), key_hash)
+
+    def test_distribution(self):
+        for name, key_partitioner in partitioner.PARTITIONERS.items():
+            counts = collections.Counter(util.key_token(key_partitioner.key_hash('key{}'.format(i))) >> 60 for i in xrange(16000))
+            self.assertEqual(len(counts), 16, name)
+            self.assertLess(max(counts.values()), 1200, name)
+            self.assertGreater(min(counts.values()), 800, name)
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, partitioner.get_partitioner, 'crc32')
@@ -1,14 +1,19 @@
 """
     test_persistence_stage.py
     ~~~~~~~~~~~~
-    Tests that PersistenceEngine's put, get, delete methods raise the correct error codes.
+    Tests that PersistenceEngine's put, get, delete methods raise the correct error codes, and that versions and
+    tombstones stored under legacy hex keys are moved to binary key hashes.
 
     Run tests with:
     clear; python -m unittest discover -v
 """
 
+import shutil
+import tempfile
 import unittest
-from persistence_stage import PersistenceStage
+from log_persistence_engine import LogPersistenceEngine
+from persistence_engine import DeletedKeyError
+from persistence_stage import PersistenceStage, FORMAT_VERSION
 import util
 
 
@@ -94,3 +99,53 @@ class TestSequenceFunctions(unittest.TestCase):
             self.fail()
 
 
+class FakeServer(object):
+
+    node_hash = util.get_hash('node')
+
+
+class TestLegacyKeys(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.engine = LogPersistenceEngine(self.directory)
+        self.timestamp = util.current_time()
+
+    def tearDown(self):
+        self.engine.close()
+        shutil.rmtree(self.directory)
+
+    def test_legacy_tombstones(self):
+        key, deleted_key = util.get_hash('key'), util.get_hash('deleted key')
+        self.engine.put(key, 'value', self.timestamp)
+        self.engine.put(deleted_key, 'value', self.timestamp)
+        self.engine.delete(deleted_key, self.timestamp + 1)
+        persistence_stage = PersistenceStage(server=FakeServer(), persistence_engine=self.engine)
+
+        self.assertEqual(self.engine.get(util.get_key_hash('key')), ('value', self.timestamp))
+        with self.assertRaises(DeletedKeyError) as context:
+            self.engine.get(util.get_key_hash('deleted key'))
+        self.assertEqual(context.exception.timestamp, self.timestamp + 1)
+        reply = persistence_stage.get(util.get_key_hash('deleted key'))
+        self.assertEqual((reply['error_code'], reply['timestamp']), ('\x01', self.timestamp + 1))
+
+        # the delete still orders an older version a replica sends later
+        persistence_stage.put(util.get_key_hash('deleted key'), 'value', self.timestamp)
+        self.assertEqual(persistence_stage.get(util.get_key_hash('deleted key'))['error_code'], '\x01')
+
+        # the legacy keys are left with tombstones already past the grace period, for compaction to drop
+        self.assertEqual(self.engine.keys(), [util.get_key_hash('key')])
+        legacy_tombstones = [(key, timestamp) for key, timestamp in self.engine.iter_tombstones() if util.from_legacy_key(key)]
+        self.assertEqual(sorted(key for key, _ in legacy_tombstones), sorted([key, deleted_key]))
+        for _, timestamp in legacy_tombstones:
+            self.assertTrue(self.engine._tombstone_expired(timestamp))
+        self.assertEqual(self.engine.format_version, FORMAT_VERSION)
+
+    def test_interrupted_upgrade(self):
+        """ an upgrade run again before it was recorded doesn't take the tombstones it left for deletes."""
+        key = util.get_hash('key')
+        self.engine.put(key, 'value', self.timestamp)
+        PersistenceStage(persistence_engine=self.engine)
+        self.engine.set_format_version(0)
+        PersistenceStage(persistence_engine=self.engine)
+        self.assertEqual(self.engine.get(util.get_key_hash('key')), ('value', self.timestamp))
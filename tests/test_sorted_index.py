@@ -0,0 +1,56 @@
+"""
+    test_sorted_index.py
+    ~~~~~~~~~~~~
+    Tests SortedKeyIndex's add, discard and range scans.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import random
+import unittest
+
+import util
+from sorted_index import SortedKeyIndex
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.keys = [util.get_hash(str(i)) for i in xrange(1000)]
+        self.index = SortedKeyIndex(load=8)
+        for key in self.keys:
+            self.index.add(key)
+
+    def tearDown(self):
+        pass
+
+    def test_add(self):
+        self.index.add(self.keys[0])
+        self.assertEqual(len(self.index), len(self.keys))
+        self.assertEqual(list(self.index), sorted(self.keys))
+
+    def test_discard(self):
+        for key in self.keys[:500]:
+            self.index.discard(key)
+        self.index.discard(util.get_hash('missing'))
+        self.assertEqual(list(self.index), sorted(self.keys[500:]))
+        self.assertFalse(self.keys[0] in self.index)
+        self.assertTrue(self.keys[500] in self.index)
+
+    def test_irange(self):
+        keys = sorted(self.keys)
+        low, high = keys[100], keys[700]
+        self.assertEqual(list(self.index.irange(low, high)), keys[101:701])
+        self.assertEqual(list(self.index.irange(None, high)), keys[:701])
+        self.assertEqual(list(self.index.irange(low, None)), keys[101:])
+        self.assertEqual(list(self.index.irange(high, low)), [])
+
+    def test_irange_while_modified(self):
+        keys = sorted(self.keys)
+        scanned = []
+        for key in self.index.irange():
+            scanned.append(key)
+            self.index.discard(random.choice(keys))
+            self.index.add(util.get_hash(str(random.random())))
+        self.assertEqual(scanned, sorted(set(scanned)))
@@ -0,0 +1,99 @@
+"""
+    test_timer_wheel.py
+    ~~~~~~~~~~~~
+    Tests that TimerWheel fires timers in deadline order within a tick of their deadline, on every level, and that
+    cancelled timers never fire.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import random
+import unittest
+
+from timer_wheel import TimerWheel
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(resolution=0.01, slots=8, levels=3, clock=self.clock)
+        self.fired = []
+
+    def fire(self, name):
+        self.fired.append((name, self.clock.now))
+
+    def run_until(self, end, step=0.01):
+        while self.clock.now < end:
+            self.clock.now += step
+            self.wheel.advance()
+
+    def test_fires_in_order(self):
+        delays = [random.uniform(0, 10) for _ in xrange(500)]
+        start = self.clock.now
+        for delay in delays:
+            self.wheel.schedule(delay, self.fire, delay)
+        self.assertEqual(len(self.wheel), 500)
+        self.run_until(start + 11, step=0.003)
+
+        self.assertEqual(len(self.fired), 500)
+        self.assertEqual(len(self.wheel), 0)
+        for delay, fired_at in self.fired:
+            self.assertGreaterEqual(fired_at - start, delay - 1e-9)
+            self.assertLess(fired_at - start, delay + 0.02)
+        # within a tick of each other at worst
+        fired_delays = [delay for delay, _ in self.fired]
+        for earlier, later in zip(fired_delays, fired_delays[1:]):
+            self.assertLess(earlier, later + 0.01)
+
+    def test_beyond_top_level(self):
+        # 8 ** 3 ticks of 10ms span 5.12s
+        start = self.clock.now
+        self.wheel.schedule(20, self.fire, 'far')
+        self.run_until(start + 19.9, step=0.05)
+        self.assertEqual(self.fired, [])
+        self.run_until(start + 20.1, step=0.05)
+        self.assertEqual([name for name, _ in self.fired], ['far'])
+
+    def test_clock_jump(self):
+        start = self.clock.now
+        self.wheel.schedule(0.5, self.fire, 'a')
+        self.wheel.schedule(3, self.fire, 'b')
+        self.clock.now += 60
+        self.assertEqual(self.wheel.advance(), 2)
+        self.assertEqual(sorted(name for name, _ in self.fired), ['a', 'b'])
+        self.wheel.schedule(0.05, self.fire, 'c')
+        self.run_until(start + 60.1)
+        self.assertEqual(self.fired[-1][0], 'c')
+
+    def test_cancel(self):
+        timers = [self.wheel.schedule(1, self.fire, i) for i in xrange(10)]
+        for timer in timers[::2]:
+            timer.cancel()
+        self.assertEqual(len(self.wheel), 5)
+        self.assertFalse(timers[0].active)
+        self.assertTrue(timers[1].active)
+        self.run_until(self.clock.now + 2)
+        self.assertEqual(sorted(name for name, _ in self.fired), [1, 3, 5, 7, 9])
+        self.assertFalse(timers[1].active)
+        timers[1].cancel()
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_callbacks_schedule_and_cancel(self):
+        later = self.wheel.schedule(0.5, self.fire, 'cancelled')
+        self.wheel.schedule(0.2, later.cancel)
+        self.wheel.schedule(0.2, lambda: self.wheel.schedule(0, self.fire, 'rescheduled'))
+        self.wheel.schedule(0.3, lambda: 1 / 0)
+        self.run_until(self.clock.now + 1)
+        self.assertEqual([name for name, _ in self.fired], ['rescheduled'])
+        self.assertEqual(self.wheel.metrics['expired'], 4)
@@ -0,0 +1,223 @@
+"""
+    test_tombstones.py
+    ~~~~~~~~~~~~
+    Tests that deletes leave timestamped tombstones in every persistence engine, that puts and deletes arriving
+    out of order, e.g. a hinted delete replayed after a newer put, are applied by timestamp, and that neither reads,
+    read repair nor anti-entropy bring back a key a lagging replica missed the delete of.  also tests that the in-memory
+    engine purges tombstones past their grace period, and that the tombstones any engine purges leave the Merkle trees.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import collections
+import shutil
+import tempfile
+import unittest
+
+import util
+from hybrid_logical_clock import HybridLogicalClock
+from internal_request_stage import InternalRequestCoordinator
+from log_persistence_engine import LogPersistenceEngine
+from lsm_persistence_engine import LSMPersistenceEngine
+from persistence_engine import PersistenceEngine, DeletedKeyError
+from persistence_stage import PersistenceStage
+
+
+class FakeInternalRequestStage(object):
+
+    def __init__(self):
+        self._metrics = collections.Counter()
+
+
+class FakeServer(object):
+    """ Just enough of PynamoServer to run a PersistenceStage and a coordinator's local handlers."""
+
+    def __init__(self, node_hash, persistence_engine=None):
+        self.node_hash = node_hash
+        self.num_replicas = 3
+        self.vector_clocks = False
+        self.clock = HybridLogicalClock()
+        self.internal_request_stage = FakeInternalRequestStage()
+        self.persistence_stage = PersistenceStage(server=self, persistence_engine=persistence_engine)
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.key = util.get_key_hash('key')
+        self.server = FakeServer(util.get_hash('node'))
+        self.coordinator = InternalRequestCoordinator(server=self.server)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def engines(self):
+        return [PersistenceEngine(),
+                LogPersistenceEngine(self.directory + '/log'),
+                LSMPersistenceEngine(self.directory + '/lsm', memtable_size=256, index_interval=4)]
+
+    def test_engine_tombstones(self):
+        timestamp = util.current_time()
+        for engine in self.engines():
+            engine.put(self.key, 'value', timestamp)
+            engine.delete(self.key, timestamp + 1)
+            with self.assertRaises(DeletedKeyError) as context:
+                engine.get(self.key)
+            self.assertEqual(context.exception.timestamp, timestamp + 1)
+            self.assertNotIn(self.key, list(engine.iter_keys()))
+
+            # a versioned delete of a key never stored still leaves its tombstone
+            other_key = util.get_key_hash('other key')
+            with self.assertRaises(KeyError):
+                engine.delete(other_key)
+            engine.delete(other_key, timestamp)
+            self.assertRaises(DeletedKeyError, engine.get, other_key)
+
+            engine.put(self.key, 'new value', timestamp + 2)
+            self.assertEqual(engine.get(self.key), ('new value', timestamp + 2))
+            engine.process()
+            if hasattr(engine, 'close'):
+                engine.close()
+
+    def test_expired_tombstones_purged(self):
+        engine = PersistenceEngine(tombstone_grace_period=60, purge_slice=2)
+        old, recent = util.add_time(util.current_time(), -120), util.current_time()
+        keys = [util.get_key_hash(str(i)) for i in xrange(4)]
+        for key in keys[:3]:
+            engine.delete(key, old)
+        engine.delete(keys[2], recent)
+        engine.delete(keys[3], recent)
+
+        # purge_slice heap entries per call, the oldest first; the one replaced by the newer delete is skipped
+        self.assertTrue(engine.process())
+        self.assertFalse(engine.process())
+        self.assertFalse(engine.process())
+        self.assertEqual(engine.metrics['dropped_tombstones'], 2)
+        self.assertEqual(list(engine.iter_tombstones()), sorted((key, recent) for key in keys[2:]))
+        for key in keys[:2]:
+            with self.assertRaises(KeyError) as context:
+                engine.get(key)
+            self.assertNotIsInstance(context.exception, DeletedKeyError)
+
+    def test_put_older_than_delete(self):
+        persistence_stage = self.server.persistence_stage
+        timestamp = self.server.clock.now()
+        persistence_stage.put(self.key, 'value', timestamp)
+        self.assertEqual(persistence_stage.delete(self.key, timestamp + 2)['error_code'], '\x00')
+        persistence_stage.put(self.key, 'value', timestamp + 1)
+        self.assertEqual(persistence_stage.get(self.key)['error_code'], '\x01')
+        persistence_stage.put(self.key, 'newer value', timestamp + 3)
+        self.assertEqual(persistence_stage.get(self.key)['value'], 'newer value')
+
+    def test_replayed_hinted_delete(self):
+        persistence_stage = self.server.persistence_stage
+        delete_timestamp = self.server.clock.now()
+        put_timestamp = self.server.clock.now()
+        persistence_stage.put(self.key, 'value', put_timestamp)
+
+        # the hinted delete was accepted before the put reached the owner, and is replayed after it
+        chunk = {'transfer_id': 'transfer', 'sequence': 0, 'items': [[self.key, None, delete_timestamp, 'delete']]}
+        self.assertEqual(self.coordinator._handle_partition_chunk(chunk)['error_code'], '\x00')
+        self.assertEqual(persistence_stage.get(self.key)['value'], 'value')
+
+        chunk['items'] = [[self.key, None, self.server.clock.now(), 'delete']]
+        self.coordinator._handle_partition_chunk(chunk)
+        self.assertEqual(persistence_stage.get(self.key)['error_code'], '\x01')
+
+    def replicas(self, value_timestamp, delete_timestamp):
+        """
+        Returns:
+            get replies of two replicas holding a delete at delete_timestamp, and of this node, which missed the delete
+            and holds the value written at value_timestamp.
+        """
+        persistence_stage = self.server.persistence_stage
+        persistence_stage.put(self.key, 'value', value_timestamp)
+        replies = {self.server.node_hash: persistence_stage.get(self.key)}
+        for name in ['a', 'b']:
+            replica = FakeServer(util.get_hash(name))
+            replica.persistence_stage.put(self.key, 'old value', min(value_timestamp, delete_timestamp) - 1)
+            replica.persistence_stage.delete(self.key, delete_timestamp)
+            replies[replica.node_hash] = replica.persistence_stage.get(self.key)
+        return replies
+
+    def test_read_after_delete(self):
+        value_timestamp = self.server.clock.now()
+        delete_timestamp = self.server.clock.now()
+        replies = self.replicas(value_timestamp, delete_timestamp)
+        self.assertEqual(self.coordinator._client_reply('get', replies), {'error_code': '\x01', 'value': None})
+
+        self.coordinator._handle_read_repair({self.key: replies})
+        # the lagging replica is sent the delete; the others aren't sent the deleted value
+        self.assertEqual(self.coordinator._transfers, [])
+        reply = self.server.persistence_stage.get(self.key)
+        self.assertEqual((reply['error_code'], reply['timestamp']), ('\x01', delete_timestamp))
+        self.assertEqual(self.server.internal_request_stage._metrics['read_repairs'], 1)
+
+    def test_read_after_newer_put(self):
+        delete_timestamp = self.server.clock.now()
+        value_timestamp = self.server.clock.now()
+        replies = self.replicas(value_timestamp, delete_timestamp)
+        self.assertEqual(self.coordinator._client_reply('get', replies), {'error_code': '\x00', 'value': 'value'})
+
+    def test_anti_entropy(self):
+        lagging = FakeServer(util.get_hash('lagging'))
+        lagging_coordinator = InternalRequestCoordinator(server=lagging)
+        timestamp = self.server.clock.now()
+        for server in [self.server, lagging]:
+            server.persistence_stage.put(self.key, 'value', timestamp)
+            server.persistence_stage.rebuild_merkle_trees([(0, 0)], depth=4)
+        tree = self.server.persistence_stage.merkle_tree(0, 0)
+        lagging_tree = lagging.persistence_stage.merkle_tree(0, 0)
+        self.assertEqual(tree.root, lagging_tree.root)
+
+        delete_timestamp = self.server.clock.now()
+        self.server.persistence_stage.delete(self.key, delete_timestamp)
+        self.assertNotEqual(tree.root, lagging_tree.root)
+        index = tree.leaf_index(self.key)
+        self.assertNotEqual(tree.digests(4, [index]), lagging_tree.digests(4, [index]))
+
+        # the lagging replica compares its leaf with this node's: it wants the delete rather than sending its value back
+        message = {'range': [0, 0], 'depth': 4, 'level': 4, 'leaves': {index: self.coordinator._leaf_versions(*tree.leaf_range(index))}}
+        reply = lagging_coordinator._handle_anti_entropy_message(message)
+        self.assertEqual((reply['items'], reply['wanted']), ([], [self.key]))
+
+        # and this node, compared with the lagging replica's leaf, sends the delete
+        message['leaves'] = {index: lagging_coordinator._leaf_versions(*tree.leaf_range(index))}
+        reply = self.coordinator._handle_anti_entropy_message(message)
+        self.assertEqual((reply['items'], reply['wanted']), ([[self.key, None, delete_timestamp, 'delete']], []))
+
+        for item in self.coordinator._iter_stored_items([self.key]):
+            lagging_coordinator._apply_item(item)
+        self.assertEqual(lagging.persistence_stage.get(self.key)['timestamp'], delete_timestamp)
+        self.assertEqual(tree.root, lagging_tree.root)
+
+        # trees rebuilt from storage hold the tombstone too
+        for server in [self.server, lagging]:
+            server.persistence_stage.rebuild_merkle_trees([(0, 0)], depth=5)
+        self.assertEqual(self.server.persistence_stage.merkle_tree(0, 0).root, lagging.persistence_stage.merkle_tree(0, 0).root)
+        self.assertEqual(self.server.persistence_stage.merkle_tree(0, 0).root, tree.root)
+
+    def test_purged_tombstone_leaves_merkle_tree(self):
+        engines = [PersistenceEngine(tombstone_grace_period=0),
+                   LogPersistenceEngine(self.directory + '/log', max_segment_size=1024, compaction_threshold=2, tombstone_grace_period=0),
+                   LSMPersistenceEngine(self.directory + '/lsm', memtable_size=256, index_interval=4, compaction_threshold=2, tombstone_grace_period=0)]
+        for engine in engines:
+            server = FakeServer(util.get_hash('node'), persistence_engine=engine)
+            persistence_stage = server.persistence_stage
+            persistence_stage.rebuild_merkle_trees([(0, 0)], depth=4)
+            tree = persistence_stage.merkle_tree(0, 0)
+            persistence_stage.delete(self.key, util.add_time(util.current_time(), -10))
+            # written after the delete, so compaction reaches the segment or table holding it
+            for i in xrange(200):
+                persistence_stage.put(util.get_key_hash(str(i % 20)), str(i), server.clock.now())
+            while persistence_stage.process():
+                pass
+
+            self.assertEqual(list(persistence_stage.tombstones_in_range()), [])
+            persistence_stage.rebuild_merkle_trees([(0, 0)], depth=5)
+            persistence_stage.rebuild_merkle_trees([(0, 0)], depth=4)
+            self.assertEqual(tree.root, persistence_stage.merkle_tree(0, 0).root)
+            if hasattr(engine, 'close'):
+                engine.close()
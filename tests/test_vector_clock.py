@@ -0,0 +1,63 @@
+"""
+    test_vector_clock.py
+    ~~~~~~~~~~~~
+    Tests that vector clocks order writes, keep concurrent versions as siblings and prune their oldest entries, and
+    that context tokens round trip.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import unittest
+
+import vector_clock
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def test_increment(self):
+        clock = vector_clock.increment({}, 'a', 1)
+        self.assertEqual(clock, {'a': [1, 1]})
+        self.assertEqual(vector_clock.increment(clock, 'a', 2), {'a': [2, 2]})
+        self.assertEqual(clock, {'a': [1, 1]})
+
+    def test_descends(self):
+        a = vector_clock.increment({}, 'a', 1)
+        ab = vector_clock.increment(a, 'b', 2)
+        ac = vector_clock.increment(a, 'c', 3)
+        self.assertTrue(vector_clock.descends(ab, a))
+        self.assertFalse(vector_clock.descends(a, ab))
+        self.assertFalse(vector_clock.descends(ab, ac))
+        self.assertFalse(vector_clock.descends(ac, ab))
+        self.assertTrue(vector_clock.descends(a, {}))
+        self.assertEqual(vector_clock.merge([ab, ac]), {'a': [1, 1], 'b': [1, 2], 'c': [1, 3]})
+
+    def test_reconcile(self):
+        first = vector_clock.new_version('first', None, 'a', 1)[0]
+        context = vector_clock.encode_context(first[1])
+        left = vector_clock.new_version('left', context, 'b', 2)[0]
+        right = vector_clock.new_version('right', context, 'c', 3)[0]
+        self.assertEqual(vector_clock.reconcile([left, first]), [left])
+        self.assertEqual(vector_clock.reconcile([right, first, left, right]), [left, right])
+        self.assertEqual(vector_clock.reconcile([left, right]), vector_clock.reconcile([right, left]))
+
+        context = vector_clock.encode_context(vector_clock.merge(clock for _, clock in [left, right]))
+        resolved = vector_clock.new_version('resolved', context, 'a', 4)[0]
+        self.assertEqual(vector_clock.reconcile([left, right, resolved]), [resolved])
+        self.assertEqual(vector_clock.latest_timestamp([left, right]), 3)
+
+    def test_prune(self):
+        clock = {}
+        for timestamp in xrange(vector_clock.MAX_ENTRIES + 5):
+            clock = vector_clock.increment(clock, 'actor{}'.format(timestamp), timestamp)
+        self.assertEqual(len(clock), vector_clock.MAX_ENTRIES)
+        self.assertNotIn('actor0', clock)
+        self.assertIn('actor{}'.format(vector_clock.MAX_ENTRIES + 4), clock)
+
+    def test_context(self):
+        clock = {'a': [3, 2 ** 60], 'b': [1, 5]}
+        self.assertEqual(vector_clock.decode_context(vector_clock.encode_context(clock)), clock)
+        self.assertEqual(vector_clock.decode_context(unicode(vector_clock.encode_context(clock))), clock)
+        self.assertEqual(vector_clock.decode_context(None), {})
+        self.assertRaises(ValueError, vector_clock.decode_context, 'not a token')
+        self.assertRaises(ValueError, vector_clock.decode_context, vector_clock.encode_context(['a']))
@@ -0,0 +1,92 @@
+"""
+    test_vnodes.py
+    ~~~~~~~~~~~~
+    Tests that virtual nodes on ConsistentHashRing balance the keys between nodes according to their weights, return
+    distinct nodes for a key, and spread the ranges of a node that leaves over the rest of the ring.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import binascii
+import collections
+import unittest
+
+import util
+from consistent_hash_ring import ConsistentHashRing
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.node_hashes = [util.get_hash('node{}'.format(index)) for index in xrange(10)]
+
+    def shares(self, ring):
+        """ Returns node_hash -> fraction of the ring it is the primary node for."""
+        shares = collections.defaultdict(float)
+        for index, (low, high) in enumerate(ring.ranges()):
+            width = (high - low) % 2 ** util.TOKEN_BITS
+            shares[ring.preference_list(index)[0]] += width / float(2 ** util.TOKEN_BITS)
+        return shares
+
+    def test_single_vnode(self):
+        ring = ConsistentHashRing(node_hashes=self.node_hashes)
+        self.assertEqual(list(ring.tokens), sorted(util.node_token(node_hash) for node_hash in self.node_hashes))
+        node_hashes = sorted(self.node_hashes)
+        # the key hash with the same token as the node
+        key_hash = binascii.unhexlify(node_hashes[2][:2 * util.KEY_HASH_BYTES])
+        self.assertEqual(ring.get_responsible_node_hashes(key_hash), tuple(node_hashes[2:5]))
+        self.assertEqual(ring.get_responsible_node_hashes('\xff' * util.KEY_HASH_BYTES), tuple(node_hashes[:3]))
+
+    def test_balance(self):
+        single = self.shares(ConsistentHashRing(node_hashes=self.node_hashes))
+        ring = ConsistentHashRing(node_hashes=self.node_hashes, vnodes=128)
+        self.assertEqual(len(ring.tokens), 1280)
+        shares = self.shares(ring)
+        self.assertAlmostEqual(sum(shares.values()), 1.0)
+        self.assertLess(max(shares.values()) / min(shares.values()), max(single.values()) / min(single.values()))
+        self.assertLess(max(shares.values()), 0.15)
+        self.assertGreater(min(shares.values()), 0.05)
+
+    def test_distinct_nodes(self):
+        ring = ConsistentHashRing(node_hashes=self.node_hashes[:4], vnodes=32)
+        for index in xrange(100):
+            node_hashes = ring.get_responsible_node_hashes(util.get_key_hash('key{}'.format(index)))
+            self.assertEqual(len(node_hashes), 3)
+            self.assertEqual(len(set(node_hashes)), 3)
+        ring = ConsistentHashRing(node_hashes=self.node_hashes[:2], vnodes=32)
+        self.assertEqual(len(set(ring.get_responsible_node_hashes(util.get_key_hash('key')))), 2)
+        self.assertEqual(sorted(ring.clockwise_node_hashes(util.get_key_hash('key'))), sorted(self.node_hashes[:2]))
+
+    def test_weights(self):
+        heavy = self.node_hashes[0]
+        ring = ConsistentHashRing(node_hashes=self.node_hashes, vnodes=128, weights={heavy: 2.0})
+        self.assertEqual(len(ring.node_tokens(heavy)), 256)
+        shares = self.shares(ring)
+        light = sum(shares[node_hash] for node_hash in self.node_hashes[1:]) / 9
+        self.assertGreater(shares[heavy] / light, 1.6)
+        self.assertLess(shares[heavy] / light, 2.4)
+
+    def test_add_remove(self):
+        ring = ConsistentHashRing(node_hashes=self.node_hashes[:9], vnodes=16)
+        before = ring.get_responsible_node_hashes(util.get_key_hash('key'))
+        ring.add_node_hash(self.node_hashes[9])
+        self.assertEqual(len(ring.tokens), 160)
+        ring.remove_node_hash(self.node_hashes[9])
+        self.assertEqual(len(ring.tokens), 144)
+        self.assertEqual(ring.get_responsible_node_hashes(util.get_key_hash('key')), before)
+
+    def test_failure_spreads(self):
+        ring = ConsistentHashRing(node_hashes=self.node_hashes, vnodes=64)
+        failed = self.node_hashes[0]
+        new_node_hashes, source_node_hashes = set(), set()
+        for index in xrange(len(ring.tokens)):
+            old_node_hashes = ring.preference_list(index)
+            if failed not in old_node_hashes:
+                continue
+            new = [node_hash for node_hash in ring.preference_list(index, exclude=failed) if node_hash not in old_node_hashes]
+            self.assertEqual(len(new), 1)
+            new_node_hashes.update(new)
+            source_node_hashes.add([node_hash for node_hash in old_node_hashes if node_hash != failed][0])
+        self.assertEqual(new_node_hashes, set(self.node_hashes[1:]))
+        self.assertEqual(source_node_hashes, set(self.node_hashes[1:]))
@@ -0,0 +1,112 @@
+"""
+    test_wire_protocol.py
+    ~~~~~~~~~~~~
+    Tests the binary message encoding, and that MessageChannel splits frames and detects the framing of a connection.
+
+    Run tests with:
+    clear; python -m unittest discover -v
+"""
+
+import json
+import unittest
+
+import util
+import wire_protocol
+from wire_protocol import MessageChannel, FRAMING_BINARY, FRAMING_JSON
+
+
+class RecordingChannel(MessageChannel):
+    """ MessageChannel without a socket that records the messages it receives."""
+
+    def __init__(self, framing=None, buffer_size=wire_protocol.RECEIVE_BUFFER_SIZE):
+        MessageChannel.__init__(self, framing=framing, buffer_size=buffer_size)
+        self.messages = []
+        self.chunk_size = None
+
+    def _process_message(self, message):
+        self.messages.append(message)
+
+    def feed(self, data, chunk_size):
+        """ Runs data through handle_read, at most chunk_size bytes at a time as if read from the socket."""
+        self._data = data
+        self.chunk_size = chunk_size
+        while self._data:
+            self.handle_read()
+
+    def _recv_into(self, view):
+        num_bytes = min(len(view), self.chunk_size, len(self._data))
+        view[:num_bytes] = self._data[:num_bytes]
+        self._data = self._data[num_bytes:]
+        return num_bytes
+
+
+class TestSequenceFunctions(unittest.TestCase):
+
+    def setUp(self):
+        self.message = {
+            'type': 'internal request',
+            'command': 'put',
+            'key': util.get_hash('key'),
+            'value': 'value',
+            'timestamp': util.current_time(),
+            'request_id': 12345,
+            'items': [[util.get_hash(str(i)), str(i), -i, 2 ** 70, 0.5, None, True, False] for i in xrange(300)],
+        }
+
+    def test_round_trip(self):
+        self.assertEqual(wire_protocol.decode(wire_protocol.encode(self.message)), self.message)
+        self.assertEqual(wire_protocol.decode(wire_protocol.encode(u'unicode \u2603')), u'unicode \u2603')
+        self.assertEqual(wire_protocol.decode(wire_protocol.encode('x' * 100000)), 'x' * 100000)
+
+    def test_binary_values(self):
+        value = ''.join(chr(i) for i in xrange(256)) * 10
+        self.assertEqual(wire_protocol.decode(wire_protocol.encode({'value': value})), {'value': value})
+
+    def test_smaller_than_json(self):
+        self.assertLess(len(wire_protocol.encode(self.message)), len(json.dumps(self.message)))
+
+    def test_invalid(self):
+        data = wire_protocol.encode(self.message)
+        self.assertRaises(ValueError, wire_protocol.decode, data[:-1])
+        self.assertRaises(ValueError, wire_protocol.decode, data + 'N')
+        self.assertRaises(ValueError, wire_protocol.decode, '?')
+        self.assertRaises(TypeError, wire_protocol.encode, object())
+
+    def test_binary_framing(self):
+        messages = [self.message, {'value': '\r\n' * 10}, {}]
+        data = ''.join(wire_protocol.pack_frame(message) for message in messages)
+        for chunk_size in (1, 7, len(data)):
+            channel = RecordingChannel()
+            channel.feed(data, chunk_size)
+            self.assertEqual(channel.framing, FRAMING_BINARY)
+            self.assertEqual(channel.messages, messages)
+
+    def test_json_framing(self):
+        messages = [{'command': 'get', 'key': 'key'}, {'command': 'put', 'key': 'key', 'value': 'value'}]
+        data = ''.join(json.dumps(message) + '\r\n' for message in messages)
+        for chunk_size in (1, 7, len(data)):
+            channel = RecordingChannel()
+            channel.feed(data, chunk_size)
+            self.assertEqual(channel.framing, FRAMING_JSON)
+            self.assertEqual(channel.messages, messages)
+            self.assertEqual(json.loads(channel.pack_message(messages[0])), messages[0])
+
+    def test_buffer_growth(self):
+        messages = [{'value': 'x' * 100000}, {'value': 'y'}, {'value': 'z' * 1000}]
+        for chunk_size in (1000, 100001):
+            channel = RecordingChannel(buffer_size=16)
+            channel.feed(''.join(wire_protocol.pack_frame(message) for message in messages), chunk_size)
+            self.assertEqual(channel.messages, messages)
+
+            channel = RecordingChannel(buffer_size=16)
+            channel.feed(''.join(json.dumps(message) + '\r\n' for message in messages), chunk_size)
+            self.assertEqual(channel.messages, messages)
+
+    def test_buffer_shrinks(self):
+        channel = RecordingChannel(buffer_size=16)
+        channel.feed(wire_protocol.pack_frame({'value': 'x' * 1000}), 100)
+        self.assertGreater(len(channel._buffer), 1000)
+        frame = wire_protocol.pack_frame({})
+        channel.feed(frame * (wire_protocol.SHRINK_AFTER_DRAINS + 1), len(frame))
+        self.assertEqual(len(channel._buffer), 16)
+        self.assertEqual(len(channel.messages), wire_protocol.SHRINK_AFTER_DRAINS + 2)